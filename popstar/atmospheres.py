@@ -7,86 +7,219 @@ from astropy.io import fits
 from astropy.table import Table, Column
 import pysynphot
 import time
+import hashlib
+from collections import OrderedDict
+from popstar.utils.files import atomic_write
 import pdb
 
 log = logging.getLogger('atmospheres')
 
 def get_atmosphere_bounds(model_dir, metallicity=0, temperature=20000, gravity=4):
     """
-    Given atmosphere model, get temperature and gravity bounds
+    Given atmosphere model, get temperature and gravity bounds. 
+    Inputs can be floats or arrays.
+
+    The closest metallicity in the grid is used. The temperature is
+    clipped to the grid temperature range, and the gravity to the 
+    most conservative gravity range of the two closest grid temperatures.
+    The catalog is parsed once per grid (see get_atmosphere_catalog_index).
     """
-    # Open catalog fits file and break out row indices
-    catalog = Table.read('{0}/grid/{1}/catalog.fits'.format(os.environ['PYSYN_CDBS'], model_dir))
+    scalar = np.isscalar(temperature) & np.isscalar(gravity)
     
-    teff_arr = []
-    z_arr = []
-    logg_arr = []
-    for cur_row_index in range(len(catalog)):
-        index = catalog['INDEX'][cur_row_index]
-        tmp = index.split(',')
-        teff_arr.append(float(tmp[0]))
-        z_arr.append(float(tmp[1]))
-        logg_arr.append(float(tmp[2]))
-    teff_arr = np.array(teff_arr)
-    z_arr = np.array(z_arr)
-    logg_arr = np.array(logg_arr)
-
-    # Filter by metallicity. Will chose the closest metallicity to desired input
-    metal_list = np.unique(np.array(z_arr))
-    metal_idx = np.where( (abs(metal_list - metallicity)) == min(abs(metal_list - metallicity)))
-    
-    z_filt = np.where(z_arr == metal_list[metal_idx])
-    teff_arr = teff_arr[z_filt]
-    logg_arr = logg_arr[z_filt]
-    
-    # # Now find the closest atmosphere in parameter space to
-    # # the one we want. We'll find the match with the lowest
-    # # fractional difference
-    # teff_diff = (teff_arr - temperature) / temperature
-    # logg_diff = (logg_arr - gravity) / gravity
-    #
-    # diff_tot = abs(teff_diff) + abs(logg_diff)
-    # idx_f = np.argmin(diff_tot)
-    #
-    # temperature_new = teff_arr[idx_f]
-    # gravity_new = logg_arr[idx_f]
-    
-    # First check if temperature within bounds
-    temperature_new = temperature
-    if temperature > np.max(teff_arr):
-        temperature_new = np.max(teff_arr)
-    if temperature < np.min(teff_arr):
-        temperature_new = np.min(teff_arr)
-    
-    # If temperature within bounds, then check if metallicity within bounds
-    teff_diff = np.abs(teff_arr - temperature)
-    sorted_min_diffs = np.unique(teff_diff)
-    
-    ## Find two closest temperatures
-    teff_close_1 = teff_arr[np.where(teff_diff == sorted_min_diffs[0])[0][0]]
-    teff_close_2 = teff_arr[np.where(teff_diff == sorted_min_diffs[1])[0][0]]
-    
-    logg_arr_1 = logg_arr[np.where(teff_arr == teff_close_1)]
-    logg_arr_2 = logg_arr[np.where(teff_arr == teff_close_2)]
-    
-    ## Switch to most conservative bound of logg out of two closest temps
-    gravity_new = gravity
-    if gravity > np.min([np.max(logg_arr_1), np.max(logg_arr_2)]):
-        gravity_new = np.min([np.max(logg_arr_1), np.max(logg_arr_2)])
-    if gravity < np.max([np.min(logg_arr_1), np.min(logg_arr_2)]):
-        gravity_new = np.max([np.min(logg_arr_1), np.min(logg_arr_2)])
+    index = get_atmosphere_catalog_index(model_dir)
+    (temperature_new, gravity_new) = index.get_bounds(metallicity=metallicity,
+                                                      temperature=temperature,
+                                                      gravity=gravity)
     
     # Print out changes, if any
-    if temperature_new != temperature:
-        teff_msg = 'Changing to T={0:6.0f} for T={1:6.0f} logg={2:4.2f}'
-        print( teff_msg.format(temperature_new, temperature, gravity))
+    temperature, gravity = np.broadcast_arrays(np.atleast_1d(temperature), np.atleast_1d(gravity))
     
-    if gravity_new != gravity:
-        logg_msg = 'Changing to logg={0:4.2f} for T={1:6.0f} logg={2:4.2f}'
-        print( logg_msg.format(gravity_new, temperature, gravity))
+    teff_msg = 'Changing to T={0:6.0f} for T={1:6.0f} logg={2:4.2f}'
+    for ii in np.where(temperature_new != temperature)[0]:
+        print( teff_msg.format(temperature_new[ii], temperature[ii], gravity[ii]))
+    
+    logg_msg = 'Changing to logg={0:4.2f} for T={1:6.0f} logg={2:4.2f}'
+    for ii in np.where(gravity_new != gravity)[0]:
+        print( logg_msg.format(gravity_new[ii], temperature[ii], gravity[ii]))
+
+    if scalar:
+        return (float(temperature_new[0]), float(gravity_new[0]))
     
     return (temperature_new, gravity_new)
 
+class AtmosphereCatalogIndex(object):
+    """
+    Pre-parsed index of an atmosphere grid catalog.fits, used to move
+    atmospheres onto the grid bounds (see get_atmosphere_bounds).
+
+    For each metallicity in the grid, the index holds the sorted grid 
+    temperatures and the min/max gravity at each temperature, so that 
+    bounds for whole arrays of stars are found with searchsorted. 
+    The index is saved next to the grid (<grid_dir>/cube/catalog_index.npz)
+    and is rebuilt if catalog.fits is newer.
+
+    Parameters
+    ----------
+    model_dir: str
+        Name of the atmosphere grid, i.e. the directory in $PYSYN_CDBS/grid/.
+
+    grid_dir: path or None, optional
+        Directory with the grid catalog.fits. If None, use 
+        $PYSYN_CDBS/grid/<model_dir>/.
+
+    cache_dir: path or None, optional
+        Directory to save the index in. If None, use <grid_dir>/cube/.
+        If the directory can't be written to, the index is only kept in memory.
+    """
+    def __init__(self, model_dir, grid_dir=None, cache_dir=None):
+        if grid_dir == None:
+            grid_dir = '{0}/grid/{1}/'.format(os.environ['PYSYN_CDBS'], model_dir)
+        if cache_dir == None:
+            cache_dir = grid_dir + '/cube/'
+
+        self.model_dir = model_dir
+        self.catalog_file = '{0}/catalog.fits'.format(grid_dir)
+        self.index_file = '{0}/catalog_index.npz'.format(cache_dir)
+
+        if (os.path.exists(self.index_file) and
+            (os.path.getmtime(self.index_file) >= os.path.getmtime(self.catalog_file))):
+            data = np.load(self.index_file)
+            for key in ['metal', 'offsets', 'teff', 'order', 'logg_min', 'logg_max']:
+                setattr(self, key, data[key])
+        else:
+            self.make_index()
+
+            try:
+                self._save(cache_dir)
+            except OSError:
+                pass
+            
+        return
+
+    def make_index(self):
+        """
+        Parse the grid catalog.fits into the index arrays.
+        """
+        catalog = Table.read(self.catalog_file)
+        params = np.array([[float(x) for x in index.split(',')] for index in catalog['INDEX']])
+        teff_arr = params[:, 0]
+        z_arr = params[:, 1]
+        logg_arr = params[:, 2]
+        
+        self.metal = np.unique(z_arr)
+
+        # Temperatures for each metallicity are stored one after
+        # another, starting at offsets[ii].
+        teff = []
+        order = []
+        logg_min = []
+        logg_max = []
+        for zz in self.metal:
+            idx = np.where(z_arr == zz)[0]
+
+            # Keep track of the catalog order of the temperatures,
+            # which is used to break ties.
+            teff_z, first, inverse = np.unique(teff_arr[idx], return_index=True,
+                                               return_inverse=True)
+            inverse = inverse.reshape(-1)
+            
+            logg_min_z = np.full(len(teff_z), np.inf)
+            logg_max_z = np.full(len(teff_z), -np.inf)
+            np.minimum.at(logg_min_z, inverse, logg_arr[idx])
+            np.maximum.at(logg_max_z, inverse, logg_arr[idx])
+
+            teff.append(teff_z)
+            order.append(first)
+            logg_min.append(logg_min_z)
+            logg_max.append(logg_max_z)
+
+        self.offsets = np.cumsum([0] + [len(tt) for tt in teff])
+        self.teff = np.concatenate(teff)
+        self.order = np.concatenate(order)
+        self.logg_min = np.concatenate(logg_min)
+        self.logg_max = np.concatenate(logg_max)
+
+        return
+
+    def get_bounds(self, metallicity=0, temperature=20000, gravity=4):
+        """
+        Return the (temperature, gravity) arrays moved onto the grid bounds,
+        following get_atmosphere_bounds.
+        """
+        metallicity, temperature, gravity = np.broadcast_arrays(np.atleast_1d(metallicity).astype(float),
+                                                                np.atleast_1d(temperature).astype(float),
+                                                                np.atleast_1d(gravity).astype(float))
+        temperature_new = temperature.copy()
+        gravity_new = gravity.copy()
+
+        # Use the closest metallicity in the grid
+        metal_idx = np.argmin(np.abs(self.metal[None, :] - metallicity[:, None]), axis=1)
+
+        for zz in np.unique(metal_idx):
+            idx = np.where(metal_idx == zz)[0]
+            zslice = slice(self.offsets[zz], self.offsets[zz+1])
+            teff = self.teff[zslice]
+            
+            # Check if temperature within bounds
+            temp = temperature[idx]
+            temperature_new[idx] = np.clip(temp, teff[0], teff[-1])
+
+            # Find the two closest grid temperatures. These are among the 
+            # two grid points on either side. Ties go to the temperature 
+            # that is listed first in the catalog.
+            cand = np.searchsorted(teff, temp)[:, None] + np.arange(-2, 2)[None, :]
+            on_grid = (cand >= 0) & (cand < len(teff))
+            cand = np.clip(cand, 0, len(teff) - 1)
+            diff = np.where(on_grid, np.abs(teff[cand] - temp[:, None]), np.inf)
+            rank = self.order[zslice][cand]
+            rows = np.arange(len(idx))
+
+            close_1 = np.lexsort((rank, diff), axis=1)[:, 0]
+            diff_2 = np.where(diff > diff[rows, close_1][:, None], diff, np.inf)
+            close_2 = np.lexsort((rank, diff_2), axis=1)[:, 0]
+            close_2 = np.where(np.isfinite(diff_2[rows, close_2]), close_2, close_1)
+
+            teff_close_1 = cand[rows, close_1]
+            teff_close_2 = cand[rows, close_2]
+
+            # Switch to most conservative bound of logg out of two closest temps
+            logg_min = self.logg_min[zslice]
+            logg_max = self.logg_max[zslice]
+            logg_hi = np.minimum(logg_max[teff_close_1], logg_max[teff_close_2])
+            logg_lo = np.maximum(logg_min[teff_close_1], logg_min[teff_close_2])
+
+            grav = gravity[idx]
+            gravity_new[idx] = np.where(grav > logg_hi, logg_hi, grav)
+            gravity_new[idx] = np.where(grav < logg_lo, logg_lo, gravity_new[idx])
+
+        return (temperature_new, gravity_new)
+
+    def _save(self, cache_dir):
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Write to a temporary file first, so that other processes never
+        # read a partially written index.
+        with atomic_write(self.index_file, suffix='.npz') as tmp_file:
+            with open(tmp_file, 'wb') as _out:
+                np.savez(_out, metal=self.metal, offsets=self.offsets, teff=self.teff,
+                         order=self.order, logg_min=self.logg_min, logg_max=self.logg_max)
+
+        return
+
+# Parsed catalog indices, keyed by grid name
+atmosphere_catalog_indices = {}
+
+def get_atmosphere_catalog_index(model_dir):
+    """
+    Return the AtmosphereCatalogIndex for a model grid. It is 
+    only built (or read from disk) once per session.
+    """
+    if model_dir not in atmosphere_catalog_indices:
+        atmosphere_catalog_indices[model_dir] = AtmosphereCatalogIndex(model_dir)
+
+    return atmosphere_catalog_indices[model_dir]
+
 def get_kurucz_atmosphere(metallicity=0, temperature=20000, gravity=4):
     """
     Return atmosphere from the Kurucz pysnphot grid 
@@ -115,7 +248,7 @@ def get_kurucz_atmosphere(metallicity=0, temperature=20000, gravity=4):
         which is often sufficient synthetic photometry in most cases.
     """
     try:
-        sp = pysynphot.Icat('k93models', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('k93models', temperature, metallicity, gravity)
     except:
         # Check atmosphere catalog bounds
         (temperature, gravity) = get_atmosphere_bounds('k93models',
@@ -123,7 +256,7 @@ def get_kurucz_atmosphere(metallicity=0, temperature=20000, gravity=4):
                                                    temperature=temperature,
                                                    gravity=gravity)
     
-        sp = pysynphot.Icat('k93models', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('k93models', temperature, metallicity, gravity)
 
     # Do some error checking
     idx = np.where(sp.flux != 0)[0]
@@ -166,7 +299,7 @@ def get_castelli_atmosphere(metallicity=0, temperature=20000, gravity=4, rebin=F
         True for verbose output
     """
     try:
-        sp = pysynphot.Icat('ck04models', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('ck04models', temperature, metallicity, gravity)
     except:
         # Check atmosphere catalog bounds
         (temperature, gravity) = get_atmosphere_bounds('ck04models',
@@ -174,7 +307,7 @@ def get_castelli_atmosphere(metallicity=0, temperature=20000, gravity=4, rebin=F
                                                    temperature=temperature,
                                                    gravity=gravity)
     
-        sp = pysynphot.Icat('ck04models', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('ck04models', temperature, metallicity, gravity)
         
     # Do some error checking
     idx = np.where(sp.flux != 0)[0]
@@ -193,7 +326,7 @@ def get_nextgen_atmosphere(metallicity=0, temperature=5000, gravity=4, rebin=Fal
     gravity = log gravity (def = 4.0)
     """
     try:
-        sp = pysynphot.Icat('nextgen', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('nextgen', temperature, metallicity, gravity)
     except:
         # Check atmosphere catalog bounds
         (temperature, gravity) = get_atmosphere_bounds('nextgen',
@@ -201,7 +334,7 @@ def get_nextgen_atmosphere(metallicity=0, temperature=5000, gravity=4, rebin=Fal
                                                    temperature=temperature,
                                                    gravity=gravity)
     
-        sp = pysynphot.Icat('nextgen', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('nextgen', temperature, metallicity, gravity)
 
     # Do some error checking
     idx = np.where(sp.flux != 0)[0]
@@ -219,7 +352,7 @@ def get_amesdusty_atmosphere(metallicity=0, temperature=5000, gravity=4, rebin=F
     temperature = Kelvin (def = 5000)
     gravity = log gravity (def = 4.0)
     """
-    sp = pysynphot.Icat('AMESdusty', temperature, metallicity, gravity)
+    sp = get_grid_atmosphere('AMESdusty', temperature, metallicity, gravity)
 
     # Do some error checking
     idx = np.where(sp.flux != 0)[0]
@@ -255,7 +388,7 @@ def get_phoenix_atmosphere(metallicity=0, temperature=5000, gravity=4,
 
     """
     try:
-        sp = pysynphot.Icat('phoenix', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('phoenix', temperature, metallicity, gravity)
     except:
         # Check atmosphere catalog bounds
         (temperature, gravity) = get_atmosphere_bounds('phoenix',
@@ -263,7 +396,7 @@ def get_phoenix_atmosphere(metallicity=0, temperature=5000, gravity=4,
                                                    temperature=temperature,
                                                    gravity=gravity)
     
-        sp = pysynphot.Icat('phoenix', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('phoenix', temperature, metallicity, gravity)
 
     # Do some error checking
     idx = np.where(sp.flux != 0)[0]
@@ -459,7 +592,7 @@ def get_phoenixv16_atmosphere(metallicity=0, temperature=4000, gravity=4, rebin=
 
     # Extract atmosphere. If that fails, then check bounds and try again
     try:
-        sp = pysynphot.Icat(atm_model_name, temperature, metallicity, gravity)
+        sp = get_grid_atmosphere(atm_model_name, temperature, metallicity, gravity)
     except:
         # Check atmosphere catalog bounds
         (temperature, gravity) = get_atmosphere_bounds(atm_model_name,
@@ -467,7 +600,7 @@ def get_phoenixv16_atmosphere(metallicity=0, temperature=4000, gravity=4, rebin=
                                                    temperature=temperature,
                                                    gravity=gravity)
     
-        sp = pysynphot.Icat(atm_model_name, temperature, metallicity, gravity)
+        sp = get_grid_atmosphere(atm_model_name, temperature, metallicity, gravity)
     
     # Do some error checking
     idx = np.where(sp.flux != 0)[0]
@@ -515,7 +648,7 @@ def get_BTSettl_2015_atmosphere(metallicity=0, temperature=2500, gravity=4, rebi
         atm_name = 'BTSettl_2015'
 
     try:
-        sp = pysynphot.Icat(atm_name, temperature, metallicity, gravity)
+        sp = get_grid_atmosphere(atm_name, temperature, metallicity, gravity)
     except:
         # Check atmosphere catalog bounds
         (temperature, gravity) = get_atmosphere_bounds(atm_name,
@@ -523,7 +656,7 @@ def get_BTSettl_2015_atmosphere(metallicity=0, temperature=2500, gravity=4, rebi
                                                    temperature=temperature,
                                                    gravity=gravity)
     
-        sp = pysynphot.Icat(atm_name, temperature, metallicity, gravity)
+        sp = get_grid_atmosphere(atm_name, temperature, metallicity, gravity)
         
     
     # Do some error checking
@@ -615,7 +748,7 @@ def get_BTSettl_atmosphere(metallicity=0, temperature=2500, gravity=4.5, rebin=T
         atm_name = 'BTSettl'
 
     try:
-        sp = pysynphot.Icat(atm_name, temperature, metallicity, gravity)
+        sp = get_grid_atmosphere(atm_name, temperature, metallicity, gravity)
     except:
         # Check atmosphere catalog bounds
         (temperature, gravity) = get_atmosphere_bounds(atm_name,
@@ -623,7 +756,7 @@ def get_BTSettl_atmosphere(metallicity=0, temperature=2500, gravity=4.5, rebin=T
                                                    temperature=temperature,
                                                    gravity=gravity)
     
-        sp = pysynphot.Icat(atm_name, temperature, metallicity, gravity)
+        sp = get_grid_atmosphere(atm_name, temperature, metallicity, gravity)
         
     
     # Do some error checking
@@ -657,7 +790,7 @@ def get_wdKoester_atmosphere(metallicity=0, temperature=20000, gravity=7):
         resolution as the Castelli+04 atmospheres. Default is False,
         which is often sufficient synthetic photometry in most cases.
     """
-    sp = pysynphot.Icat('wdKoester', temperature, metallicity, gravity)
+    sp = get_grid_atmosphere('wdKoester', temperature, metallicity, gravity)
 
     # Do some error checking
     idx = np.where(sp.flux != 0)[0]
@@ -676,7 +809,7 @@ def get_atlas_phoenix_atmosphere(metallicity=0, temperature=5250, gravity=4):
     Only valid for temps between 5000 - 5500K, gravity from 0 = 5.0 
     """
     try:
-        sp = pysynphot.Icat('merged_atlas_phoenix', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('merged_atlas_phoenix', temperature, metallicity, gravity)
     except:
         # Check atmosphere catalog bounds
         (temperature, gravity) = get_atmosphere_bounds('merged_atlas_phoenix',
@@ -684,7 +817,7 @@ def get_atlas_phoenix_atmosphere(metallicity=0, temperature=5250, gravity=4):
                                                    temperature=temperature,
                                                    gravity=gravity)
     
-        sp = pysynphot.Icat('merged_atlas_phoenix', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('merged_atlas_phoenix', temperature, metallicity, gravity)
 
     # Do some error checking
     idx = np.where(sp.flux != 0)[0]
@@ -704,7 +837,7 @@ def get_BTSettl_phoenix_atmosphere(metallicity=0, temperature=5250, gravity=4):
     Only valid for temps between 3200 - 3800K, gravity from 2.5 - 5.5 
     """
     try:
-        sp = pysynphot.Icat('merged_BTSettl_phoenix', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('merged_BTSettl_phoenix', temperature, metallicity, gravity)
     except:
         # Check atmosphere catalog bounds
         (temperature, gravity) = get_atmosphere_bounds('merged_BTSettl_phoenix',
@@ -712,7 +845,7 @@ def get_BTSettl_phoenix_atmosphere(metallicity=0, temperature=5250, gravity=4):
                                                    temperature=temperature,
                                                    gravity=gravity)
     
-        sp = pysynphot.Icat('merged_BTSettl_phoenix', temperature, metallicity, gravity)
+        sp = get_grid_atmosphere('merged_BTSettl_phoenix', temperature, metallicity, gravity)
 
     # Do some error checking
     idx = np.where(sp.flux != 0)[0]
@@ -872,6 +1005,177 @@ def get_merged_atmosphere(metallicity=0, temperature=20000, gravity=4.5, verbose
     
 
 
+def get_merged_atmosphere_regime(metallicity, temperature, gravity):
+    """
+    Return the name of the model grid that get_merged_atmosphere uses 
+    for each star. Inputs can be floats or arrays. The grid names are:
+    'BTSettl_2015', 'BTSettl_phoenix', 'phoenixv16', 'atlas_phoenix', 
+    'castelli', or '' where no grid is defined (e.g. for NaN temperatures).
+
+    Parameters
+    ----------
+    metallicity: float or array
+        The stellar metallicity, in terms of [Z]
+
+    temperature: float or array
+        The stellar temperature, in units of K
+
+    gravity: float or array
+        The stellar gravity, in cgs units
+    """
+    metallicity, temperature, gravity = np.broadcast_arrays(np.atleast_1d(metallicity),
+                                                            np.atleast_1d(temperature),
+                                                            np.atleast_1d(gravity))
+    regime = np.full(len(temperature), '', dtype='U15')
+
+    # Same order of checks as get_merged_atmosphere. For T < 3800, the 
+    # atmosphere depends on metallicity + gravity.
+    btsettl = (metallicity == 0) & (temperature <= 3200) & (gravity > 2.5)
+    btsettl_phoenix = ((metallicity == 0) & (temperature > 3200) &
+                       (temperature < 3800) & (gravity > 2.5))
+    phoenix = (((temperature <= 3800) & ~btsettl & ~btsettl_phoenix) |
+               ((temperature >= 3800) & (temperature < 5000)))
+
+    regime[(temperature >= 5500)] = 'castelli'
+    regime[(temperature >= 5000) & (temperature < 5500)] = 'atlas_phoenix'
+    regime[phoenix] = 'phoenixv16'
+    regime[btsettl_phoenix] = 'BTSettl_phoenix'
+    regime[btsettl] = 'BTSettl_2015'
+
+    return regime
+
+def get_merged_atmospheres(metallicity, temperature, gravity, rebin=True,
+                           wave=None, verbose=False):
+    """
+    Array version of get_merged_atmosphere. Return the stellar 
+    atmospheres for many stars at once, as a 2D flux array on 
+    a common wavelength grid.
+
+    The stars are split up by model grid (see get_merged_atmosphere_regime),
+    and each unique set of (metallicity, temperature, gravity) is only 
+    fetched once.
+
+    Parameters
+    ----------
+    metallicity: float or array
+        The stellar metallicity, in terms of [Z]
+
+    temperature: array
+        The stellar temperatures, in units of K
+
+    gravity: array
+        The stellar gravities, in cgs units
+        
+    rebin: boolean
+        If true, rebins the atmospheres so that they are the same
+        resolution as the Castelli+04 atmospheres. Default is True.
+
+    wave: array or None
+        The wavelength grid for the output fluxes, in Angstroms. 
+        If None, use the wavelength grid of the first atmosphere.
+
+    verbose: boolean
+        True for verbose output
+
+    Returns
+    -------
+    wave: array
+        Wavelength grid, in Angstroms
+
+    flux: array
+        2D (N_stars x N_wave) array of fluxes, in flam. Stars without
+        an atmosphere (e.g. NaN temperatures) have NaN fluxes.
+    """
+    metallicity, temperature, gravity = np.broadcast_arrays(np.atleast_1d(metallicity),
+                                                            np.atleast_1d(temperature),
+                                                            np.atleast_1d(gravity))
+    regime = get_merged_atmosphere_regime(metallicity, temperature, gravity)
+
+    flux = None
+    
+    for name in merged_atmosphere_grids:
+        idx = np.where(regime == name)[0]
+        if len(idx) == 0:
+            continue
+        
+        if verbose:
+            print( '{0} atmosphere: {1:d} stars'.format(name, len(idx)))
+
+        # Only fetch each unique atmosphere once.
+        params = np.array([metallicity[idx], temperature[idx], gravity[idx]]).T
+        params_uni, inverse = np.unique(params, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+
+        atm_func, takes_rebin, grid_name = merged_atmosphere_grids[name]
+        kwargs = {}
+        if takes_rebin:
+            kwargs['rebin'] = rebin
+            if rebin:
+                grid_name += '_rebin'
+
+        # If the flux cube for this grid has been made, interpolate 
+        # all of the atmospheres at once.
+        grid = get_atmosphere_grid(grid_name)
+        if grid != None:
+            sp_flux, good = grid.get_fluxes(params_uni[:, 0], params_uni[:, 1], params_uni[:, 2])
+
+            # Out of bounds: move to the catalog bounds and try again,
+            # as the scalar functions do.
+            bad = np.where(~good)[0]
+            if len(bad) > 0:
+                (temp_new, grav_new) = get_atmosphere_bounds(grid_name,
+                                                             metallicity=params_uni[bad, 0],
+                                                             temperature=params_uni[bad, 1],
+                                                             gravity=params_uni[bad, 2])
+                sp_flux[bad], good[bad] = grid.get_fluxes(params_uni[bad, 0], temp_new, grav_new)
+
+                if not good.all():
+                    msg = 'get_merged_atmospheres: {0:d} atmospheres outside of the {1} grid'
+                    raise pysynphot.exceptions.ParameterOutOfBounds(msg.format((~good).sum(), grid_name))
+
+            if wave is None:
+                wave = np.array(grid.wave, dtype=float)
+            if flux is None:
+                flux = np.full((len(temperature), len(wave)), np.nan, dtype=float)
+
+            flux[idx] = resample_fluxes(grid.wave, sp_flux, wave)[inverse]
+            continue
+
+        for uu in range(len(params_uni)):
+            sp = atm_func(metallicity=params_uni[uu, 0], temperature=params_uni[uu, 1],
+                          gravity=params_uni[uu, 2], **kwargs)
+
+            if wave is None:
+                wave = np.array(sp.wave, dtype=float)
+            if flux is None:
+                flux = np.full((len(temperature), len(wave)), np.nan, dtype=float)
+
+            # Evaluate on the common wavelength grid, in flam
+            sp_flux = pysynphot.units.Photlam().ToFlam(wave, sp(wave))
+            flux[idx[inverse == uu]] = sp_flux
+
+    if flux is None:
+        raise ValueError('get_merged_atmospheres: no atmospheres for any of the stars')
+
+    return wave, flux
+
+def resample_fluxes(wave, flux, wave_new):
+    """
+    Linearly interpolate a 2D (N_stars x N_wave) array of flam fluxes 
+    onto a new wavelength grid. As in pysynphot, the interpolation 
+    is done in photlam.
+    """
+    if np.array_equal(wave, wave_new):
+        return np.array(flux, dtype=float)
+
+    photlam = pysynphot.units.Flam().ToPhotlam(wave, flux)
+
+    jj = np.clip(np.searchsorted(wave, wave_new), 1, len(wave) - 1)
+    frac = np.clip((wave_new - wave[jj-1]) / (wave[jj] - wave[jj-1]), 0, 1)
+    photlam_new = photlam[:, jj-1] * (1.0 - frac) + photlam[:, jj] * frac
+
+    return pysynphot.units.Photlam().ToFlam(wave_new, photlam_new)
+
 def get_wd_atmosphere(metallicity=0, temperature=20000, gravity=4, verbose=False):
     """
     Return the white dwarf atmosphere from 
@@ -915,7 +1219,539 @@ def get_wd_atmosphere(metallicity=0, temperature=20000, gravity=4, verbose=False
         bbspec.convert('flam')
         bbspec *= (1000 * 3.08e18 / 6.957e10)**2
         return bbspec
+
+def get_bb_atmosphere(metallicity=0, temperature=5000, gravity=4, rebin=True):
+    """
+    Return a blackbody spectrum, in flam, on the default pysynphot 
+    wavelength grid. Only the temperature is used; the other 
+    parameters are there so that this can be used in place of the 
+    other atmosphere functions (e.g. for testing without the model grids).
+
+    Parameters
+    ----------
+    temperature: float
+        The stellar temperature, in units of K
+    """
+    bbspec = pysynphot.spectrum.BlackBody(temperature)
+    bbspec.convert('flam')
+    return bbspec
+    
+# Atmosphere function for each of the model grids used by 
+# get_merged_atmosphere, whether the function takes rebin, and the
+# name of the grid (+ '_rebin' for rebinned atmospheres).
+merged_atmosphere_grids = OrderedDict([
+    ('BTSettl_2015', (get_BTSettl_2015_atmosphere, True, 'BTSettl_2015')),
+    ('BTSettl_phoenix', (get_BTSettl_phoenix_atmosphere, False, 'merged_BTSettl_phoenix')),
+    ('phoenixv16', (get_phoenixv16_atmosphere, True, 'phoenix_v16')),
+    ('atlas_phoenix', (get_atlas_phoenix_atmosphere, False, 'merged_atlas_phoenix')),
+    ('castelli', (get_castelli_atmosphere, False, 'ck04models'))])
+    
+#--------------------------------------#
+# Atmosphere spectrum cache
+#--------------------------------------#
+class AtmosphereCache(object):
+    """
+    Persistent on-disk cache of interpolated atmosphere spectra, so that 
+    the same grid interpolations are not repeated for every isochrone.
+
+    Each spectrum is stored as its own .npy file (wavelength and flux
+    in flam), named by a hash of (atmosphere function, Teff, logg, [M/H], 
+    other keywords such as rebin). When the cache grows beyond `max_size`, 
+    the least recently used spectra are deleted.
+
+    By default, the cache keys are the exact parameters, so the cached 
+    spectra are the same as those from the atmosphere function. To increase 
+    the number of cache hits between neighboring isochrones, the requested 
+    temperature and gravity can be rounded to `teff_step` and `logg_step` 
+    before the atmosphere is fetched (this changes the photometry slightly).
+
+    Parameters
+    ----------
+    cache_dir: path or None, optional
+        Directory to store the cached spectra in. If None, 
+        use $POPSTAR_MODELS/atm_cache/.
+
+    max_size: float, optional
+        Maximum total size of the cache, in bytes. Default is 2 GB.
+
+    teff_step: float or None, optional
+        Temperature rounding step, in K (e.g. 5). Default is None 
+        (no rounding).
+
+    logg_step: float or None, optional
+        Gravity rounding step, in cgs (e.g. 0.01). Default is None 
+        (no rounding).
+
+    Examples
+    --------
+    Wrap an atmosphere function and use it as usual::
+
+        cache = AtmosphereCache()
+        atm_func = cache.cached(get_merged_atmosphere)
+        sp = atm_func(temperature=5772, gravity=4.44)
+        print(cache.hits, cache.misses)
+    """
+    def __init__(self, cache_dir=None, max_size=2e9, teff_step=None, logg_step=None):
+        if cache_dir == None:
+            try:
+                cache_dir = os.environ['POPSTAR_MODELS'] + '/atm_cache/'
+            except KeyError:
+                raise ValueError('POPSTAR_MODELS is undefined; must specify cache_dir')
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+            
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.teff_step = teff_step
+        self.logg_step = logg_step
+
+        self.hits = 0
+        self.misses = 0
+
+        # Keep track of the existing files and their sizes, in order of
+        # last use (oldest first).
+        files = glob.glob('{0}/*.npy'.format(cache_dir))
+        files.sort(key=os.path.getmtime)
+
+        self._entries = OrderedDict()
+        for ff in files:
+            key = os.path.basename(ff)[:-4]
+            self._entries[key] = os.path.getsize(ff)
+        self.size = sum(self._entries.values())
+
+        return
+
+    def get_key(self, atm_name, temperature, gravity, metallicity, **kwargs):
+        """
+        Return the cache key for an atmosphere function name and 
+        (already rounded) parameters.
+        """
+        params = [atm_name, repr(float(temperature)), repr(float(gravity)),
+                  repr(float(metallicity))]
+        for kw in sorted(kwargs.keys()):
+            if kw == 'verbose':
+                continue
+            params.append('{0}={1}'.format(kw, kwargs[kw]))
+
+        return hashlib.sha1(','.join(params).encode()).hexdigest()
+
+    def get_atmosphere(self, atm_func, metallicity=0, temperature=20000, gravity=4, **kwargs):
+        """
+        Return the atmosphere from atm_func for the given parameters, reading 
+        it from the cache if possible. Additional keywords (e.g. rebin) 
+        are passed to atm_func and are part of the cache key.
+
+        Returns
+        -------
+        sp: pysynphot ArraySourceSpectrum
+            Spectrum in flam.
+        """
+        if self.teff_step != None:
+            temperature = round(temperature / self.teff_step) * self.teff_step
+        if self.logg_step != None:
+            gravity = round(gravity / self.logg_step) * self.logg_step
+
+        key = self.get_key(atm_func.__name__, temperature, gravity, metallicity, **kwargs)
+        cache_file = '{0}/{1}.npy'.format(self.cache_dir, key)
+
+        if os.path.exists(cache_file):
+            self.hits += 1
+            spec = np.load(cache_file)
+
+            # Mark as recently used. The file may have been written
+            # by another process.
+            if key not in self._entries:
+                self._entries[key] = os.path.getsize(cache_file)
+                self.size += self._entries[key]
+            self._entries.move_to_end(key)
+            os.utime(cache_file)
+        else:
+            self.misses += 1
+            sp = atm_func(metallicity=metallicity, temperature=temperature,
+                          gravity=gravity, **kwargs)
+            sp.convert('angstrom')
+            sp.convert('flam')
+            spec = np.array([sp.wave, sp.flux], dtype=float)
+
+            self._save(key, cache_file, spec)
+
+        sp = pysynphot.spectrum.ArraySourceSpectrum(wave=spec[0], flux=spec[1],
+                                           waveunits='angstrom', fluxunits='flam')
+        return sp
+
+    def cached(self, atm_func):
+        """
+        Return a function with the same call signature as atm_func
+        that fetches atmospheres through this cache.
+        """
+        def cached_atm_func(**kwargs):
+            return self.get_atmosphere(atm_func, **kwargs)
+
+        cached_atm_func.__name__ = atm_func.__name__
+
+        return cached_atm_func
+
+    def clear(self):
+        """
+        Delete all spectra from the cache and reset the hit/miss counters.
+        """
+        for key in list(self._entries.keys()):
+            self._remove(key)
+
+        self.hits = 0
+        self.misses = 0
+
+        return
+
+    def _save(self, key, cache_file, spec):
+        # Write to a temporary file first, so that other processes never
+        # read a partially written spectrum.
+        with atomic_write(cache_file) as tmp_file:
+            with open(tmp_file, 'wb') as _out:
+                np.save(_out, spec)
+
+        if key in self._entries:
+            self.size -= self._entries[key]
+        self._entries[key] = os.path.getsize(cache_file)
+        self.size += self._entries[key]
+
+        # Evict the least recently used spectra, but always keep
+        # the one we just added.
+        while (self.size > self.max_size) and (len(self._entries) > 1):
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+
+        return
+
+    def _remove(self, key):
+        cache_file = '{0}/{1}.npy'.format(self.cache_dir, key)
+        if os.path.exists(cache_file):
+            os.remove(cache_file)
+        self.size -= self._entries.pop(key)
+
+        return
+    
+#--------------------------------------#
+# Preloaded atmosphere grids
+#--------------------------------------#
+class AtmosphereGrid(object):
+    """
+    Atmosphere model grid preloaded into a single float32 flux array,
+    interpolated in the same way as pysynphot.Icat but without 
+    reading any FITS files.
+
+    make_cube() reads every spectrum listed in the grid's catalog.fits
+    and saves them as one (N_models x N_wave) float32 array in flam 
+    (flux.npy), along with the grid axes and a (N_teff x N_metal x N_logg) 
+    index of the models (axes.npz). The flux array is read with 
+    memory mapping.
+
+    As in pysynphot.Icat, the temperature is bracketed first, then the 
+    metallicity at each of the two temperatures, then the gravity at each 
+    of the four (temperature, metallicity) pairs. The 8 surrounding models 
+    are then linearly interpolated. If any of them is missing or has 
+    no valid flux, the atmosphere is out of bounds.
+
+    Parameters
+    ----------
+    model_dir: str
+        Name of the atmosphere grid, i.e. the directory in $PYSYN_CDBS/grid/
+        (e.g. 'ck04models', 'phoenix_v16_rebin').
+
+    grid_dir: path or None, optional
+        Directory with the grid catalog.fits. If None, use 
+        $PYSYN_CDBS/grid/<model_dir>/.
+
+    cube_dir: path or None, optional
+        Directory to save the flux cube in. If None, use <grid_dir>/cube/.
+
+    Examples
+    --------
+    Convert the grid once::
+
+        grid = AtmosphereGrid('ck04models')
+        grid.make_cube()
+
+    Afterwards, the get_*_atmosphere functions using this grid pick up 
+    the cube automatically (see get_grid_atmosphere).
+    """
+    def __init__(self, model_dir, grid_dir=None, cube_dir=None):
+        if grid_dir == None:
+            grid_dir = '{0}/grid/{1}/'.format(os.environ['PYSYN_CDBS'], model_dir)
+        if cube_dir == None:
+            cube_dir = grid_dir + '/cube/'
+
+        self.model_dir = model_dir
+        self.grid_dir = grid_dir
+        self.cube_dir = cube_dir
+
+        self.catalog_file = '{0}/catalog.fits'.format(grid_dir)
+        self.flux_file = '{0}/flux.npy'.format(cube_dir)
+        self.axes_file = '{0}/axes.npz'.format(cube_dir)
+
+        self.flux = None
+
+        return
+
+    def exists(self):
+        """
+        Return True if the cube has been made and is newer
+        than the grid catalog.
+        """
+        if not (os.path.exists(self.axes_file) and os.path.exists(self.flux_file)):
+            return False
+
+        return os.path.getmtime(self.axes_file) >= os.path.getmtime(self.catalog_file)
+
+    def make_cube(self, verbose=False):
+        """
+        Read all of the spectra in the grid and save them as the flux cube.
+        """
+        t1 = time.time()
+        
+        catalog = Table.read(self.catalog_file)
+        params = np.array([[float(x) for x in index.split(',')] for index in catalog['INDEX']])
+
+        teff = np.unique(params[:, 0])
+        metal = np.unique(params[:, 1])
+        logg = np.unique(params[:, 2])
+
+        index = np.full((len(teff), len(metal), len(logg)), -1, dtype=np.int32)
+        index[np.searchsorted(teff, params[:, 0]),
+              np.searchsorted(metal, params[:, 1]),
+              np.searchsorted(logg, params[:, 2])] = np.arange(len(catalog))
+
+        if not os.path.exists(self.cube_dir):
+            os.makedirs(self.cube_dir)
+
+        # Write to temporary files first, so that other processes never
+        # read a partially written cube. The axes file is replaced last.
+        with atomic_write(self.axes_file, suffix='.npz') as tmp_axes_file, \
+             atomic_write(self.flux_file, suffix='.npy') as tmp_flux_file:
+            flux = None
+            valid = np.zeros(len(catalog), dtype=bool)
+
+            for ii in range(len(catalog)):
+                # Read the spectrum the same way as pysynphot.Icat
+                name = catalog['FILENAME'][ii]
+                filename = '{0}/{1}'.format(self.grid_dir, name.split('[')[0])
+                column = name.split('[')[1][:-1]
+                sp = pysynphot.spectrum.TabularSourceSpectrum(filename, fluxname=column)
+
+                if flux is None:
+                    wave = np.array(sp.wave, dtype=float)
+                    flux = np.lib.format.open_memmap(tmp_flux_file, mode='w+', dtype=np.float32,
+                                                     shape=(len(catalog), len(wave)))
+                elif not np.array_equal(sp.wave, wave):
+                    raise ValueError('AtmosphereGrid: {0} is not on the same wavelength grid'.format(name))
+
+                flux[ii] = pysynphot.units.Photlam().ToFlam(wave, sp(wave))
+
+                totflux = sp.integrate()
+                valid[ii] = np.isfinite(totflux) & (totflux > 0)
+
+                if verbose and ((ii % 100) == 0):
+                    print( 'Read {0:d} of {1:d} spectra'.format(ii, len(catalog)))
+
+            flux.flush()
+            del flux
+
+            with open(tmp_axes_file, 'wb') as _out:
+                np.savez(_out, teff=teff, metal=metal, logg=logg, wave=wave,
+                         index=index, valid=valid)
+
+        self.flux = None
+        atmosphere_grids.pop(self.model_dir, None)
+        
+        t2 = time.time()
+        print( 'Made {0} flux cube in {1:f} s'.format(self.model_dir, t2 - t1))
+
+        return
+
+    def load(self):
+        """
+        Read the grid axes and memory map the flux cube.
+        """
+        axes = np.load(self.axes_file)
+        self.teff = axes['teff']
+        self.metal = axes['metal']
+        self.logg = axes['logg']
+        self.wave = axes['wave']
+        self.index = axes['index']
+        self.valid = axes['valid']
+
+        self.flux = np.load(self.flux_file, mmap_mode='r')
+
+        return
+
+    def get_fluxes(self, metallicity, temperature, gravity):
+        """
+        Interpolate the grid for many stars at once.
+
+        Parameters
+        ----------
+        metallicity: float or array
+            The stellar metallicity, in terms of [Z]
+
+        temperature: float or array
+            The stellar temperature, in units of K
+
+        gravity: float or array
+            The stellar gravity, in cgs units
+
+        Returns
+        -------
+        flux: array
+            2D (N_stars x N_wave) array of fluxes in flam, on the 
+            wavelength grid self.wave. Out of bounds stars have NaN fluxes.
+
+        good: boolean array
+            False for stars that are outside of the grid.
+        """
+        if self.flux is None:
+            self.load()
+            
+        metallicity, temperature, gravity = np.broadcast_arrays(np.atleast_1d(metallicity).astype(float),
+                                                                np.atleast_1d(temperature).astype(float),
+                                                                np.atleast_1d(gravity).astype(float))
+        n_star = len(temperature)
+        
+        # Bracket temperature, then metallicity at each temperature,
+        # then gravity at each (temperature, metallicity).
+        has_teff = np.ones((n_star, len(self.teff)), dtype=bool)
+        t_brack = _bracket_axis(self.teff, temperature, has_teff)
+        
+        corners = []
+        for tt, t_wgt in zip(t_brack[0], t_brack[1]):
+            has_metal = (self.index[tt] >= 0).any(axis=-1)
+            z_brack = _bracket_axis(self.metal, metallicity, has_metal)
+            
+            for zz, z_wgt in zip(z_brack[0], z_brack[1]):
+                has_logg = self.index[tt, zz] >= 0
+                g_brack = _bracket_axis(self.logg, gravity, has_logg)
+
+                for gg, g_wgt in zip(g_brack[0], g_brack[1]):
+                    model = self.index[tt, zz, gg]
+                    ok = t_brack[2] & z_brack[2] & g_brack[2]
+                    corners.append((model, t_wgt * z_wgt * g_wgt, ok))
+
+        good = np.ones(n_star, dtype=bool)
+        for model, wgt, ok in corners:
+            good &= ok & self.valid[model]
+
+        flux = np.zeros((n_star, len(self.wave)), dtype=float)
+        for model, wgt, ok in corners:
+            flux[good] += wgt[good, None] * self.flux[model[good]]
+        flux[~good] = np.nan
+
+        return flux, good
+
+    def get_spectrum(self, metallicity=0, temperature=20000, gravity=4):
+        """
+        Interpolate the grid for one star.
+
+        Returns
+        -------
+        sp: pysynphot ArraySourceSpectrum
+            Spectrum in flam.
+
+        Raises
+        ------
+        pysynphot.exceptions.ParameterOutOfBounds
+            If the parameters are outside of the grid, as pysynphot.Icat does.
+        """
+        flux, good = self.get_fluxes(metallicity, temperature, gravity)
+
+        if not good[0]:
+            msg = '{0}: Teff={1:g}, metallicity={2:g}, logg={3:g} is outside of the grid'
+            raise pysynphot.exceptions.ParameterOutOfBounds(msg.format(self.model_dir, temperature,
+                                                                       metallicity, gravity))
+
+        sp = pysynphot.spectrum.ArraySourceSpectrum(wave=self.wave, flux=flux[0],
+                                                    waveunits='angstrom', fluxunits='flam')
+        return sp
+
+def _bracket_axis(axis, value, has_value):
+    """
+    For each star, find the closest grid values below and above `value`
+    among the grid values that exist for that star (has_value, 
+    N_stars x N_axis). Returns the ([lower, upper] indices, 
+    [lower, upper] weights, in bounds) like pysynphot.Icat, where
+    the upper model is used if the value is on the grid.
+    """
+    below = has_value & (axis[None, :] <= value[:, None])
+    above = has_value & (axis[None, :] >= value[:, None])
+
+    ok = below.any(axis=1) & above.any(axis=1)
     
+    lo = len(axis) - 1 - np.argmax(below[:, ::-1], axis=1)
+    hi = np.argmax(above, axis=1)
+
+    dx = axis[hi] - axis[lo]
+    w_lo = np.zeros(len(value), dtype=float)
+    idx = np.where(ok & (dx != 0))[0]
+    w_lo[idx] = (axis[hi][idx] - value[idx]) / dx[idx]
+
+    return [lo, hi], [w_lo, 1.0 - w_lo], ok
+
+# Loaded flux cubes, keyed by grid name. None for the grids 
+# that don't have a flux cube.
+atmosphere_grids = {}
+
+def get_atmosphere_grid(model_dir):
+    """
+    Return the preloaded AtmosphereGrid for a model grid, or None
+    if its flux cube has not been made. Both are remembered, so the
+    files are only checked once (make_cube resets this).
+    """
+    if model_dir in atmosphere_grids:
+        return atmosphere_grids[model_dir]
+
+    try:
+        grid = AtmosphereGrid(model_dir)
+    except KeyError:
+        # PYSYN_CDBS is undefined
+        grid = None
+    
+    if (grid != None) and grid.exists():
+        grid.load()
+    else:
+        grid = None
+        
+    atmosphere_grids[model_dir] = grid
+
+    return grid
+
+def get_grid_atmosphere(model_dir, temperature, metallicity, gravity):
+    """
+    Drop-in replacement for pysynphot.Icat(model_dir, temperature, metallicity, gravity)
+    that uses the preloaded flux cube if it has been made.
+    """
+    grid = get_atmosphere_grid(model_dir)
+
+    if grid == None:
+        return pysynphot.Icat(model_dir, temperature, metallicity, gravity)
+
+    return grid.get_spectrum(metallicity=metallicity, temperature=temperature, gravity=gravity)
+
+def make_atmosphere_cubes(model_dirs=['ck04models', 'phoenix_v16_rebin', 'BTSettl_2015_rebin',
+                                      'merged_atlas_phoenix', 'merged_BTSettl_phoenix',
+                                      'wdKoester'],
+                          verbose=False):
+    """
+    Make the preloaded flux cubes (see AtmosphereGrid) for a list of grids. 
+    By default, these are the grids used by get_merged_atmosphere and
+    get_wd_atmosphere.
+    """
+    for model_dir in model_dirs:
+        grid = AtmosphereGrid(model_dir)
+        grid.make_cube(verbose=verbose)
+
+        atmosphere_grids.pop(model_dir, None)
+
+    return
+
 #--------------------------------------#
 # Atmosphere formatting functions
 #--------------------------------------#
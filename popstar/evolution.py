@@ -4,12 +4,15 @@ from numpy import searchsorted, genfromtxt
 import numpy as np
 import os
 import glob
+import json
 import pdb
 import warnings
 from astropy.table import Table, vstack, Column
+from collections import OrderedDict
 from scipy import interpolate
 import pylab as py
 from popstar.utils import objects
+from popstar.utils.files import atomic_write
 
 logger = logging.getLogger('evolution')
 
@@ -47,7 +50,367 @@ class StellarEvolution(object):
         self.age_list = age_list
         
         return
+
+    def _interpolate_isochrone(self, age=1.e8, metallicity=0.0):
+        """
+        Interpolate between the grid isochrones that bracket the 
+        requested age and metallicity. Points are matched by 
+        equivalent evolutionary phase (EEP) and interpolated linearly in 
+        log(age), then in [M/H]. Columns that can't be interpolated 
+        (e.g. phase, isWR) are taken from the closer grid isochrone.
+        At a grid point, the grid isochrone is returned unchanged.
+
+        Requires an 'EEP' column in the isochrones and a 
+        _get_iso_file(age_idx, z_idx) method.
+        """
+        log_age = math.log10(age)
+        
+        # check age and metallicity are within bounds
+        if ((log_age < np.min(self.age_list)) or (log_age > np.max(self.age_list))):
+            logger.error('Requested age {0} is out of bounds.'.format(log_age))
+
+        metal_list = np.log10(np.array(self.z_list) / self.z_solar)
+        if ((metallicity < np.min(metal_list)) or (metallicity > np.max(metal_list))):
+            logger.error('Requested metallicity {0} is out of bounds.'.format(metallicity))
+
+        age_idx, age_wgt = bracket_grid(self.age_list, log_age)
+        z_idx, z_wgt = bracket_grid(metal_list, metallicity)
+
+        # Interpolate in age at each metallicity, then in metallicity.
+        iso_z = []
+        for zz in z_idx:
+            iso_age = [isochrone_cache.get_isochrone(self, aa, zz, self._get_iso_file(aa, zz))
+                       for aa in age_idx]
+            iso_z.append(_interpolate_eep(iso_age[0], iso_age[1], age_wgt))
+        iso = _interpolate_eep(iso_z[0], iso_z[1], z_wgt)
+
+        iso.meta['log_age'] = log_age
+        iso.meta['metallicity_in'] = metallicity
+        iso.meta['metallicity_act'] = (1.0 - z_wgt) * metal_list[z_idx[0]] + z_wgt * metal_list[z_idx[1]]
+
+        return iso
+
+def bracket_grid(grid, value):
+    """
+    Return the indices of the grid values on either side of value
+    and the weight of the upper one. Values outside of the grid 
+    go to the closest grid point.
+    """
+    grid = np.asarray(grid)
+    if len(grid) == 1:
+        return [0, 0], 0.0
+    
+    hi = np.clip(searchsorted(grid, value, side='left'), 1, len(grid) - 1)
+    lo = hi - 1
+    wgt = np.clip((value - grid[lo]) / (grid[hi] - grid[lo]), 0, 1)
+
+    # Snap to grid points, to avoid round-off from log(age). Then
+    # only one grid isochrone is needed.
+    if np.isclose(wgt, 0, rtol=0, atol=1e-6):
+        return [lo, lo], 0.0
+    if np.isclose(wgt, 1, rtol=0, atol=1e-6):
+        return [hi, hi], 0.0
+
+    return [lo, hi], wgt
+
+def _interpolate_eep(iso1, iso2, wgt):
+    """
+    Linearly interpolate between two isochrone tables, matching 
+    points by EEP. wgt is the weight of iso2. Only EEPs in both 
+    isochrones are kept. Non-float columns come from the closer isochrone.
+    """
+    if wgt == 0:
+        return iso1.copy()
+    if wgt == 1:
+        return iso2.copy()
+
+    eep, idx1, idx2 = np.intersect1d(iso1['EEP'], iso2['EEP'], return_indices=True)
+
+    near, idx_near = (iso1, idx1) if (wgt < 0.5) else (iso2, idx2)
+    
+    iso = Table()
+    for col in iso1.colnames:
+        if (col != 'EEP') and (col != 'phase') and (iso1[col].dtype.kind == 'f'):
+            iso[col] = (1.0 - wgt) * iso1[col][idx1] + wgt * iso2[col][idx2]
+        else:
+            iso[col] = near[col][idx_near]
+
+    return iso
+    
+class IsochroneCache(object):
+    """
+    In-memory cache of isochrone tables read by the evolution models,
+    so that the same isochrone file is not read and re-formatted
+    every time it is requested. The least recently used tables are 
+    dropped when there are more than `max_tables`.
+
+    Tables are keyed by the evolution model, model version, age index, 
+    metallicity index and isochrone file. A copy of the cached table is 
+    returned, so callers are free to modify it.
+
+    Parameters
+    ----------
+    max_tables: int, optional
+        Maximum number of isochrone tables to keep. Set to 0 
+        to turn off caching. Default is 32.
+    """
+    def __init__(self, max_tables=32):
+        self.max_tables = max_tables
+        
+        self.hits = 0
+        self.misses = 0
+        
+        self._tables = OrderedDict()
+        
+        return
+
+    def get_isochrone(self, evo_model, age_idx, z_idx, full_iso_file):
+        """
+        Return the isochrone table for evo_model at age_list[age_idx]
+        and z_list[z_idx], reading it with evo_model._read_isochrone
+        if it isn't in the cache.
+        """
+        key = (type(evo_model).__name__, getattr(evo_model, 'version', None),
+               age_idx, z_idx, full_iso_file)
+
+        if key in self._tables:
+            self.hits += 1
+            self._tables.move_to_end(key)
+        else:
+            self.misses += 1
+            iso = evo_model._read_isochrone(full_iso_file)
+
+            if self.max_tables <= 0:
+                return iso
+
+            self._tables[key] = iso
+            while len(self._tables) > self.max_tables:
+                self._tables.popitem(last=False)
+
+        return self._tables[key].copy()
+
+    def clear(self):
+        """
+        Remove all tables from the cache and reset the hit/miss counters.
+        """
+        self._tables.clear()
+        self.hits = 0
+        self.misses = 0
+
+        return
+
+# Isochrone cache shared by all of the evolution models
+isochrone_cache = IsochroneCache()
+
+class PackedIsochrones(object):
+    """
+    All of the isochrones in one isochrone directory (i.e. every age
+    for one metallicity), packed into a single columnar file 
+    by pack_isochrones(). 
+
+    The packed file (iso_packed.dat, memory mapped) holds each column,
+    in its own dtype, with all ages one after another. The index 
+    (iso_packed_index.npz) has the column names, dtypes and byte offsets,
+    the offset and meta-data of each isochrone file, and the size and 
+    modification time of each isochrone file when it was packed.
+    A single isochrone is a slice of each column, so no parsing is needed,
+    and whole columns can be used for bulk queries over all ages.
+
+    Parameters
+    ----------
+    iso_dir: path
+        Isochrone directory with the packed file.
+    """
+    def __init__(self, iso_dir):
+        self.iso_dir = iso_dir
+        
+        index = np.load('{0}/iso_packed_index.npz'.format(iso_dir))
+        self.col_names = list(index['col_names'])
+        self.col_dtypes = list(index['col_dtypes'])
+        self.col_offsets = index['col_offsets']
+        self.files = list(index['files'])
+        self.log_age = index['log_age']
+        self.offsets = index['offsets']
+        self.metas = [json.loads(meta) for meta in index['metas']]
+        self.source_sizes = index['source_sizes']
+        self.source_mtimes = index['source_mtimes']
+
+        data = np.memmap('{0}/iso_packed.dat'.format(iso_dir), dtype=np.uint8, mode='r')
+        n_rows = self.offsets[-1]
+        self._columns = []
+        for cc in range(len(self.col_names)):
+            dtype = np.dtype(self.col_dtypes[cc])
+            start = self.col_offsets[cc]
+            self._columns.append(data[start:start + n_rows * dtype.itemsize].view(dtype))
+
+        self._file_idx = dict(zip(self.files, range(len(self.files))))
+
+        return
+
+    def __contains__(self, iso_file):
+        return iso_file in self._file_idx
+
+    def is_current(self, read_func=None):
+        """
+        Check that none of the packed isochrone files that still exist 
+        have changed since they were packed. If read_func is given, 
+        also check that it gives the same columns as in the packed file.
+        """
+        iso_file = None
+        for ii in range(len(self.files)):
+            try:
+                stat = os.stat('{0}/{1}'.format(self.iso_dir, self.files[ii]))
+            except OSError:
+                continue
+
+            if ((stat.st_size != self.source_sizes[ii]) or 
+                (stat.st_mtime_ns != self.source_mtimes[ii])):
+                return False
+            iso_file = self.files[ii]
+
+        if (read_func != None) and (iso_file != None):
+            iso = read_func('{0}/{1}'.format(self.iso_dir, iso_file))
+            col_dtypes = [iso[col].dtype.str for col in iso.colnames]
+            if (iso.colnames != self.col_names) or (col_dtypes != self.col_dtypes):
+                return False
+
+        return True
+
+    def get_column(self, name):
+        """
+        Return one column for all of the isochrones. Isochrone ii is
+        the slice offsets[ii]:offsets[ii+1].
+        """
+        cc = self.col_names.index(name)
+        
+        return np.array(self._columns[cc])
+
+    def get_isochrone(self, iso_file):
+        """
+        Return the table for one isochrone file (e.g. 'iso_7.00.fits').
+        """
+        ii = self._file_idx[iso_file]
+        rows = slice(self.offsets[ii], self.offsets[ii+1])
+
+        iso = Table(meta=OrderedDict(self.metas[ii]))
+        for cc in range(len(self.col_names)):
+            iso[self.col_names[cc]] = np.array(self._columns[cc][rows])
+
+        return iso
+
+def pack_isochrones(iso_dir, read_func):
+    """
+    Pack all of the iso_*.fits files in an isochrone directory into 
+    one columnar file (see PackedIsochrones). get_packed_isochrones
+    re-packs when the isochrone files change.
+
+    Parameters
+    ----------
+    iso_dir: path
+        Isochrone directory, containing the files for one metallicity.
+
+    read_func: function
+        Function that reads one isochrone file and returns the table 
+        in standard format (e.g. MISTv1()._read_isochrone_file).
+    """
+    files = glob.glob('{0}/iso_*.fits'.format(iso_dir))
+    files = [os.path.basename(ff) for ff in files]
+    log_age = np.array([float(ff[4:-5]) for ff in files])
+
+    sdx = np.argsort(log_age)
+    files = [files[ss] for ss in sdx]
+    log_age = log_age[sdx]
+
+    # Keep the file stats from before they are read, so that any 
+    # changes while packing are caught next time.
+    stats = [os.stat('{0}/{1}'.format(iso_dir, ff)) for ff in files]
+    source_sizes = np.array([stat.st_size for stat in stats], dtype=np.int64)
+    source_mtimes = np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64)
+
+    isos = [read_func('{0}/{1}'.format(iso_dir, ff)) for ff in files]
+
+    col_names = isos[0].colnames
+    col_dtypes = [isos[0][col].dtype.str for col in col_names]
+    for col in col_names:
+        if isos[0][col].dtype.kind not in 'biuf':
+            raise ValueError('pack_isochrones: column {0} is not numeric'.format(col))
+    for ii in range(len(isos)):
+        if isos[ii].colnames != col_names:
+            raise ValueError('pack_isochrones: {0} has different columns'.format(files[ii]))
+
+    offsets = np.cumsum([0] + [len(iso) for iso in isos])
+    metas = [json.dumps(dict(iso.meta), default=str) for iso in isos]
+
+    # Write to temporary files first, so that other processes never
+    # read a partially written file. The index is written last.
+    col_offsets = np.zeros(len(col_names), dtype=np.int64)
+    with atomic_write('{0}/iso_packed_index.npz'.format(iso_dir)) as tmp_index_file, \
+         atomic_write('{0}/iso_packed.dat'.format(iso_dir)) as tmp_data_file:
+        with open(tmp_data_file, 'wb') as _out:
+            for cc in range(len(col_names)):
+                col_offsets[cc] = _out.tell()
+                for iso in isos:
+                    _out.write(np.asarray(iso[col_names[cc]], dtype=col_dtypes[cc]).tobytes())
+
+                # Keep the columns 8-byte aligned.
+                _out.write(b'\0' * (-_out.tell() % 8))
+        
+        with open(tmp_index_file, 'wb') as _out:
+            np.savez(_out, col_names=col_names, col_dtypes=col_dtypes, col_offsets=col_offsets,
+                     files=files, log_age=log_age, offsets=offsets, metas=metas,
+                     source_sizes=source_sizes, source_mtimes=source_mtimes)
+
+    # Packed file from older versions, with every column as float64
+    if os.path.exists('{0}/iso_packed.npy'.format(iso_dir)):
+        os.remove('{0}/iso_packed.npy'.format(iso_dir))
+
+    packed_isochrones.pop(os.path.normpath(iso_dir), None)
+
+    return
+
+# Loaded packed isochrone files, keyed by isochrone directory.
+# None if the directory isn't packed (or the packed file is out of date).
+packed_isochrones = {}
+
+def get_packed_isochrones(iso_dir, read_func=None):
+    """
+    Return the PackedIsochrones for an isochrone directory, or None
+    if the directory has not been packed. 
+
+    If the isochrone files have changed since they were packed (see
+    PackedIsochrones.is_current), the packed file isn't used. If 
+    read_func is given, the directory is re-packed with it instead,
+    if possible.
+    """
+    iso_dir = os.path.normpath(iso_dir)
     
+    if iso_dir in packed_isochrones:
+        return packed_isochrones[iso_dir]
+
+    if not os.path.exists('{0}/iso_packed_index.npz'.format(iso_dir)):
+        return None
+
+    try:
+        packed = PackedIsochrones(iso_dir)
+    except (KeyError, OSError):
+        # Packed by an older version
+        packed = None
+
+    if (packed == None) or (not packed.is_current(read_func)):
+        packed = None
+
+        if read_func != None:
+            try:
+                pack_isochrones(iso_dir, read_func)
+                packed = PackedIsochrones(iso_dir)
+            except OSError:
+                # Can't re-pack (e.g. read-only directory); read the files.
+                pass
+
+    packed_isochrones[iso_dir] = packed
+
+    return packed
+
 class Geneva(StellarEvolution):
     def __init__(self):
         r"""
@@ -171,6 +534,19 @@ class Ekstrom12(StellarEvolution):
         else:
             full_iso_file = self.model_dir + 'iso/' + z_dir + 'norot/' + iso_file
         
+        # Read the isochrone (or fetch it from the cache)
+        iso = isochrone_cache.get_isochrone(self, age_idx, z_idx, full_iso_file)
+
+        iso.meta['log_age'] = log_age
+        iso.meta['metallicity_in'] = metallicity
+        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
+
+        return iso
+
+    def _read_isochrone(self, full_iso_file):
+        """
+        Read an isochrone file and put it in the standard format.
+        """
         # Return isochrone data
         iso = Table.read(full_iso_file, format='fits')
         iso.rename_column('col4', 'Z')
@@ -191,10 +567,6 @@ class Ekstrom12(StellarEvolution):
         # Add a phase column... everything is just a star.
         iso.add_column( Column(np.ones(len(iso)), name = 'phase'))
 
-        iso.meta['log_age'] = log_age
-        iso.meta['metallicity_in'] = metallicity
-        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
-
         return iso
 
     def format_isochrones(input_iso_dir):
@@ -395,6 +767,19 @@ class Parsec(StellarEvolution):
         # generate isochrone file string
         full_iso_file = self.model_dir + 'iso/' + z_dir + iso_file
         
+        # Read the isochrone (or fetch it from the cache)
+        iso = isochrone_cache.get_isochrone(self, age_idx, z_idx, full_iso_file)
+
+        iso.meta['log_age'] = log_age
+        iso.meta['metallicity_in'] = metallicity
+        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
+
+        return iso
+
+    def _read_isochrone(self, full_iso_file):
+        """
+        Read an isochrone file and put it in the standard format.
+        """
         # return isochrone data
         iso = Table.read(full_iso_file, format='fits')
         iso.rename_column('col1', 'Z')
@@ -410,10 +795,6 @@ class Parsec(StellarEvolution):
         # Parsec doesn't identify WR stars, so identify all as "False"
         isWR = Column([False] * len(iso), name='isWR')
         iso.add_column(isWR)
-        
-        iso.meta['log_age'] = log_age
-        iso.meta['metallicity_in'] = metallicity
-        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
 
         return iso
         
@@ -537,6 +918,19 @@ class Pisa(StellarEvolution):
         # generate isochrone file string
         full_iso_file = self.model_dir + 'iso/' + z_dir + iso_file
         
+        # Read the isochrone (or fetch it from the cache)
+        iso = isochrone_cache.get_isochrone(self, age_idx, z_idx, full_iso_file)
+
+        iso.meta['log_age'] = log_age
+        iso.meta['metallicity_in'] = metallicity
+        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
+
+        return iso
+
+    def _read_isochrone(self, full_iso_file):
+        """
+        Read an isochrone file and put it in the standard format.
+        """
         # return isochrone data
         iso = Table.read(full_iso_file, format='fits')
         iso.rename_column('col1', 'logL')
@@ -553,10 +947,6 @@ class Pisa(StellarEvolution):
         iso.add_column( Column(np.zeros(len(iso)), name = 'phase'))
         iso.add_column( Column(iso['mass'], name = 'mass_current'))
 
-        iso.meta['log_age'] = log_age
-        iso.meta['metallicity_in'] = metallicity
-        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
-
         return iso
 
     def format_isochrones(input_iso_dir, metallicity_list):
@@ -692,6 +1082,19 @@ class Baraffe15(StellarEvolution):
         # generate isochrone file string
         full_iso_file = self.model_dir + 'iso/' + z_dir + iso_file
         
+        # Read the isochrone (or fetch it from the cache)
+        iso = isochrone_cache.get_isochrone(self, age_idx, z_idx, full_iso_file)
+
+        iso.meta['log_age'] = log_age
+        iso.meta['metallicity_in'] = metallicity
+        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
+
+        return iso
+
+    def _read_isochrone(self, full_iso_file):
+        """
+        Read an isochrone file and put it in the standard format.
+        """
         # Read isochrone, get in proper format
         iso = Table.read(full_iso_file, format='fits')
         iso.rename_column('Mass', 'mass')
@@ -707,10 +1110,6 @@ class Baraffe15(StellarEvolution):
         iso.add_column( Column(np.zeros(len(iso)), name = 'phase'))
         iso.add_column( Column(iso['mass'], name = 'mass_current'))
 
-        iso.meta['log_age'] = log_age
-        iso.meta['metallicity_in'] = metallicity
-        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
-
         return iso
 
     def tracks_to_isochrones(self, tracksFile):
@@ -993,11 +1392,27 @@ class MISTv1(StellarEvolution):
                            0.041: 'z041/'}
         
         
-    def isochrone(self, age=1.e8, metallicity=0.0):
+    def isochrone(self, age=1.e8, metallicity=0.0, interpolate=False):
         r"""
         Extract an individual isochrone from the MISTv1
         collection.
+
+        Parameters
+        ----------
+        age: float, optional
+            Age of the isochrone, in years
+
+        metallicity: float, optional
+            Metallicity of the isochrone, in [M/H]
+
+        interpolate: boolean, optional
+            If True, interpolate between the grid isochrones that bracket
+            age and metallicity, matching points by EEP. If False (default), 
+            use the nearest grid isochrone.
         """
+        if interpolate:
+            return self._interpolate_isochrone(age=age, metallicity=metallicity)
+        
         # convert metallicity to mass fraction
         z_defined = self.z_solar * (10.**metallicity)
 
@@ -1016,20 +1431,53 @@ class MISTv1(StellarEvolution):
             age_idx = searchsorted(self.age_list, log_age, side='right')
         else:
             age_idx = searchsorted(self.age_list, log_age, side='left')
-        iso_file = 'iso_{0:.2f}.fits'.format(self.age_list[age_idx])
         
         # find closest metallicity value
         z_idx = searchsorted(self.z_list, z_defined, side='left')
         if z_idx == len(self.z_list):   # in case just over last index
             z_idx = z_idx - 1
-        z_dir = self.z_file_map[self.z_list[z_idx]]
         
         # generate isochrone file string
-        full_iso_file = self.model_dir + 'iso/' + z_dir + iso_file
+        full_iso_file = self._get_iso_file(age_idx, z_idx)
         
-        # return isochrone data. Column locations depend on
-        # version
+        # Read the isochrone (or fetch it from the cache)
+        iso = isochrone_cache.get_isochrone(self, age_idx, z_idx, full_iso_file)
+
+        iso.meta['log_age'] = log_age
+        iso.meta['metallicity_in'] = metallicity
+        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
+
+        return iso
+
+    def _get_iso_file(self, age_idx, z_idx):
+        """
+        Return the isochrone file at age_list[age_idx] and z_list[z_idx].
+        """
+        iso_file = 'iso_{0:.2f}.fits'.format(self.age_list[age_idx])
+        z_dir = self.z_file_map[self.z_list[z_idx]]
+
+        return self.model_dir + 'iso/' + z_dir + iso_file
+
+    def _read_isochrone(self, full_iso_file):
+        """
+        Read an isochrone file and put it in the standard format. 
+        If the metallicity directory has been packed (see pack_isochrones),
+        the isochrone is sliced out of the packed file instead.
+        """
+        iso_dir, iso_file = os.path.split(full_iso_file)
+        packed = get_packed_isochrones(iso_dir, read_func=self._read_isochrone_file)
+        if (packed != None) and (iso_file in packed):
+            return packed.get_isochrone(iso_file)
+
+        return self._read_isochrone_file(full_iso_file)
+    
+    def _read_isochrone_file(self, full_iso_file):
+        """
+        Read an isochrone FITS file and put it in the standard format.
+        """
+        # Column locations depend on version
         iso = Table.read(full_iso_file, format='fits')
+        iso.rename_column('col1', 'EEP')
         if self.version == 1.0:
             iso.rename_column('col7', 'Z')
             iso.rename_column('col2', 'logAge')
@@ -1059,12 +1507,33 @@ class MISTv1(StellarEvolution):
         isWR[idx_WR] = True
         iso.add_column(isWR)
 
-        iso.meta['log_age'] = log_age
-        iso.meta['metallicity_in'] = metallicity
-        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
-
         return iso
         
+    def pack_isochrones(self, metallicity_list=None):
+        """
+        Pack all of the isochrone ages for each metallicity into one 
+        columnar file (see pack_isochrones), so that isochrone() can 
+        slice out an age without reading a FITS file.
+
+        Parameters
+        ----------
+        metallicity_list: list or None, optional
+            List of metallicity directories to pack (i.e. z015 is solar). 
+            If None, pack all metallicities that exist.
+        """
+        if metallicity_list == None:
+            metallicity_list = [self.z_file_map[zz] for zz in self.z_list]
+
+        for metal in metallicity_list:
+            iso_dir = self.model_dir + 'iso/' + metal
+            if not os.path.exists(iso_dir):
+                continue
+
+            print( 'Packing {0}'.format(iso_dir))
+            pack_isochrones(iso_dir, self._read_isochrone_file)
+
+        return
+    
     def format_isochrones(self, input_iso_dir, metallicity_list):
         r"""
         Parse isochrone file downloaded from MIST web server,
@@ -1207,6 +1676,19 @@ class MergedBaraffePisaEkstromParsec(StellarEvolution):
         # generate isochrone file string
         full_iso_file = self.model_dir + z_dir + iso_file
 
+        # Read the isochrone (or fetch it from the cache)
+        iso = isochrone_cache.get_isochrone(self, age_idx, z_idx, full_iso_file)
+
+        iso.meta['log_age'] = log_age
+        iso.meta['metallicity_in'] = metallicity
+        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
+        
+        return iso
+
+    def _read_isochrone(self, full_iso_file):
+        """
+        Read an isochrone file and put it in the standard format.
+        """
         # return isochrone data
         iso = Table.read(full_iso_file, format='fits')
         iso.rename_column('col1', 'mass')
@@ -1223,11 +1705,7 @@ class MergedBaraffePisaEkstromParsec(StellarEvolution):
         idx_WR = np.where(iso['logT'] != iso['logT_WR'])
         isWR[idx_WR] = True
         iso.add_column(isWR)
-        
-        iso.meta['log_age'] = log_age
-        iso.meta['metallicity_in'] = metallicity
-        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
-        
+
         return iso
 
 
@@ -1290,6 +1768,19 @@ class MergedPisaEkstromParsec(StellarEvolution):
         # generate isochrone file string
         full_iso_file = self.model_dir + z_dir + iso_file
 
+        # Read the isochrone (or fetch it from the cache)
+        iso = isochrone_cache.get_isochrone(self, age_idx, z_idx, full_iso_file)
+
+        iso.meta['log_age'] = log_age
+        iso.meta['metallicity_in'] = metallicity
+        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
+        
+        return iso
+
+    def _read_isochrone(self, full_iso_file):
+        """
+        Read an isochrone file and put it in the standard format.
+        """
         # return isochrone data
         iso = Table.read(full_iso_file, format='fits')
         iso.rename_column('col1', 'mass')
@@ -1299,10 +1790,6 @@ class MergedPisaEkstromParsec(StellarEvolution):
         iso.rename_column('col5', 'logT_WR')
         iso.rename_column('col6', 'model_ref')
 
-        iso.meta['log_age'] = log_age
-        iso.meta['metallicity_in'] = metallicity
-        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
-        
         return iso
 
 class MergedSiessGenevaPadova(StellarEvolution):
@@ -1393,6 +1880,19 @@ class MergedSiessGenevaPadova(StellarEvolution):
         # generate isochrone file string
         full_iso_file = self.model_dir + z_dir + iso_file
 
+        # Read the isochrone (or fetch it from the cache)
+        iso = isochrone_cache.get_isochrone(self, age_idx, z_idx, full_iso_file)
+
+        iso.meta['log_age'] = log_age
+        iso.meta['metallicity_in'] = metallicity
+        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
+        
+        return iso
+
+    def _read_isochrone(self, full_iso_file):
+        """
+        Read an isochrone file and put it in the standard format.
+        """
         # return isochrone data
         iso = Table.read(full_iso_file, format='ascii')
         iso.rename_column('col1', 'mass')
@@ -1401,11 +1901,7 @@ class MergedSiessGenevaPadova(StellarEvolution):
         iso.rename_column('col4', 'logg')
         iso.rename_column('col5', 'logT_WR')
         iso.rename_column('col6', 'model_ref')
-        
-        iso.meta['log_age'] = log_age
-        iso.meta['metallicity_in'] = metallicity
-        iso.meta['metallicity_act'] = np.log10(self.z_list[z_idx] / self.z_solar)
-        
+
         return iso
 
 #================================================#
@@ -9,6 +9,15 @@ import pdb
 code_dir = os.path.dirname(__file__)
 filters_dir = code_dir[:-8]+'/filt_func/'
 
+# Directory in filters_dir with the filter files for each
+# facility (the first part of the obs_string)
+facility_dirs = {'nirc2': 'nirc2', '2mass': '2mass', 'vista': 'vista',
+                 'decam': 'decam', 'ps1': 'ps1', 'jwst': 'jwst',
+                 'jg': 'Johnson_Glass', 'nirc1': 'nirc1',
+                 'ctio_osiris': 'CTIO_OSIRIS', 'naco': 'naco', 'ubv': 'ubv',
+                 'ukirt': 'ukirt', 'keck_osiris': 'keck_osiris', 'ztf': 'ztf',
+                 'gaia': 'gaia'}
+
 def get_nirc2_filt(name):
     """
     Define nirc2 filter as a pysynphot spectrum object
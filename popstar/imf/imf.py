@@ -59,7 +59,7 @@ class IMF(object):
         return
             
 
-    def generate_cluster(self, totalMass, seed=None):
+    def generate_cluster(self, totalMass, seed=None, flat_companions=False):
         """
         Generate a cluster of stellar systems with the specified IMF.
         
@@ -84,6 +84,13 @@ class IMF(object):
             specified seed, forcing identical output.
             Default None
 
+        flat_companions: boolean
+            If True, return the companion masses as one flat array plus
+            an array of offsets into it (see Returns), rather than
+            as an object array of per-system arrays. This is much faster
+            and smaller for large clusters.
+            Default False
+
         Returns
         -------
         masses : numpy float array
@@ -93,9 +100,20 @@ class IMF(object):
             List of booleans with True for each primary star that is in a multiple
             system and False for each single star.
 
-        companionMasses : numpy float array
-            List of 
-        
+        companionMasses : numpy array
+            If flat_companions is False, an object array with the array of 
+            companion masses for each primary star. If flat_companions 
+            is True, a flat float array of all the companion masses, 
+            ordered by primary star.
+
+        systemMasses : numpy float array
+            List of system masses (primary plus companions).
+
+        companionOffsets : numpy int array
+            Only returned if flat_companions is True. The companions of 
+            primary star ii are companionMasses[companionOffsets[ii]:companionOffsets[ii+1]],
+            so the array has length len(masses) + 1 and 
+            np.diff(companionOffsets) is the number of companions.
         """
 
         if (self._mass_limits[-1] > totalMass):
@@ -110,11 +128,13 @@ class IMF(object):
         if self._multi_props == None:
             newStarCount *= 1.1
 
-        # Generate output arrays.
-        masses = np.array([], dtype=float)
-        isMultiple = np.array([], dtype=bool)
+        # Generate output arrays. We keep a list of arrays from each
+        # loop and join them at the end.
+        masses = []
+        isMultiple = []
         compMasses = []
-        systemMasses = np.array([], dtype=float)
+        compCounts = []
+        systemMasses = []
 
         # Loop through and add stars to the cluster until we get to
         # the desired total cluster mass.
@@ -139,70 +159,26 @@ class IMF(object):
                 
             # Dealing with multiplicity
             if self._multi_props != None:
-                #compMasses = [[] for newMass in newMasses]
-                compMasses = np.empty((len(newMasses),), dtype=np.object)
-                compMasses.fill([])
-                
                 # Determine the multiplicity of every star
                 MF = self._multi_props.multiplicity_fraction(newMasses)
                 CSF = self._multi_props.companion_star_fraction(newMasses)
                 
                 newIsMultiple = np.random.rand(int(newStarCount)) < MF
 
-                # Copy over the primary masses. Eventually add the companions.
-                newSystemMasses = newMasses.copy()
-
-                #------New code-------#
-                new = True
-                if new:
-                    # Function to calculate multiple systems more efficiently
-                    #t1 = time.time()
-                    compMasses, newSystemMasses, newIsMultiple = self.calc_multi(newMasses, compMasses,
-                                                                                 newSystemMasses, newIsMultiple,
-                                                                                    CSF, MF)
-
-                    newTotalMassTally = newSystemMasses.sum()
-                    isMultiple = np.append(isMultiple, newIsMultiple)
-                    systemMasses = np.append(systemMasses, newSystemMasses)
-                    #t2 = time.time()
-                    #print('Generate multiples: {0}'.format(t2 - t1))
-                #------Previous code------#
-                old = False
-                if old:
-                    # Calculate number and masses of companions
-                    t1 = time.time()
-                    for ii in range(len(newMasses)):
-                        if newIsMultiple[ii]:
-                            # determine number of companions
-                            n_comp = 1 + np.random.poisson((CSF[ii]/MF[ii]) - 1)
-
-                            # Determine the mass ratios of the companions
-                            q_values = self._multi_props.random_q(np.random.rand(n_comp))
-
-                            # Determine the masses of the companions
-                            m_comp = q_values * newMasses[ii]
-
-                            # Add in seperation information
-
-                            # Only keep companions that are more than the minimum mass
-                            compMasses[ii] = m_comp[m_comp >= self._mass_limits[0]]
-                            newSystemMasses[ii] += compMasses[ii].sum()
-
-                            # Double check for the case when we drop all companions.
-                            # This happens a lot near the minimum allowed mass.
-                            if len(compMasses) == 0:
-                                newIsMultiple[ii] == False
-                #-----------------------------------#
-                    newTotalMassTally = newSystemMasses.sum()
-                    isMultiple = np.append(isMultiple, newIsMultiple)
-                    systemMasses = np.append(systemMasses, newSystemMasses)
-                    t2 = time.time()
-                    print( 'All loop: {0}'.format(t2 - t1))
+                # Make the companions for all the multiple systems at once.
+                newCompMasses, newCompCounts, newSystemMasses, newIsMultiple = \
+                    self.calc_multi(newMasses, newIsMultiple, CSF, MF)
+
+                newTotalMassTally = newSystemMasses.sum()
+                isMultiple.append(newIsMultiple)
+                compMasses.append(newCompMasses)
+                compCounts.append(newCompCounts)
+                systemMasses.append(newSystemMasses)
             else:
                 newTotalMassTally = newMasses.sum()
 
             # Append to our primary masses array
-            masses = np.append(masses, newMasses)
+            masses.append(newMasses)
             
             if (loopCnt >= 0):
                 log.info('sample_imf: Loop %d added %.2e Msun to previous total of %.2e Msun' %
@@ -211,9 +187,12 @@ class IMF(object):
             totalMassTally += newTotalMassTally
             newStarCount = mean_number * 0.1  # increase by 20% each pass
             loopCnt += 1
+
+        masses = np.concatenate(masses)
         
         # Make a running sum of the system masses
         if self._multi_props:
+            systemMasses = np.concatenate(systemMasses)
             massCumSum = systemMasses.cumsum()
         else:
             massCumSum = masses.cumsum()
@@ -226,68 +205,261 @@ class IMF(object):
 
         if self._multi_props:
             systemMasses = systemMasses[:idx+1]
-            isMultiple = isMultiple[:idx+1]
-            compMasses = compMasses[:idx+1]
+            isMultiple = np.concatenate(isMultiple)[:idx+1]
+
+            compCounts = np.concatenate(compCounts)[:idx+1]
+            compOffsets = np.zeros(len(masses) + 1, dtype=int)
+            np.cumsum(compCounts, out=compOffsets[1:])
+            compMasses = np.concatenate(compMasses)[:compOffsets[-1]]
         else:
             isMultiple = np.zeros(len(masses), dtype=bool)
             systemMasses = masses
+            compOffsets = np.zeros(len(masses) + 1, dtype=int)
+            compMasses = np.array([], dtype=float)
+
+        if flat_companions:
+            return (masses, isMultiple, compMasses, systemMasses, compOffsets)
+
+        # Split the flat companions into an array for each system.
+        if self._multi_props:
+            compMasses = self.split_companions(compMasses, compOffsets)
+        else:
+            compMasses = []
 
         return (masses, isMultiple, compMasses, systemMasses)
+
+    def generate_cluster_chunks(self, totalMass, chunk_size=10**6, seed=None):
+        """
+        Generate a cluster of stellar systems with the specified IMF,
+        in chunks of at most chunk_size systems. Only one chunk is
+        in memory at a time, so this works for clusters that are too
+        big for generate_cluster.
+
+        The IMF is sampled in the same way as in generate_cluster, and
+        the running total of the system masses is kept across the chunks.
+        The last chunk stops at the star that brings the total closest to
+        the desired total cluster mass (this may leave the last chunk
+        empty, in which case it is not yielded). The random draws are not
+        the same as those of generate_cluster with the same seed.
+
+        Parameters
+        ----------
+        totalMass : float
+            The total mass of the cluster (including companions) in solar masses.
+
+        chunk_size : int
+            The maximum number of star systems in each chunk.
+            Default 10**6
+
+        seed: int
+            If set to non-None, all random sampling will be seeded with the
+            specified seed, forcing identical output.
+            Default None
+
+        Yields
+        ------
+        chunk : tuple
+            (masses, isMultiple, companionMasses, systemMasses, companionOffsets)
+            for the systems in each chunk, as returned by
+            generate_cluster(flat_companions=True). companionOffsets index
+            into the companionMasses of the same chunk.
+        """
+        if (self._mass_limits[-1] > totalMass):
+            log.info('sample_imf: Setting maximum allowed mass to %d' %
+                      (totalMass))
+            self._mass_limits[-1] = totalMass
+
+        self.normalize(totalMass)
+        chunk_size = int(chunk_size)
+
+        # Set the random seed, if desired
+        if seed:
+            np.random.seed(seed=seed)
+
+        totalMassTally = 0
+        loopCnt = 0
+
+        while totalMassTally < totalMass:
+            # Generate a random number array and convert it into
+            # the IMF from the inverted CDF
+            uniX = np.random.rand(chunk_size)
+            newMasses = self.dice_star_cl(uniX)
+
+            # Testing for Nans produced in masses
+            if np.isnan(newMasses).sum() > 0:
+                raise ValueError('Nan detected in cluster mass')
+
+            # Dealing with multiplicity
+            if self._multi_props != None:
+                MF = self._multi_props.multiplicity_fraction(newMasses)
+                CSF = self._multi_props.companion_star_fraction(newMasses)
+
+                newIsMultiple = np.random.rand(chunk_size) < MF
+
+                newCompMasses, newCompCounts, newSystemMasses, newIsMultiple = \
+                    self.calc_multi(newMasses, newIsMultiple, CSF, MF)
+            else:
+                newIsMultiple = np.zeros(chunk_size, dtype=bool)
+                newCompMasses = np.array([], dtype=float)
+                newCompCounts = np.zeros(chunk_size, dtype=int)
+                newSystemMasses = newMasses
+
+            # Running sum of the system masses of the whole cluster, starting
+            # with the total before this chunk (i.e. keeping no systems).
+            massCumSum = np.zeros(chunk_size + 1, dtype=float)
+            np.cumsum(newSystemMasses, out=massCumSum[1:])
+            massCumSum += totalMassTally
+
+            if massCumSum[-1] < totalMass:
+                n_keep = chunk_size
+            else:
+                # Find the number of systems where we are closest to the
+                # desired total mass. Keep at least one star in the cluster.
+                n_keep = np.abs(massCumSum - totalMass).argmin()
+                if loopCnt == 0:
+                    n_keep = max(n_keep, 1)
+
+            log.info('sample_imf: Chunk %d added %.2e Msun to previous total of %.2e Msun' %
+                     (loopCnt, massCumSum[n_keep] - totalMassTally, totalMassTally))
+
+            compOffsets = np.zeros(n_keep + 1, dtype=int)
+            np.cumsum(newCompCounts[:n_keep], out=compOffsets[1:])
+
+            if n_keep > 0:
+                yield (newMasses[:n_keep], newIsMultiple[:n_keep],
+                       newCompMasses[:compOffsets[-1]], newSystemMasses[:n_keep],
+                       compOffsets)
+
+            if n_keep < chunk_size:
+                break
+
+            totalMassTally = massCumSum[-1]
+            loopCnt += 1
+
+        return
+
+    def generate_high_mass_tail(self, totalMass, massLo, seed=None):
+        """
+        Randomly sample only the stars more massive than massLo in a cluster
+        with the specified total mass. The number of stars is drawn from a
+        Poisson distribution around the number expected from the IMF. 
+        Multiplicity is not used.
+
+        Parameters
+        ----------
+        totalMass : float
+            The total mass of the cluster in solar masses.
+
+        massLo : float
+            The minimum mass of the stars to sample, in solar masses.
+
+        seed: int
+            If set to non-None, all random sampling will be seeded with the
+            specified seed, forcing identical output.
+            Default None
+
+        Returns
+        -------
+        masses : numpy float array
+            List of star masses.
+        """
+        if (self._mass_limits[-1] > totalMass):
+            log.info('sample_imf: Setting maximum allowed mass to %d' %
+                      (totalMass))
+            self._mass_limits[-1] = totalMass
+
+        if seed:
+            np.random.seed(seed=seed)
+
+        # Cumulative fraction of stars below massLo
+        self.normalize(totalMass)
+        n_tot = self.lamda[-1]
+        r_lo = float(self.int_xi_cl(self._m_limits_low[0], float(massLo))) / n_tot
+        r_lo = min(max(r_lo, 0.0), 1.0)
+
+        # Draw the stars from the inverted CDF, above massLo only.
+        n_stars = np.random.poisson(n_tot * (1.0 - r_lo))
+        uniX = np.random.uniform(r_lo, 1.0, n_stars)
+        masses = self.dice_star_cl(uniX)
         
-    def calc_multi(self, newMasses, compMasses, newSystemMasses, newIsMultiple, CSF, MF):
+        return masses
+
+    def calc_multi(self, newMasses, newIsMultiple, CSF, MF):
         """
-        Helper function to calculate multiples more efficiently.
-        We will use array operations as much as possible
+        Helper function to calculate the companions of all the multiple
+        systems at once, with array operations only.
+
+        Parameters
+        ----------
+        newMasses : numpy float array
+            Primary star masses.
+
+        newIsMultiple : numpy boolean array
+            True for each primary star that is in a multiple system.
+
+        CSF : numpy float array
+            Companion star fraction for each primary star.
+
+        MF : numpy float array
+            Multiplicity fraction for each primary star.
+
+        Returns
+        -------
+        compMasses : numpy float array
+            Flat array of all the companion masses, ordered by primary star.
+
+        compCounts : numpy int array
+            Number of companions for each primary star.
+
+        newSystemMasses : numpy float array
+            System masses (primary plus companions).
+
+        newIsMultiple : numpy boolean array
+            Updated multiplicity; False for systems that lost all
+            their companions to the minimum mass cut.
         """
         # Identify multiple systems, calculate number of companions for
         # each 
         idx = np.where(newIsMultiple == True)[0]
         n_comp_arr = 1 + np.random.poisson((CSF[idx] / MF[idx]) - 1)
-        primary = newMasses[idx]
 
-        # We will deal with each number of multiple system independently. This is
-        # so we can put in uniform arrays in _multi_props.random_q.
-        num = np.unique(n_comp_arr)
-        for ii in num:
-            tmp = np.where(n_comp_arr == ii)[0]
-            
-            if ii == 1:
-                # Single companion case
-                q_values = self._multi_props.random_q(np.random.rand(len(tmp)))
-                
-                # Calculate mass of companion
-                m_comp = q_values * primary[tmp]
-
-                # Only keep companions that are more than the minimum mass. Update
-                # compMasses, newSystemMasses, and newIsMultiple appropriately 
-                good = np.where(m_comp >= self._mass_limits[0])[0]
-                for jj in good:
-                    compMasses[idx[tmp[jj]]] = np.transpose([m_comp[jj]])
-                    newSystemMasses[idx[tmp[jj]]] += compMasses[idx[tmp[jj]]]
-
-                bad = np.where(m_comp < self._mass_limits[0])[0]
-                newIsMultiple[idx[tmp[bad]]] = False                
-            else:
-                # Multple companion case
-                q_values = self._multi_props.random_q(np.random.rand(len(tmp), ii))
+        # Repeat each primary once per companion, and make all the
+        # companions at once.
+        primary = np.repeat(newMasses[idx], n_comp_arr)
+        sys_idx = np.repeat(idx, n_comp_arr)
+        q_values = self._multi_props.random_q(np.random.rand(len(primary)))
+        m_comp = q_values * primary
 
-                # Calculate masses of companions
-                m_comp = np.multiply(q_values, np.transpose([primary[tmp]]))
+        # Only keep companions that are more than the minimum mass.
+        good = m_comp >= self._mass_limits[0]
+        compMasses = m_comp[good]
+        sys_idx = sys_idx[good]
 
-                # Update compMasses, newSystemMasses, and newIsMultiple appropriately
-                for jj in range(len(tmp)):
-                    m_comp_tmp = m_comp[jj]
-                    compMasses[idx[tmp[jj]]] = m_comp_tmp[m_comp_tmp >= self._mass_limits[0]]
-                    newSystemMasses[idx[tmp[jj]]] += compMasses[idx[tmp[jj]]].sum()
+        # Count the companions and add up their masses for each system.
+        compCounts = np.bincount(sys_idx, minlength=len(newMasses))
+        newSystemMasses = newMasses + np.bincount(sys_idx, weights=compMasses,
+                                                  minlength=len(newMasses))
 
-                    # Double check for the case when we drop all companions.
-                    # This happens a lot near the minimum allowed mass.
-                    if len(compMasses[idx[tmp[jj]]]) == 0:
-                        newIsMultiple[idx[tmp[jj]]] = False
+        # Double check for the case when we drop all companions.
+        # This happens a lot near the minimum allowed mass.
+        newIsMultiple = newIsMultiple & (compCounts > 0)
+
+        return compMasses, compCounts, newSystemMasses, newIsMultiple
+
+    def split_companions(self, compMasses, compOffsets):
+        """
+        Helper function to split the flat companion masses from
+        calc_multi into an object array with the array of companion
+        masses for each system.
+        """
+        compMasses = np.split(compMasses, compOffsets[1:-1])
+
+        compMassesObj = np.empty(len(compMasses), dtype=object)
+        for ii in range(len(compMasses)):
+            compMassesObj[ii] = compMasses[ii]
+
+        return compMassesObj
 
-        return compMasses, newSystemMasses, newIsMultiple
-        
-    
 class IMF_broken_powerlaw(IMF):
     """
     Initialize a multi-part power-law with N parts. Each part of the
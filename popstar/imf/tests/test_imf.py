@@ -31,6 +31,44 @@ def test_prim_power():
 
     return
 
+def test_generate_cluster_multiples():
+    from .. import imf
+    from .. import multiplicity
+
+    mass_limits = np.array([0.1, 0.5, 150.0])
+    powers = np.array([-1.3, -2.3])
+    multi = multiplicity.MultiplicityUnresolved()
+
+    Mcl = 1e5
+    imf_tmp = imf.IMF_broken_powerlaw(mass_limits, powers, multiplicity=multi)
+    out_flat = imf_tmp.generate_cluster(Mcl, seed=1, flat_companions=True)
+    (mass, is_multi, c_mass, s_mass, c_offsets) = out_flat
+
+    # Check the flat companion layout
+    n_comp = np.diff(c_offsets)
+    assert len(c_offsets) == len(mass) + 1
+    assert c_offsets[-1] == len(c_mass)
+    assert (c_mass >= mass_limits[0]).all()
+    np.testing.assert_array_equal(is_multi, n_comp > 0)
+
+    sys_idx = np.repeat(np.arange(len(mass)), n_comp)
+    assert (c_mass <= mass[sys_idx]).all()
+    np.testing.assert_allclose(s_mass, mass + np.bincount(sys_idx, weights=c_mass,
+                                                          minlength=len(mass)))
+    assert np.abs(s_mass.sum() - Mcl) < mass_limits[-1]
+
+    # Same cluster with a companion array for each system.
+    imf_tmp = imf.IMF_broken_powerlaw(mass_limits, powers, multiplicity=multi)
+    (mass2, is_multi2, c_mass2, s_mass2) = imf_tmp.generate_cluster(Mcl, seed=1)
+
+    np.testing.assert_array_equal(mass, mass2)
+    np.testing.assert_array_equal(s_mass, s_mass2)
+    assert len(c_mass2) == len(mass2)
+    for ii in np.where(is_multi)[0][:100]:
+        np.testing.assert_array_equal(c_mass2[ii], c_mass[c_offsets[ii]:c_offsets[ii+1]])
+
+    return
+
 def test_xi():
     from .. import imf
 
@@ -9,13 +9,20 @@ import numpy as np
 from scipy import interpolate
 import pysynphot
 from scipy.linalg import solve_banded
+from collections import OrderedDict
+import threading
 import pdb
 
 
+# Reddening laws that have been made by get_red_law, by name and params
+red_law_registry = {}
+red_law_lock = threading.Lock()
+
 def get_red_law(str):
     """
     Given a reddening law name, return the reddening
-    law object.
+    law object. Each law is only made once; later calls with
+    the same name and params return the same (shared) object.
 
     Parameters:
     ----------
@@ -31,6 +38,17 @@ def get_red_law(str):
         for ii in range(len(tmp) - 1):
             params = params + (float(tmp[ii+1]),)
 
+    with red_law_lock:
+        if (name, params) not in red_law_registry:
+            red_law_registry[(name, params)] = _make_red_law(name, params)
+
+        return red_law_registry[(name, params)]
+
+def _make_red_law(name, params):
+    """
+    Make a new reddening law object from its name and params. 
+    Use get_red_law instead, to reuse existing laws.
+    """
     # Define dictionary connecting redlaw names to the redlaw classes
     name_dict = {'N09':RedLawNishiyama09,
                      'C89': RedLawCardelli,
@@ -64,7 +82,126 @@ def get_red_law(str):
 
     return red_law
 
-class RedLawNishiyama09(pysynphot.reddening.CustomRedLaw):
+class RedLawMixin(object):
+    """
+    Array methods shared by all of the reddening laws, for evaluating 
+    the law on many wavelengths and extinctions at once. The interpolation 
+    onto each wavelength grid is cached, since the same grids (e.g. of 
+    the atmosphere models) are used over and over.
+
+    Mix in before pysynphot.reddening.CustomRedLaw.
+    """
+    # Number of wavelength grids to keep interpolation weights for
+    max_wave_grids = 16
+    _wave_nodes_lock = threading.Lock()
+    
+    def get_law(self, wave):
+        """
+        Return the extinction law, A_lambda / A_Ks, on a wavelength grid.
+        The law is linearly interpolated and is constant beyond its 
+        wavelength limits.
+
+        Parameters
+        ----------
+        wave : array
+            Wavelengths, in angstroms
+        """
+        lo, hi, wgt, law = self._get_wave_nodes(wave)
+
+        return (1.0 - wgt) * law[lo] + wgt * law[hi]
+
+    def transmission(self, AKs, wave):
+        """
+        Return the fraction of the flux transmitted, 10**(-0.4 * A_lambda),
+        for one or more extinctions on a wavelength grid. This is the same 
+        as reddening(AKs).resample(wave).throughput for each extinction.
+
+        Parameters
+        ----------
+        AKs : float or array
+            Total extinction in AKs, in mags
+        wave : array
+            Wavelengths, in angstroms
+
+        Returns
+        -------
+        trans : array
+            Transmission of shape (N_wave), or (N_AKs x N_wave) if 
+            AKs is an array.
+        """
+        lo, hi, wgt, law = self._get_wave_nodes(wave)
+        AKs = np.asarray(AKs, dtype=float)[..., np.newaxis]
+
+        # Interpolate the transmission (rather than A_lambda), as 
+        # pysynphot does.
+        trans = ((1.0 - wgt) * 10**(-0.4 * AKs * law[lo]) +
+                 wgt * 10**(-0.4 * AKs * law[hi]))
+
+        return trans
+
+    def get_law_nearest(self, wavelength):
+        """
+        Return the extinction law, A_lambda / A_Ks, at the law point 
+        closest to each wavelength. If two points are equally close, 
+        the shorter wavelength is used.
+
+        Parameters
+        ----------
+        wavelength : float or array
+            Wavelengths, in microns
+        """
+        self._setup_law_arrays()
+        wavelength = np.atleast_1d(np.asarray(wavelength, dtype=float))
+
+        # Compare in microns, the same way as the <law>() methods always have.
+        law_wave = self._law_wave * (10**-4)
+        hi = np.clip(np.searchsorted(law_wave, wavelength), 1, len(law_wave) - 1)
+        lo = hi - 1
+        use_hi = np.abs(law_wave[hi] - wavelength) < np.abs(law_wave[lo] - wavelength)
+
+        return self._law[np.where(use_hi, hi, lo)]
+
+    def _setup_law_arrays(self):
+        """
+        Sort the law by wavelength, for the array methods.
+        """
+        if '_wave_nodes' not in self.__dict__:
+            sdx = np.argsort(self.wave)
+            self._law_wave = np.asarray(self.wave, dtype=float)[sdx]
+            self._law = np.asarray(self.obscuration, dtype=float)[sdx]
+            self._wave_nodes = OrderedDict()
+
+        return
+        
+    def _get_wave_nodes(self, wave):
+        """
+        Get the law points on either side of each wavelength and the
+        interpolation weight of the upper one.
+        """
+        wave = np.asarray(wave, dtype=float)
+        self._setup_law_arrays()
+
+        # The laws from get_red_law are shared between threads.
+        key = (wave.shape, hash(wave.tobytes()))
+        with self._wave_nodes_lock:
+            if key in self._wave_nodes:
+                self._wave_nodes.move_to_end(key)
+                return self._wave_nodes[key]
+
+        law_wave = self._law_wave
+        hi = np.clip(np.searchsorted(law_wave, wave), 1, len(law_wave) - 1)
+        lo = hi - 1
+        wgt = np.clip((wave - law_wave[lo]) / (law_wave[hi] - law_wave[lo]), 0, 1)
+        nodes = (lo, hi, wgt, self._law)
+
+        with self._wave_nodes_lock:
+            self._wave_nodes[key] = nodes
+            if len(self._wave_nodes) > self.max_wave_grids:
+                self._wave_nodes.popitem(last=False)
+
+        return nodes
+
+class RedLawNishiyama09(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines extinction law from `Nishiyama et al. 2009 
     <https://ui.adsabs.harvard.edu/abs/2009ApJ...696.1407N/abstract>`_
@@ -167,26 +304,19 @@ class RedLawNishiyama09(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
 
         return A_at_wave
         
-class RedLawCardelli(pysynphot.reddening.CustomRedLaw):
+class RedLawCardelli(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines the extinction law from  
     `Cardelli et al. 1989 <https://ui.adsabs.harvard.edu/abs/1989ApJ...345..245C/abstract>`_. 
@@ -312,26 +442,19 @@ class RedLawCardelli(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
 
         return A_at_wave
     
-class RedLawRomanZuniga07(pysynphot.reddening.CustomRedLaw):
+class RedLawRomanZuniga07(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines extinction law from `Roman-Zuniga et al. 2007
     <https://ui.adsabs.harvard.edu/abs/2007ApJ...664..357R/abstract>`_
@@ -393,26 +516,19 @@ class RedLawRomanZuniga07(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
 
         return A_at_wave
     
-class RedLawRiekeLebofsky(pysynphot.reddening.CustomRedLaw):
+class RedLawRiekeLebofsky(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines the extinction law from `Rieke & Lebofsky 1985
     <https://ui.adsabs.harvard.edu/abs/1985ApJ...288..618R/abstract>`_
@@ -496,26 +612,19 @@ class RedLawRiekeLebofsky(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
 
         return A_at_wave
 
-class RedLawDamineli16(pysynphot.reddening.CustomRedLaw):
+class RedLawDamineli16(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines the extinction law of `Damineli et al. 2016
     <https://ui.adsabs.harvard.edu/abs/2016MNRAS.463.2653D/abstract>`_,
@@ -587,26 +696,19 @@ class RedLawDamineli16(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
 
         return A_at_wave
 
-class RedLawDeMarchi16(pysynphot.reddening.CustomRedLaw):
+class RedLawDeMarchi16(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines extinction law from `De Marchi et al. 2016
     <https://ui.adsabs.harvard.edu/abs/2016MNRAS.455.4373D/abstract>`_
@@ -694,26 +796,19 @@ class RedLawDeMarchi16(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AK (since law assumes AK = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AK
 
         return A_at_wave
     
-class RedLawFitzpatrick09(pysynphot.reddening.CustomRedLaw):
+class RedLawFitzpatrick09(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines the extinction law from 
     `Fitzpatrick et al. 2009 <https://ui.adsabs.harvard.edu/abs/2009ApJ...699.1209F/abstract>`_.
@@ -811,26 +906,19 @@ class RedLawFitzpatrick09(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
 
         return A_at_wave
 
-class RedLawSchlafly16(pysynphot.reddening.CustomRedLaw):
+class RedLawSchlafly16(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines the extinction law from `Schlafly et al. 2016 
     <https://ui.adsabs.harvard.edu/abs/2016ApJ...821...78S/abstract>`_.
@@ -958,26 +1046,19 @@ class RedLawSchlafly16(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
 
         return A_at_wave
         
-class RedLawPowerLaw(pysynphot.reddening.CustomRedLaw):
+class RedLawPowerLaw(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Extinction object that is a power-law extinction law: 
     :math:`A_{\lambda} \propto \lambda^{\alpha}`.
@@ -1071,26 +1152,19 @@ class RedLawPowerLaw(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
 
         return A_at_wave
 
-class RedLawFritz11(pysynphot.reddening.CustomRedLaw):
+class RedLawFritz11(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines extinction law from `Fritz et al. 2011 
     <https://ui.adsabs.harvard.edu/abs/2011ApJ...737...73F/abstract>`_
@@ -1168,26 +1242,19 @@ class RedLawFritz11(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
 
         return A_at_wave
         
-class RedLawHosek18(pysynphot.reddening.CustomRedLaw):
+class RedLawHosek18(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines extinction law from `Hosek et al. 2018 
     <https://ui.adsabs.harvard.edu/abs/2018ApJ...855...13H/abstract>`_
@@ -1267,26 +1334,19 @@ class RedLawHosek18(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
 
         return A_at_wave
 
-class RedLawHosek18b(pysynphot.reddening.CustomRedLaw):
+class RedLawHosek18b(RedLawMixin, pysynphot.reddening.CustomRedLaw):
     """
     Defines extinction law from `Hosek et al. 2019 
     <https://ui.adsabs.harvard.edu/abs/2019ApJ...870...44H/abstract>`_
@@ -1362,19 +1422,12 @@ class RedLawHosek18b(pysynphot.reddening.CustomRedLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))
             
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
@@ -1417,19 +1470,12 @@ class RedLawNoguerasLara18(RedLawPowerLaw):
 
         # Return error if any wavelength is beyond interpolation range of
         # extinction law
-        if ((min(wavelength) < (self.low_lim*10**-4)) | (max(wavelength) > (self.high_lim*10**-4))):
+        if ((np.min(wavelength) < (self.low_lim*10**-4)) | (np.max(wavelength) > (self.high_lim*10**-4))):
             return ValueError('{0}: wavelength values beyond interpolation range'.format(self))    
 
-        # Extract wave and A/AKs from law, turning wave into micron units
-        wave = self.wave * (10**-4)
-        law = self.obscuration
-
         # Find the value of the law at the closest points
         # to wavelength
-        A_AKs_at_wave = []
-        for ii in wavelength:
-            idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
-            A_AKs_at_wave.append(law[idx][0])
+        A_AKs_at_wave = self.get_law_nearest(wavelength)
 
         # Now multiply by AKs (since law assumes AKs = 1)
         A_at_wave = np.array(A_AKs_at_wave) * AKs
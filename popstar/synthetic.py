@@ -10,16 +10,22 @@ from scipy.special import erf
 from pysynphot import spectrum
 from pysynphot import ObsBandpass
 from pysynphot import observation as obs
+from pysynphot import binning
 import pysynphot
 from astropy import constants, units
 from astropy.table import Table, Column, MaskedColumn
+from astropy.io import fits
 from popstar.imf import imf, multiplicity
 from popstar.utils import objects
+from popstar.utils.files import atomic_write
 import pickle
 import time, datetime
 import math
 import os, glob
 import tempfile
+import json
+import hashlib
+import multiprocessing
 import scipy
 import matplotlib
 import matplotlib.pyplot as plt
@@ -140,8 +146,9 @@ class ResolvedCluster(Cluster):
         ##### 
         # Sample the IMF to build up our cluster mass.
         #####
-        mass, isMulti, compMass, sysMass = imf.generate_cluster(cluster_mass,
-                                                                    seed=seed)
+        mass, isMulti, compMass, sysMass, compOffsets = imf.generate_cluster(cluster_mass,
+                                                                                 seed=seed,
+                                                                                 flat_companions=True)
 
         # Figure out the filters we will make.
         self.filt_names = self.set_filter_names()
@@ -150,12 +157,44 @@ class ResolvedCluster(Cluster):
         #####
         # Make isochrone interpolators
         #####
+        self._make_iso_interps()
+
+        #####
+        # Make the tables of star systems and companions.
+        #####
+        star_systems, companions = self._make_cluster_tables(mass, isMulti, compMass,
+                                                             sysMass, compOffsets)
+
+        #####
+        # Save our arrays to the object
+        #####
+        self.star_systems = star_systems
+        
+        if self.imf.make_multiples:
+            self.companions = companions
+
+        return
+
+    def _make_iso_interps(self):
+        """
+        Make the interpolators of the isochrone properties and
+        photometry in mass.
+        """
         interp_keys = ['Teff', 'L', 'logg', 'isWR', 'mass_current', 'phase'] + self.filt_names
         self.iso_interps = {}
         for ikey in interp_keys:
             self.iso_interps[ikey] = interpolate.interp1d(self.iso.points['mass'], self.iso.points[ikey],
                                                           kind='linear', bounds_error=False, fill_value=np.nan)
-        
+
+        return
+
+    def _make_cluster_tables(self, mass, isMulti, compMass, sysMass, compOffsets):
+        """
+        Make the star_systems and companions tables for the sampled
+        systems, in the flat companion layout of 
+        IMF.generate_cluster(flat_companions=True). The companions 
+        table is None if the IMF has no multiplicity.
+        """
         ##### 
         # Make a table to contain all the information about each stellar system.
         #####
@@ -163,23 +202,18 @@ class ResolvedCluster(Cluster):
         
         # Trim out bad systems; specifically, stars with masses outside those provided
         # by the model isochrone (except for compact objects).
-        star_systems, compMass = self._remove_bad_systems(star_systems, compMass)
+        star_systems, compMass, compOffsets = self._remove_bad_systems(star_systems, compMass,
+                                                                       compOffsets)
 
         ##### 
         # Make a table to contain all the information about companions.
         #####
+        companions = None
         if self.imf.make_multiples:
-            companions = self._make_companions_table(star_systems, compMass)
-            
-        #####
-        # Save our arrays to the object
-        #####
-        self.star_systems = star_systems
-        
-        if self.imf.make_multiples:
-            self.companions = companions
+            companions = self._make_companions_table(star_systems, compMass,
+                                                     compOffsets=compOffsets)
 
-        return
+        return star_systems, companions
 
     def set_filter_names(self):
         """
@@ -271,8 +305,17 @@ class ResolvedCluster(Cluster):
 
         return star_systems
         
-    def _make_companions_table(self, star_systems, compMass):
-
+    def _make_companions_table(self, star_systems, compMass, compOffsets=None):
+        """
+        Make a companions table and get synthetic photometry for each companion
+        star. The companion fluxes are added to the system photometry in the 
+        star_systems table.
+
+        compMass is either a flat array of the companion masses ordered by
+        system, with compOffsets marking where each system's companions start
+        (as returned by IMF.generate_cluster(flat_companions=True)), or a list 
+        with an array of companion masses for each system if compOffsets is None.
+        """
         N_systems = len(star_systems)
         
         #####
@@ -281,94 +324,44 @@ class ResolvedCluster(Cluster):
         # This table will be much longer... here are the arrays:
         #    sysIndex - the index of the system this star belongs too
         #    mass - the mass of this individual star.
-        N_companions = np.array([len(star_masses) for star_masses in compMass])
+        if compOffsets is None:
+            N_companions = np.array([len(star_masses) for star_masses in compMass], dtype=int)
+            compMass = np.concatenate([np.zeros(0, dtype=float)] + list(compMass))
+        else:
+            N_companions = np.diff(compOffsets)
         star_systems.add_column( Column(N_companions, name='N_companions') )
 
         N_comp_tot = N_companions.sum()
         system_index = np.repeat(np.arange(N_systems), N_companions)
 
-        companions = Table([system_index], names=['system_idx'])
-
-        # Add columns for the Teff, L, logg, isWR mass_current, phase, and filters for the companion stars.
-        companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='mass') )
-        companions.add_column( Column(np.zeros(N_comp_tot, dtype=float), name='Teff') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='L') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='logg') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='isWR') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='mass_current') )
-        companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name='phase') )
-        for filt in self.filt_names:
-            companions.add_column( Column(np.empty(N_comp_tot, dtype=float), name=filt) )
-
-        # Make an array that maps system index (ii), companion index (cc) to
-        # the place in the 1D companions array.
-        N_comp_max = N_companions.max()
-        
-        comp_index = np.zeros((N_systems, N_comp_max), dtype=int)
-        kk = 0
-        for ii in range(N_systems):
-            for cc in range(N_companions[ii]):
-                comp_index[ii][cc] = kk
-                kk += 1
-
-        # Find all the systems with at least one companion... add the flux
-        # of that companion to the primary. Repeat for 2 companions,
-        # 3 companions, etc.
-        for cc in range(1, N_comp_max+1):
-            # All systems with at least cc companions.
-            idx = np.where(N_companions >= cc)[0]
-
-            # Get the location in the companions array for each system and
-            # the cc'th companion. 
-            cdx = comp_index[idx, cc-1]
-            
-            companions['mass'][cdx] = [compMass[ii][cc-1] for ii in idx]
-            comp_mass = companions['mass'][cdx]
-
-            if len(idx) > 0:
-                companions['Teff'][cdx] = self.iso_interps['Teff'](comp_mass)
-                companions['L'][cdx] = self.iso_interps['L'](comp_mass)
-                companions['logg'][cdx] = self.iso_interps['logg'](comp_mass)
-                companions['isWR'][cdx] = np.round(self.iso_interps['isWR'](comp_mass))
-                companions['mass_current'] = self.iso_interps['mass_current'](companions['mass'])
-                companions['phase'] = np.round(self.iso_interps['phase'](companions['mass']))
-
-                # For a very small fraction of stars, the star phase falls on integers in-between
-                # the ones we have definition for, as a result of the interpolation. For these
-                # stars, round phase down to nearest defined phase (e.g., if phase is 71,
-                # then round it down to 5, rather than up to 101).
-                # Convert nan_to_num to avoid errors on greater than, less than comparisons
-                star_systems_phase_non_nan = np.nan_to_num(star_systems['phase'], nan=-99)
-                bad = np.where( (star_systems_phase_non_nan > 5) & (star_systems_phase_non_nan < 101) & (star_systems_phase_non_nan != 9) & (star_systems_phase_non_nan != -99))
-                # Print warning, if desired
-                verbose=False
-                if verbose:
-                    for ii in range(len(bad[0])):
-                        print('WARNING: changing phase {0} to 5'.format(companions['phase'][bad[0][ii]]))
-                companions['phase'][bad] = 5
-
-                for filt in self.filt_names:
-                    # Magnitude of companion
-                    companions[filt][cdx] = self.iso_interps[filt](comp_mass)
-
-                    mag_s = star_systems[filt][idx]
-                    mag_c = companions[filt][cdx]
+        companions = Table([system_index, compMass], names=['system_idx', 'mass'])
+        comp_mass = companions['mass']
 
-                    # Add companion flux to system flux.
-                    f1 = 10**(-mag_s / 2.5)
-                    f2 = 10**(-mag_c / 2.5)
+        # Use our pre-built interpolators to fetch values from the isochrone for all
+        # the companions at once.
+        companions.add_column( Column(self.iso_interps['Teff'](comp_mass), name='Teff') )
+        companions.add_column( Column(self.iso_interps['L'](comp_mass), name='L') )
+        companions.add_column( Column(self.iso_interps['logg'](comp_mass), name='logg') )
+        companions.add_column( Column(np.round(self.iso_interps['isWR'](comp_mass)), name='isWR') )
+        companions.add_column( Column(self.iso_interps['mass_current'](comp_mass), name='mass_current') )
+        companions.add_column( Column(np.round(self.iso_interps['phase'](comp_mass)), name='phase') )
 
-                    # For dark objects, turn the np.nan fluxes into zeros.
-                    f1 = np.nan_to_num(f1)
-                    f2 = np.nan_to_num(f2)
+        # For a very small fraction of stars, the star phase falls on integers in-between
+        # the ones we have definition for, as a result of the interpolation. For these
+        # stars, round phase down to nearest defined phase (e.g., if phase is 71,
+        # then round it down to 5, rather than up to 101).
+        # Convert nan_to_num to avoid errors on greater than, less than comparisons
+        companions_phase_non_nan = np.nan_to_num(companions['phase'], nan=-99)
+        bad = np.where( (companions_phase_non_nan > 5) & (companions_phase_non_nan < 101) & (companions_phase_non_nan != 9) & (companions_phase_non_nan != -99))
+        # Print warning, if desired
+        verbose=False
+        if verbose:
+            for ii in range(len(bad[0])):
+                print('WARNING: changing phase {0} to 5'.format(companions['phase'][bad[0][ii]]))
+        companions['phase'][bad] = 5
 
-                    # If *both* objects are dark, then keep the magnitude
-                    # as np.nan. Otherwise, add fluxes together
-                    good = np.where( (f1 != 0) | (f2 != 0) )
-                    bad = np.where( (f1 == 0) & (f2 == 0) )
-                    
-                    star_systems[filt][idx[good]] = -2.5 * np.log10(f1[good] + f2[good])
-                    star_systems[filt][idx[bad]] = np.nan
+        for filt in self.filt_names:
+            companions.add_column( Column(self.iso_interps[filt](comp_mass), name=filt) )
 
         #####
         # Make Remnants with flux = 0 in all bands.
@@ -376,7 +369,7 @@ class ResolvedCluster(Cluster):
         if self.ifmr != None:
             # Identify compact objects as those with Teff = 0 or with masses above the max iso mass
             highest_mass_iso = self.iso.points['mass'].max()
-            cdx_rem = np.where((companions['Teff'] == 0) &
+            cdx_rem = np.where((np.isnan(companions['Teff'])) &
                                 (companions['mass'] > highest_mass_iso))[0]
             
             # Calculate remnant mass and ID for compact objects; update remnant_id and
@@ -395,6 +388,33 @@ class ResolvedCluster(Cluster):
             for filt in self.filt_names:
                 companions[filt][cdx_rem_good] = np.full(len(cdx_rem_good), np.nan)
 
+        #####
+        # Add the companion fluxes to the system fluxes.
+        #####
+        idx = np.where(N_companions > 0)[0]
+        
+        if (len(idx) > 0) & (len(self.filt_names) > 0):
+            # Location of the first companion of each system in the companions table.
+            comp_start = np.cumsum(N_companions) - N_companions
+
+            # Fluxes in all filters, as (N x N_filters) arrays. For dark objects,
+            # turn the np.nan fluxes into zeros.
+            mag_s = np.array([star_systems[filt][idx] for filt in self.filt_names]).T
+            mag_c = np.array([companions[filt] for filt in self.filt_names]).T
+            f_s = np.nan_to_num(10**(-mag_s / 2.5))
+            f_c = np.nan_to_num(10**(-mag_c / 2.5))
+
+            # Sum up the companion fluxes in each system.
+            f_sys = f_s + np.add.reduceat(f_c, comp_start[idx], axis=0)
+
+            # If *all* objects in the system are dark, then keep the
+            # magnitude as np.nan.
+            with np.errstate(divide='ignore'):
+                mag_sys = -2.5 * np.log10(f_sys)
+            mag_sys[f_sys == 0] = np.nan
+
+            for ff in range(len(self.filt_names)):
+                star_systems[self.filt_names[ff]][idx] = mag_sys[:, ff]
 
         # Notify if we have a lot of bad ones.
         # Convert nan_to_num to avoid errors on greater than, less than comparisons
@@ -409,7 +429,7 @@ class ResolvedCluster(Cluster):
         return companions
 
     
-    def _remove_bad_systems(self, star_systems, compMass):
+    def _remove_bad_systems(self, star_systems, compMass, compOffsets):
         """
         Helper function to remove stars with masses outside the isochrone
         mass range from the cluster. These stars are identified by having 
@@ -417,6 +437,9 @@ class ResolvedCluster(Cluster):
         If self.ifmr == None, then both high and low-mass bad systems are 
         removed. If self.ifmr != None, then we will save the high mass systems 
         since they will be pluggedd into an ifmr later.
+
+        The companions are in the flat layout from 
+        IMF.generate_cluster(flat_companions=True).
         """
         N_systems = len(star_systems)
 
@@ -439,10 +462,221 @@ class ResolvedCluster(Cluster):
 
         if self.imf.make_multiples:
             # Clean up companion stuff (which we haven't handled yet)
-            compMass = [compMass[ii] for ii in idx]
+            N_companions = np.diff(compOffsets)
+            keep = np.zeros(len(N_companions), dtype=bool)
+            keep[idx] = True
+            
+            compMass = compMass[np.repeat(keep, N_companions)]
+            compOffsets = np.append(0, np.cumsum(N_companions[idx]))
         
-        return star_systems, compMass
+        return star_systems, compMass, compOffsets
+
+
+class ResolvedClusterChunks(ResolvedCluster):
+    """
+    Cluster sub-class that produces a *resolved* stellar cluster in
+    chunks of star systems, for clusters too big to hold in memory.
+    Nothing is sampled when the object is made; iterating over it
+    yields a (star_systems, companions) pair of tables for each chunk,
+    with the same columns as in ResolvedCluster, and write() saves
+    the chunks to disk one at a time.
+
+    The system_idx column of the companions tables is the index of
+    the system in the whole cluster (i.e. counting the systems in the
+    earlier chunks). companions is None if there is no multiplicity.
+
+    Parameters
+    -----------
+    iso: isochrone object
+        PyPopStar isochrone object
+
+    imf: imf object
+        PyPopStar IMF object
+
+    cluster_mass: float
+        Total initial mass of the cluster, in M_sun
+
+    chunk_size: int
+        Number of star systems sampled from the IMF for each chunk.
+        The chunks can be smaller after the systems outside the
+        isochrone mass range are removed. Default is 10**6.
+
+    ifmr: ifmr object or None
+        If ifmr object is defined, will create compact remnants
+        produced by the cluster at the given isochrone age. Otherwise,
+        no compact remnants are produced.
+
+    seed: int
+        If set to non-None, all random sampling will be seeded with the
+        specified seed, forcing identical output.
+        Default None
+
+    vebose: boolean
+        True for verbose output.
+    """
+    def __init__(self, iso, imf, cluster_mass, chunk_size=10**6, ifmr=None,
+                     verbose=False, seed=None):
+        Cluster.__init__(self, iso, imf, cluster_mass, ifmr=ifmr, verbose=verbose,
+                             seed=seed)
+        self.chunk_size = chunk_size
+
+        self.filt_names = self.set_filter_names()
+        self._make_iso_interps()
+
+        return
+
+    def __iter__(self):
+        N_systems = 0
+
+        chunks = self.imf.generate_cluster_chunks(self.cluster_mass, chunk_size=self.chunk_size,
+                                                  seed=self.seed)
+
+        for mass, isMulti, compMass, sysMass, compOffsets in chunks:
+            star_systems, companions = self._make_cluster_tables(mass, isMulti, compMass,
+                                                                 sysMass, compOffsets)
+
+            if companions is not None:
+                companions['system_idx'] += N_systems
+
+            N_systems += len(star_systems)
+
+            yield star_systems, companions
+
+    def write(self, out_file, format='fits'):
+        """
+        Make the cluster and write it to out_file, one chunk at a time.
+        The output is written to a temporary file (or directory) and
+        then renamed, so a partially written cluster is never left at
+        out_file. Use read_cluster_chunks to read it back.
+
+        Parameters
+        ----------
+        out_file : str
+            Output file name (or directory name, for parquet).
+
+        format : str
+            'fits' - one file, with a SYSTEMS and a COMPANIONS table HDU
+            for each chunk (EXTVER is the chunk number, starting at 1).
+            'hdf5' - one file, with the tables of each chunk at the
+            star_systems/chunk_<ii> and companions/chunk_<ii> paths (needs h5py).
+            'parquet' - a directory, with star_systems_<ii>.parquet and
+            companions_<ii>.parquet files for each chunk (needs pyarrow).
+
+        Returns
+        -------
+        N_chunks : int
+            The number of chunks written.
+        """
+        if format not in ['fits', 'hdf5', 'parquet']:
+            raise ValueError('ResolvedClusterChunks: format {0} undefined'.format(format))
+
+        with atomic_write(out_file, suffix='.' + format,
+                          directory=(format == 'parquet')) as tmp_file:
+            if format == 'fits':
+                hdr = fits.Header()
+                hdr['CLMASS'] = (self.cluster_mass, 'Cluster mass (Msun)')
+                hdr['CHUNKSZ'] = (self.chunk_size, 'Systems sampled per chunk')
+                fits.PrimaryHDU(header=hdr).writeto(tmp_file, overwrite=True)
+
+            N_chunks = 0
+            N_systems = 0
+            N_companions = 0
+
+            for star_systems, companions in self:
+                N_chunks += 1
+                N_systems += len(star_systems)
+
+                tables = [('star_systems', 'SYSTEMS', star_systems)]
+                if companions is not None:
+                    N_companions += len(companions)
+                    tables.append(('companions', 'COMPANIONS', companions))
+
+                for name, ext_name, table in tables:
+                    if format == 'fits':
+                        hdu = fits.table_to_hdu(table)
+                        hdu.header['EXTNAME'] = ext_name
+                        hdu.header['EXTVER'] = N_chunks
+                        fits.append(tmp_file, hdu.data, hdu.header)
+                    elif format == 'hdf5':
+                        table.write(tmp_file, path='{0}/chunk_{1:05d}'.format(name, N_chunks),
+                                    format='hdf5', append=True)
+                    else:
+                        part_file = '{0}/{1}_{2:05d}.parquet'.format(tmp_file, name, N_chunks)
+                        table.write(part_file, format='parquet')
+
+                if self.verbose:
+                    print( 'Wrote chunk {0:d} with {1:d} systems'.format(N_chunks, len(star_systems)))
+
+            if format == 'fits':
+                with fits.open(tmp_file, mode='update') as hdul:
+                    hdul[0].header['NCHUNKS'] = (N_chunks, 'Number of chunks')
+                    hdul[0].header['NSYSTEMS'] = (N_systems, 'Number of star systems')
+                    hdul[0].header['NCOMP'] = (N_companions, 'Number of companions')
+
+        return N_chunks
+
+def read_cluster_chunks(out_file, format='fits'):
+    """
+    Read a cluster written by ResolvedClusterChunks.write,
+    one chunk at a time.
+
+    Parameters
+    ----------
+    out_file : str
+        The file (or directory, for parquet) the cluster was written to.
+
+    format : str
+        'fits', 'hdf5' or 'parquet', as used to write the cluster.
+
+    Yields
+    ------
+    (star_systems, companions) tables for each chunk. companions is
+    None if the cluster has no multiplicity.
+    """
+    if format == 'fits':
+        with fits.open(out_file) as hdul:
+            ext_vers = [hdu.header['EXTVER'] for hdu in hdul[1:] if hdu.name == 'SYSTEMS']
+            ext_comp = [hdu.header['EXTVER'] for hdu in hdul[1:] if hdu.name == 'COMPANIONS']
+
+            for ii in ext_vers:
+                star_systems = Table.read(hdul['SYSTEMS', ii])
+                companions = None
+                if ii in ext_comp:
+                    companions = Table.read(hdul['COMPANIONS', ii])
+
+                yield star_systems, companions
+
+    elif format == 'hdf5':
+        import h5py
+
+        with h5py.File(out_file, 'r') as f:
+            chunk_names = sorted(f['star_systems'].keys())
+            has_comp = 'companions' in f
+
+        for chunk_name in chunk_names:
+            star_systems = Table.read(out_file, path='star_systems/' + chunk_name, format='hdf5')
+            companions = None
+            if has_comp:
+                companions = Table.read(out_file, path='companions/' + chunk_name, format='hdf5')
+
+            yield star_systems, companions
+
+    elif format == 'parquet':
+        sys_files = sorted(glob.glob('{0}/star_systems_*.parquet'.format(out_file)))
+
+        for sys_file in sys_files:
+            star_systems = Table.read(sys_file, format='parquet')
+            comp_file = sys_file.replace('star_systems_', 'companions_')
+            companions = None
+            if os.path.exists(comp_file):
+                companions = Table.read(comp_file, format='parquet')
+
+            yield star_systems, companions
+
+    else:
+        raise ValueError('read_cluster_chunks: format {0} undefined'.format(format))
 
+    return
 
 class ResolvedClusterDiffRedden(ResolvedCluster):
     """
@@ -479,9 +713,41 @@ class ResolvedClusterDiffRedden(ResolvedCluster):
 
     vebose: boolean
         True for verbose output.
+
+    red_mode: string
+        How to get the change in magnitude from the differential extinction:
+        'vega' - scale the change in each filter for Vega at AKs + deltaAKs
+        by each star's extinction offset (default).
+        'table' - make the photometry of every isochrone point at n_AKs 
+        extinctions that span the stars' extinctions, and interpolate it 
+        for each star. This follows the exact (nonlinear and Teff-dependent) 
+        response of each filter. The isochrone must have spectra (e.g. 
+        IsochronePhot with save_spectra=True).
+
+    n_AKs: int
+        Number of extinctions in the 'table' mode. Default is 50.
+
+    power_spectrum: float, function or None
+        If None (default), the extinction of each system is drawn 
+        independently. Otherwise, the systems are given random positions
+        (x and y columns, from 0 to 1) in a field with a spatially 
+        correlated extinction map, with this power spectrum (see 
+        make_gaussian_random_field). The map is saved as red_field, in 
+        units of deltaAKs. It is scaled so that the values interpolated 
+        at random positions have unit variance (see sample_field_variance), 
+        so deltaAKs is still the standard deviation of the system 
+        extinctions.
+
+    field_grid: int
+        Number of pixels on a side of the extinction map. Default is 256.
     """
     def __init__(self, iso, imf, cluster_mass, deltaAKs,
-                 ifmr=None, verbose=False, seed=None):
+                 ifmr=None, verbose=False, seed=None, red_mode='vega', n_AKs=50,
+                 power_spectrum=None, field_grid=256):
+        if red_mode not in ['vega', 'table']:
+            raise ValueError('ResolvedClusterDiffRedden: red_mode {0} undefined'.format(red_mode))
+        if (red_mode == 'table') and (not hasattr(iso, 'spec_list')):
+            raise ValueError('ResolvedClusterDiffRedden: red_mode table needs the isochrone spectra')
 
         ResolvedCluster.__init__(self, iso, imf, cluster_mass, ifmr=ifmr, verbose=verbose,
                                      seed=seed)
@@ -493,47 +759,257 @@ class ResolvedClusterDiffRedden(ResolvedCluster):
         # Extract the extinction law from the isochrone object
         redlaw_str = iso.points.meta['REDLAW']
         red_law = reddening.get_red_law(redlaw_str)
-            
-        # For a given delta_AKs (Gaussian sigma of reddening distribution at Ks),
-        # figure out the equivalent delta_filt values for all other filters.
-        #t1 = time.time()
-        delta_red_filt = {}
         AKs = iso.points.meta['AKS']
-        red_vega_lo = vega * red_law.reddening(AKs).resample(vega.wave)
-        red_vega_hi = vega * red_law.reddening(AKs + deltaAKs).resample(vega.wave)
 
-        for filt in self.filt_names:
-            obs_str = get_obs_str(filt)
-            filt_info = get_filter_info(obs_str)
-            
-            mag_lo = mag_in_filter(red_vega_lo, filt_info)
-            mag_hi = mag_in_filter(red_vega_hi, filt_info)
-            delta_red_filt[filt] = mag_hi - mag_lo
+        if red_mode == 'vega':
+            # For a given delta_AKs (Gaussian sigma of reddening distribution at Ks),
+            # figure out the equivalent delta_filt values for all other filters.
+            #t1 = time.time()
+            delta_red_filt = {}
+            red_vega_lo = vega * red_law.reddening(AKs).resample(vega.wave)
+            red_vega_hi = vega * red_law.reddening(AKs + deltaAKs).resample(vega.wave)
+
+            for filt in self.filt_names:
+                obs_str = get_obs_str(filt)
+                filt_info = get_filter_info(obs_str)
+
+                mag_lo = mag_in_filter(red_vega_lo, filt_info)
+                mag_hi = mag_in_filter(red_vega_hi, filt_info)
+                delta_red_filt[filt] = mag_hi - mag_lo
 
         # Perturb all of star systems' photometry by a random amount corresponding to
         # differential de-reddening. The distribution is normal with a width of
         # Aks +/- deltaAKs in each filter
-        rand_red = np.random.randn(len(self.star_systems))
-
-        for filt in self.filt_names:
-            self.star_systems[filt] += rand_red * delta_red_filt[filt]
+        if power_spectrum is None:
+            rand_red = np.random.randn(len(self.star_systems))
+        else:
+            # Place the systems in a correlated extinction map
+            x, y = np.random.uniform(size=(2, len(self.star_systems)))
+            self.star_systems.add_column(Column(x, name='x'))
+            self.star_systems.add_column(Column(y, name='y'))
+            
+            # Interpolating between pixels lowers the variance, so scale
+            # the map to keep deltaAKs as the standard deviation.
+            field = make_gaussian_random_field(field_grid, power_spectrum)
+            self.red_field = field / np.sqrt(sample_field_variance(field))
+            rand_red = sample_field(self.red_field, x, y)
+        diff_AKs = deltaAKs * rand_red
 
-        # Perturb the companions by the same amount.
-        if self.imf.make_multiples:
-            rand_red_comp = np.repeat(rand_red, self.star_systems['N_companions'])
-            assert len(rand_red_comp) == len(self.companions)
+        if red_mode == 'vega':
             for filt in self.filt_names:
-                self.companions[filt] += rand_red_comp * delta_red_filt[filt]
+                self.star_systems[filt] += rand_red * delta_red_filt[filt]
+
+            # Perturb the companions by the same amount.
+            if self.imf.make_multiples:
+                rand_red_comp = np.repeat(rand_red, self.star_systems['N_companions'])
+                assert len(rand_red_comp) == len(self.companions)
+                for filt in self.filt_names:
+                    self.companions[filt] += rand_red_comp * delta_red_filt[filt]
+        else:
+            self._apply_red_table(red_law, diff_AKs, n_AKs)
 
         # Finally, we'll add a column to star_systems with the overall AKs for each star
-        diff_AKs = deltaAKs * rand_red
         final_AKs = AKs + diff_AKs
         col = Column(final_AKs, name='AKs_f')
         self.star_systems.add_column(col)
         #t2 = time.time()
         #print 'Diff redden: {0}'.format(t2 - t1)
         return
+
+    def _apply_red_table(self, red_law, diff_AKs, n_AKs):
+        """
+        Apply the extinction offsets diff_AKs of the star systems (and 
+        their companions), using a table of the change in magnitude with
+        extinction for each isochrone point.
+        """
+        # Make the photometry of the isochrone spectra for each extinction 
+        # offset, by folding the reddening curves into the filter weights.
+        if getattr(self.iso, 'flux', None) is not None:
+            wave, flux = self.iso.wave, self.iso.flux
+        elif isinstance(self.iso.spec_list, SpectrumArrayList):
+            wave, flux = self.iso.spec_list.to_array()
+        else:
+            wave, flux = spectra_to_array(self.iso.spec_list)
+
+        weights = np.zeros((len(wave), len(self.filt_names)), dtype=float)
+        mag0 = np.zeros(len(self.filt_names), dtype=float)
+        for ff in range(len(self.filt_names)):
+            filt = get_filter_info(get_obs_str(self.filt_names[ff]))
+            weights[:, ff] = get_filter_weights(filt, wave)
+            mag0[ff] = filt.mag0
+
+        # Include zero offset exactly, so that those stars are unchanged.
+        AKs_grid = np.linspace(min(diff_AKs.min(), 0), max(diff_AKs.max(), 0), n_AKs)
+        AKs_grid[np.argmin(np.abs(AKs_grid))] = 0
+        red = red_law.transmission(AKs_grid, wave)
+        red_weights = red.T[:, :, np.newaxis] * weights[:, np.newaxis, :]
+        red_weights = red_weights.reshape(len(wave), -1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mags = mags_in_filters(flux, red_weights, np.tile(mag0, n_AKs))
+            mags = mags.reshape(len(flux), n_AKs, len(self.filt_names))
+            mags_iso = mags_in_filters(flux, weights, mag0)
+
+            # Change in magnitude, shape (N_points x N_AKs x N_filters)
+            self.red_table = mags - mags_iso[:, np.newaxis, :]
+        self.red_table[~np.isfinite(self.red_table)] = 0
+        self.red_table_AKs = AKs_grid
+
+        if not self.imf.make_multiples:
+            delta_mag = self._get_red_table_delta(self.star_systems['mass'], diff_AKs)
+            for ff in range(len(self.filt_names)):
+                self.star_systems[self.filt_names[ff]] += delta_mag[:, ff]
+
+            return
+
+        # The system photometry includes the companions, which
+        # are reddened differently than the primary star.
+        N_companions = self.star_systems['N_companions']
+        delta_prim = self._get_red_table_delta(self.star_systems['mass'], diff_AKs)
+        delta_comp = self._get_red_table_delta(self.companions['mass'],
+                                               np.repeat(diff_AKs, N_companions))
+        
+        idx = np.where(N_companions > 0)[0]
+        comp_start = np.cumsum(N_companions) - N_companions
+        
+        for ff in range(len(self.filt_names)):
+            filt = self.filt_names[ff]
+            self.companions[filt] += delta_comp[:, ff]
+
+            mag_prim = self.iso_interps[filt](self.star_systems['mass']) + delta_prim[:, ff]
+            f_sys = np.nan_to_num(10**(-0.4 * mag_prim))
+            if len(idx) > 0:
+                f_comp = np.nan_to_num(10**(-0.4 * np.array(self.companions[filt])))
+                f_sys[idx] += np.add.reduceat(f_comp, comp_start[idx])
+
+            # Systems that already had nan magnitudes (e.g. remnants) don't change.
+            good = np.isfinite(self.star_systems[filt]) & (f_sys > 0)
+            self.star_systems[filt][good] = -2.5 * np.log10(f_sys[good])
+
+        return
+
+    def _get_red_table_delta(self, mass, diff_AKs):
+        """
+        Interpolate the red_table in mass and extinction offset, 
+        giving the change in magnitude in each filter, of shape 
+        (N_stars x N_filters).
+        """
+        iso_mass = np.array(self.iso.points['mass'])
+        sdx = np.argsort(iso_mass)
+        iso_mass = iso_mass[sdx]
+        table = self.red_table[sdx]
+        
+        mass = np.asarray(mass, dtype=float)
+        m_hi = np.clip(np.searchsorted(iso_mass, mass), 1, len(iso_mass) - 1)
+        m_lo = m_hi - 1
+        dm = iso_mass[m_hi] - iso_mass[m_lo]
+        m_wgt = np.clip((mass - iso_mass[m_lo]) / np.where(dm > 0, dm, 1), 0, 1)
+
+        a_hi = np.clip(np.searchsorted(self.red_table_AKs, diff_AKs), 1, len(self.red_table_AKs) - 1)
+        a_lo = a_hi - 1
+        da = self.red_table_AKs[a_hi] - self.red_table_AKs[a_lo]
+        a_wgt = np.clip((diff_AKs - self.red_table_AKs[a_lo]) / np.where(da > 0, da, 1), 0, 1)
+
+        m_wgt = m_wgt[:, np.newaxis]
+        a_wgt = a_wgt[:, np.newaxis]
+        delta_lo = (1 - a_wgt) * table[m_lo, a_lo] + a_wgt * table[m_lo, a_hi]
+        delta_hi = (1 - a_wgt) * table[m_hi, a_lo] + a_wgt * table[m_hi, a_hi]
+
+        return (1 - m_wgt) * delta_lo + m_wgt * delta_hi
     
+def make_gaussian_random_field(n_grid, power_spectrum):
+    """
+    Make a periodic 2D Gaussian random field, e.g. for a spatially 
+    correlated extinction map, by filtering white noise with FFTs. 
+    The field has zero mean and unit standard deviation.
+
+    Parameters
+    ----------
+    n_grid: int
+        Number of pixels on a side.
+
+    power_spectrum: float or function
+        If float, the power spectrum is a power law, P(k) = k**(-power_spectrum),
+        so larger values give smoother fields. If a function, P(k) is 
+        power_spectrum(k). The wavenumber k is in cycles per field width.
+
+    Returns
+    -------
+    field: 2D numpy array
+        Field of shape (n_grid x n_grid), indexed by [y, x].
+    """
+    kx = np.fft.rfftfreq(n_grid) * n_grid
+    ky = np.fft.fftfreq(n_grid) * n_grid
+    k = np.hypot(kx[np.newaxis, :], ky[:, np.newaxis])
+
+    # The mean (k = 0) is removed.
+    power = np.zeros(k.shape, dtype=float)
+    if callable(power_spectrum):
+        power[k > 0] = power_spectrum(k[k > 0])
+    else:
+        power[k > 0] = k[k > 0]**(-float(power_spectrum))
+
+    noise = np.fft.rfft2(np.random.randn(n_grid, n_grid))
+    field = np.fft.irfft2(noise * np.sqrt(power), s=(n_grid, n_grid))
+
+    field_std = field.std()
+    if field_std == 0:
+        raise ValueError('make_gaussian_random_field: power spectrum is zero')
+        
+    return (field - field.mean()) / field_std
+
+def sample_field(field, x, y, chunk_size=2**20):
+    """
+    Bilinearly interpolate a periodic 2D field (as from 
+    make_gaussian_random_field) at positions x and y, which are
+    in units of the field width. The positions are done in chunks
+    of chunk_size, to limit the memory use for many stars.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n_y, n_x = field.shape
+    values = np.empty(len(x), dtype=float)
+
+    for start in range(0, len(x), chunk_size):
+        sl = slice(start, start + chunk_size)
+        
+        # Pixel centers are at (i + 0.5) / n
+        xp = x[sl] * n_x - 0.5
+        yp = y[sl] * n_y - 0.5
+        x0 = np.floor(xp).astype(int)
+        y0 = np.floor(yp).astype(int)
+        wx = xp - x0
+        wy = yp - y0
+
+        x0 %= n_x
+        y0 %= n_y
+        x1 = (x0 + 1) % n_x
+        y1 = (y0 + 1) % n_y
+
+        values[sl] = ((1 - wy) * ((1 - wx) * field[y0, x0] + wx * field[y0, x1]) +
+                      wy * ((1 - wx) * field[y1, x0] + wx * field[y1, x1]))
+
+    return values
+
+def sample_field_variance(field):
+    """
+    Expected variance of sample_field at uniformly random positions.
+    Bilinear interpolation between the pixels lowers the variance 
+    below that of the pixel values, the more so for rougher fields.
+    """
+    # The four corners of each interpolation cell, and the expected
+    # products of their weights, for uniform offsets in the cell.
+    corners = [(0, 0), (0, 1), (1, 0), (1, 1)]
+    wgt_prod = np.array([[1.0 / 3.0, 1.0 / 6.0], [1.0 / 6.0, 1.0 / 3.0]])
+    values = [np.roll(field, (-dy, -dx), axis=(0, 1)) for dy, dx in corners]
+
+    mean_sq = 0.0
+    for (y1, x1), v1 in zip(corners, values):
+        for (y2, x2), v2 in zip(corners, values):
+            mean_sq += wgt_prod[y1, y2] * wgt_prod[x1, x2] * np.mean(v1 * v2)
+
+    return mean_sq - field.mean()**2
+
 class UnresolvedCluster(Cluster):
     """
     Cluster sub-class that produces an *unresolved* stellar cluster.
@@ -557,78 +1033,165 @@ class UnresolvedCluster(Cluster):
 
     vebose: boolean
         True for verbose output.
+
+    keep_star_spectra: boolean
+        If True, keep the spectrum of every sampled star in spec_list and 
+        spec_list_trim. This takes a lot of memory for large clusters. 
+        Otherwise, only the integrated spectrum is made.
+        Default False.
+
+    mode: string
+        How to get the stars in the cluster:
+        'sample' - randomly sample the IMF (default).
+        'expectation' - no sampling; use the number of stars expected from
+        the IMF at each isochrone point. This gives the mean integrated 
+        spectrum, in the same time for any cluster mass. Multiplicity
+        is not used.
+        'hybrid' - use the expected number of stars below hybrid_mass_min,
+        and randomly sample the stars above it. Multiplicity is not used.
+
+    hybrid_mass_min: float
+        The mass above which stars are randomly sampled in the 'hybrid'
+        mode, in M_sun. Default is 5.
     """
     def __init__(self, iso, imf, cluster_mass,
-                 wave_range=[3000, 52000], verbose=False):
+                 wave_range=[3000, 52000], verbose=False,
+                 keep_star_spectra=False, mode='sample', hybrid_mass_min=5):
         # Doesn't do much.
         Cluster.__init__(self, iso, imf, cluster_mass, verbose=verbose)
         
+        if mode not in ['sample', 'expectation', 'hybrid']:
+            raise ValueError('UnresolvedCluster: mode {0} undefined'.format(mode))
+        self.mode = mode
+
         # Sample a power-law IMF randomly
-        self.mass, isMulti, compMass, sysMass = imf.generate_cluster(cluster_mass)
-        
-        temp = np.zeros(len(self.mass), dtype=float)
-        self.mass_all = np.zeros(len(self.mass), dtype=float)
-        self.spec_list = [None] * len(self.mass)
-        # placeholder array to make spectrum summing more efficient
-        spec_list_np = np.zeros(shape=(len(iso.spec_list[0].flux),len(self.mass)), dtype=float)
-        self.spec_list_trim = [None] * len(self.mass)
-        # same as spec_list_np, but for the wavelength-trimmed spectra
-        trimtmp = spectrum.trimSpectrum(iso.spec_list[0],wave_range[0],wave_range[1])
-        trimx = len(trimtmp._fluxtable)
-        spec_list_trim_np = np.zeros(shape=(trimx,len(self.mass)), dtype=float)
+        if mode == 'sample':
+            self.mass, isMulti, compMass, sysMass, compOffsets = imf.generate_cluster(cluster_mass,
+                                                                                      flat_companions=True)
+        elif mode == 'hybrid':
+            self.mass = imf.generate_high_mass_tail(cluster_mass, hybrid_mass_min)
+            sysMass = self.mass
+        else:
+            self.mass = np.array([], dtype=float)
+            sysMass = self.mass
 
         t1 = time.time()
-        for ii in range(len(self.mass)):
-            # Find the closest model mass (returns None, if nothing with dm = 0.1
-            mdx = match_model_mass(iso.points['mass'], self.mass[ii])
-            if mdx == None:
-                continue
+        # Find the closest model mass for every star (-1 if nothing
+        # within 10%), and get rid of the bad ones.
+        iso_mass = np.array(iso.points['mass'])
+        iso_good = np.array(iso.points['Teff']) != 0
+        
+        if len(self.mass) > 0:
+            mdx = match_model_masses(iso_mass, self.mass)
+        else:
+            mdx = np.array([], dtype=int)
+        idx = np.where(mdx >= 0)[0]
+        idx = idx[iso_good[mdx[idx]]]
+        mdx = mdx[idx]
+        
+        self.mass_all = iso_mass[mdx]
+        self.mass_tot = np.sum(sysMass[idx])
+
+        # Number of stars at each isochrone point.
+        self.iso_weights = np.bincount(mdx, minlength=len(iso_mass))
 
-            # getting the temp, mass, spectrum of the matched star
-            temp[ii] = iso.points['Teff'][mdx]
-            self.mass_all[ii] = iso.points['mass'][mdx]
-            tmpspec = iso.spec_list[mdx]
-
-            # resampling the matched spectrum to a common wavelength grid
-            tmpspec = spectrum.CompositeSourceSpectrum.tabulate(tmpspec)
-            tmpspecresamp = spectrum.TabularSourceSpectrum.resample(tmpspec,iso.spec_list[0].wave)
-            self.spec_list[ii] = tmpspecresamp
-            spec_list_np[:,ii]=np.asarray(tmpspecresamp._fluxtable)
-
-            # and trimming to the requested wavelength range
-            tmpspectrim = spectrum.trimSpectrum(tmpspecresamp,wave_range[0],wave_range[1])
-            self.spec_list_trim[ii] = tmpspectrim
-            spec_list_trim_np[:,ii] = np.asarray(tmpspectrim._fluxtable)
+        # Add the expected number of stars that are not sampled
+        if mode != 'sample':
+            if mode == 'hybrid':
+                mass_max = hybrid_mass_min
+            else:
+                mass_max = None
+                
+            n_exp, m_exp = self._get_expected_stars(iso_mass, mass_max=mass_max)
+            n_exp[~iso_good] = 0
+            m_exp[~iso_good] = 0
             
+            self.iso_weights = self.iso_weights + n_exp
+            self.mass_tot += m_exp.sum()
 
         t2 = time.time()
         print( 'Mass matching took {0:f} s.'.format(t2-t1))
 
-        # Get rid of the bad ones
-        idx = np.where(temp != 0)[0]
-        cdx = np.where(temp == 0)[0]
-
-        self.mass_all = self.mass_all[idx]
-        self.spec_list = [self.spec_list[iidx] for iidx in idx]
-        spec_list_np = spec_list_np[:,idx]
-        self.spec_list_trim = [self.spec_list_trim[iidx] for iidx in idx]
-        spec_list_trim_np = spec_list_trim_np[:,idx]
+        # Put the spectra of the isochrone points that are used onto
+        # a common wavelength grid.
+        wave = iso.spec_list[0].wave
+        used = np.where(self.iso_weights > 0)[0]
+        
+        iso_spec = [None] * len(used)
+        iso_flux = np.zeros((len(used), len(wave)), dtype=float)
+        for uu in range(len(used)):
+            tmpspec = spectrum.CompositeSourceSpectrum.tabulate(iso.spec_list[used[uu]])
+            iso_spec[uu] = spectrum.TabularSourceSpectrum.resample(tmpspec, wave)
+            iso_flux[uu] = np.asarray(iso_spec[uu]._fluxtable)
 
-        self.spec_tot_full = np.sum(spec_list_np,1)
+        # The integrated spectrum is the isochrone spectra weighted by
+        # the number of stars at each isochrone point.
+        self.spec_tot_full = np.dot(self.iso_weights[used], iso_flux)
 
         t3 = time.time()
         print( 'Spec summing took {0:f}s'.format(t3-t2))
 
-        self.spec_trim = np.sum(spec_list_trim_np,1)
-        self.wave_trim = self.spec_list_trim[0].wave
+        # Trim to the requested wavelength range
+        trim = (wave >= wave_range[0]) & (wave <= wave_range[1])
+        self.spec_trim = self.spec_tot_full[trim]
+        self.wave_trim = wave[trim]
+
+        # Keep the spectrum of each star, if desired. Stars
+        # matched to the same isochrone point share one spectrum.
+        if keep_star_spectra:
+            iso_spec_trim = [spectrum.trimSpectrum(tmpspec, wave_range[0], wave_range[1])
+                             for tmpspec in iso_spec]
+            sdx = np.searchsorted(used, mdx)
+            self.spec_list = [iso_spec[ii] for ii in sdx]
+            self.spec_list_trim = [iso_spec_trim[ii] for ii in sdx]
+        else:
+            self.spec_list = None
+            self.spec_list_trim = None
         
         t4 = time.time()
         print( 'Spec trimming took {0:f}s'.format(t4-t3))
 
-        self.mass_tot = np.sum(sysMass[idx])
         print( 'Total cluster mass is {0:f} M_sun'.format(self.mass_tot))
 
         return
+
+    def _get_expected_stars(self, iso_mass, mass_max=None):
+        """
+        Get the number and total mass of stars expected from the IMF at
+        each isochrone point. Each point gets the stars that are closer to
+        it than to its neighbors and within 10% of its mass, the same as
+        the mass matching of the sampled stars.
+
+        Parameters
+        ----------
+        iso_mass: array
+            The masses of the isochrone points, in M_sun
+
+        mass_max: float or None
+            If float, only include stars below this mass, in M_sun.
+        """
+        self.imf.normalize(self.cluster_mass)
+
+        sdx = np.argsort(iso_mass)
+        mass = iso_mass[sdx]
+
+        # Mass range for each isochrone point, within the IMF mass range.
+        mid = (mass[1:] + mass[:-1]) / 2.0
+        mass_lo = np.maximum(np.append(0, mid), mass / 1.1)
+        mass_hi = np.minimum(np.append(mid, np.inf), mass / 0.9)
+
+        edge_max = self.imf.norm_Mmax
+        if mass_max != None:
+            edge_max = min(edge_max, mass_max)
+        mass_lo = np.clip(mass_lo, self.imf.norm_Mmin, edge_max)
+        mass_hi = np.clip(mass_hi, self.imf.norm_Mmin, edge_max)
+
+        n_exp = np.zeros(len(iso_mass), dtype=float)
+        m_exp = np.zeros(len(iso_mass), dtype=float)
+        n_exp[sdx] = self.imf.int_xi(mass_lo, mass_hi)
+        m_exp[sdx] = self.imf.int_mxi(mass_lo, mass_hi)
+
+        return n_exp, m_exp
         
 class Isochrone(object):
     """
@@ -682,13 +1245,18 @@ class Isochrone(object):
         If true, rebins the atmospheres so that they are the same
         resolution as the Castelli+04 atmospheres. Default is False,
         which is often sufficient synthetic photometry in most cases.
+
+    atm_cache : AtmosphereCache object or None, optional
+        If defined, fetch the stellar and white dwarf atmospheres
+        through this on-disk spectrum cache (see 
+        atmospheres.AtmosphereCache). Default is None.
     """
     def __init__(self, logAge, AKs, distance, metallicity=0.0,
                  evo_model=default_evo_model, atm_func=default_atm_func,
                  wd_atm_func = default_wd_atm_func,
                  red_law=default_red_law, mass_sampling=1,
                  wave_range=[3000, 52000], min_mass=None, max_mass=None,
-                 rebin=True):
+                 rebin=True, atm_cache=None):
 
 
         t1 = time.time()
@@ -742,6 +1310,15 @@ class Isochrone(object):
         # Initialize output for stellar spectra
         self.spec_list = []
 
+        # If desired, fetch atmospheres through the on-disk cache.
+        get_atm = atm_func
+        get_wd_atm = wd_atm_func
+        if atm_cache != None:
+            get_atm = atm_cache.cached(atm_func)
+            get_wd_atm = atm_cache.cached(wd_atm_func)
+            hits_start = atm_cache.hits
+            misses_start = atm_cache.misses
+
         # For each temperature extract the synthetic photometry.
         for ii in range(len(tab['Teff'])):
             # Loop is currently taking about 0.11 s per iteration
@@ -756,10 +1333,10 @@ class Isochrone(object):
             # If source is a star, pull from star atmospheres. If it is a WD,
             # pull from WD atmospheres
             if phase == 101:
-                star = wd_atm_func(temperature=T, gravity=gravity, metallicity=metallicity,
+                star = get_wd_atm(temperature=T, gravity=gravity, metallicity=metallicity,
                                        verbose=False)
             else:
-                star = atm_func(temperature=T, gravity=gravity, metallicity=metallicity,
+                star = get_atm(temperature=T, gravity=gravity, metallicity=metallicity,
                                     rebin=rebin)
 
             # Trim wavelength range down to JHKL range (0.5 - 5.2 microns)
@@ -769,7 +1346,8 @@ class Isochrone(object):
             star *= (R / distance)**2  # in erg s^-1 cm^-2 A^-1
 
             # Redden the spectrum. This doesn't take much time at all.
-            red = red_law.reddening(AKs).resample(star.wave) 
+            red = spectrum.ArraySpectralElement(star.wave, red_law.transmission(AKs, star.wave),
+                                                waveunits='angstrom')
             star *= red
             
             # Save the final spectrum to our spec_list for later use.            
@@ -789,6 +1367,10 @@ class Isochrone(object):
 
         self.points = tab
 
+        if atm_cache != None:
+            cache_fmt = 'Atmosphere cache: {0:d} hits, {1:d} misses'
+            print( cache_fmt.format(atm_cache.hits - hits_start, atm_cache.misses - misses_start))
+
         t2 = time.time()
         print( 'Isochrone generation took {0:f} s.'.format(t2-t1))
         return
@@ -848,7 +1430,9 @@ class Isochrone(object):
 class IsochronePhot(Isochrone):
     """
     Make an isochrone with synthetic photometry in various filters. 
-    Load from file if possible. 
+    Load from file if possible. If the saved isochrone is missing 
+    some of the filters, only the spectra are remade (through atm_cache, 
+    if given) and the new filters are added to the file.
 
     Parameters
     ----------
@@ -918,6 +1502,19 @@ class IsochronePhot(Isochrone):
         Define what filters the synthetic photometry
         will be calculated for, via the filter string 
         identifier. 
+
+    atm_cache : AtmosphereCache object or None, optional
+        If defined, fetch the atmospheres through this on-disk
+        spectrum cache (see atmospheres.AtmosphereCache). 
+        Default is None.
+
+    save_spectra : boolean, optional
+        If true, also save the spectra next to the isochrone file 
+        (see write_iso_spectra). When the isochrone is loaded again, 
+        spec_list is then read from that file, and missing filters are 
+        added without making any atmospheres. If a saved isochrone has
+        no spectra, they are made and saved, without remaking the 
+        photometry. Default is False.
     """
     def __init__(self, logAge, AKs, distance,
                  metallicity=0.0,
@@ -927,33 +1524,16 @@ class IsochronePhot(Isochrone):
                  red_law=default_red_law, mass_sampling=1, iso_dir='./',
                  min_mass=None, max_mass=None, rebin=True, recomp=False,
                  filters=['ubv,U', 'ubv,B', 'ubv,V',
-                          'ubv,R', 'ubv,I']):
+                          'ubv,R', 'ubv,I'], atm_cache=None,
+                 save_spectra=False):
 
         # Make the iso_dir, if it doesn't already exist
         if not os.path.exists(iso_dir):
             os.mkdir(iso_dir)
 
         # Make and input/output file name for the stored isochrone photometry.
-        # For solar metallicity case, allow for legacy isochrones (which didn't have
-        # metallicity tag since they were all solar metallicity) to be read
-        # properly
-        if metallicity == 0.0:
-            save_file_fmt = '{0}/iso_{1:.2f}_{2:4.2f}_{3:4s}_p00.fits'
-            self.save_file = save_file_fmt.format(iso_dir, logAge, AKs, str(distance).zfill(5))
-
-            save_file_legacy = '{0}/iso_{1:.2f}_{2:4.2f}_{3:4s}.fits'
-            self.save_file_legacy = save_file_legacy.format(iso_dir, logAge, AKs, str(distance).zfill(5))
-        else:
-            # Set metallicity flag
-            if metallicity < 0:
-                metal_pre = 'm'
-            else:
-                metal_pre = 'p'
-            metal_flag = int(abs(metallicity)*10)
-            
-            save_file_fmt = '{0}/iso_{1:.2f}_{2:4.2f}_{3:4s}_{4}{5:2s}.fits'
-            self.save_file = save_file_fmt.format(iso_dir, logAge, AKs, str(distance).zfill(5), metal_pre, str(metal_flag).zfill(2))
-            self.save_file_legacy = save_file_fmt.format(iso_dir, logAge, AKs, str(distance).zfill(5), metal_pre, str(metal_flag).zfill(2))
+        self.save_file, self.save_file_legacy = get_iso_save_file(iso_dir, logAge, AKs,
+                                                                  distance, metallicity)
             
         # Expected filters
         self.filters = filters
@@ -961,7 +1541,42 @@ class IsochronePhot(Isochrone):
         # Recalculate isochrone if save_file doesn't exist or recomp == True
         file_exists = self.check_save_file(evo_model, atm_func, red_law)
 
-        if (not file_exists) | (recomp==True):
+        # 2D (N_points x N_wave) array of the spectra, if they are loaded.
+        self.wave = None
+        self.flux = None
+
+        if file_exists & (recomp==False):
+            try:
+                saved_points = Table.read(self.save_file)
+                saved_file = self.save_file
+            except:
+                saved_points = Table.read(self.save_file_legacy)
+                saved_file = self.save_file_legacy
+            # Add some error checking.
+
+            # Use the saved spectra, if they match the isochrone.
+            spec_list = read_iso_spectra(saved_file)
+            if (spec_list != None) and (len(spec_list) == len(saved_points)):
+                self.spec_list = spec_list
+
+        has_spectra = hasattr(self, 'spec_list')
+        
+        if ((len(self.missing_filters) > 0) & (file_exists==True) &
+            (recomp==False) & has_spectra):
+            # Only the photometry for the new filters is needed.
+            self.recalc = True
+            self.verbose = True
+            self.points = saved_points
+            print( 'Adding filters to saved isochrone: {0}'.format(self.missing_filters))
+            self.make_photometry(rebin=rebin, vega=vega, filters=self.missing_filters)
+
+            # Keep the spectra with the isochrone, if it was read from 
+            # the legacy file.
+            if save_spectra and (saved_file != self.save_file):
+                write_iso_spectra(self.wave, self.flux, self.save_file)
+            
+        elif ((file_exists==False) | (recomp==True) | (len(self.missing_filters) > 0) |
+              (save_spectra & (not has_spectra))):
             self.recalc = True
             Isochrone.__init__(self, logAge, AKs, distance,
                                metallicity=metallicity,
@@ -969,72 +1584,107 @@ class IsochronePhot(Isochrone):
                                wd_atm_func=wd_atm_func,
                                wave_range=wave_range,
                                red_law=red_law, mass_sampling=mass_sampling,
-                               min_mass=min_mass, max_mass=max_mass, rebin=rebin)
+                               min_mass=min_mass, max_mass=max_mass, rebin=rebin,
+                               atm_cache=atm_cache)
             self.verbose = True
-            
-            # Make photometry
-            self.make_photometry(rebin=rebin, vega=vega)
+
+            # If the saved isochrone only lacks some filters (or the
+            # spectra), and the stars are the same, only make the 
+            # photometry for those.
+            if (file_exists & (recomp==False) and
+                (len(saved_points) == len(self.points)) and
+                np.allclose(saved_points['mass'], self.points['mass'])):
+                self.points = saved_points
+                if len(self.missing_filters) > 0:
+                    print( 'Adding filters to saved isochrone: {0}'.format(self.missing_filters))
+                    self.make_photometry(rebin=rebin, vega=vega, filters=self.missing_filters)
+                else:
+                    self.wave, self.flux = spectra_to_array(self.spec_list)
+                    if saved_file != self.save_file:
+                        write_iso_file(self.points, self.save_file)
+            else:
+                self.make_photometry(rebin=rebin, vega=vega)
+
+            # Save the spectra too. Any old ones were removed when the
+            # isochrone was written.
+            if save_spectra:
+                write_iso_spectra(self.wave, self.flux, self.save_file)
         else:
             self.recalc = False
-            try:
-                self.points = Table.read(self.save_file)
-            except:
-                self.points = Table.read(self.save_file_legacy)
-            # Add some error checking.
+            self.points = saved_points
 
         return
 
-    def make_photometry(self, rebin=True, vega=vega):
+    def make_photometry(self, rebin=True, vega=vega, filters=None):
         """ 
         Make synthetic photometry for the specified filters. This function
         udpates the self.points table to include new columns with the
         photometry.
-        
+
+        filters : list or None, optional
+            Only make the photometry for these filters, e.g. to 
+            add them to a saved isochrone. If None, use self.filters.
         """
+        if filters == None:
+            filters = self.filters
+            
         startTime = time.time()
 
         meta = self.points.meta
 
         print( 'Making photometry for isochrone: log(t) = %.2f  AKs = %.2f  dist = %d' % \
             (meta['LOGAGE'], meta['AKS'], meta['DISTANCE']))
-        print( '     Starting at: ', datetime.datetime.now(), '  Usually takes ~5 minutes')
+        print( '     Starting at: ', datetime.datetime.now(), '  Usually takes a few seconds')
 
         npoints = len(self.points)
         verbose_fmt = 'M = {0:7.3f} Msun  T = {1:5.0f} K  m_{2:s} = {3:4.2f}'
 
-        # Loop through the filters, get filter info, make photometry for
-        # all stars in this filter.
-        for ii in self.filters:
+        # Put all of the spectra onto a common wavelength grid, as a
+        # 2D (N_points x N_wave) flux array. These are already extincted,
+        # observed spectra.
+        if self.flux is None:
+            if isinstance(self.spec_list, SpectrumArrayList):
+                self.wave, self.flux = self.spec_list.to_array()
+            else:
+                self.wave, self.flux = spectra_to_array(self.spec_list)
+        wave, flux = self.wave, self.flux
+
+        # Loop through the filters, get filter info, and build the
+        # weight vector for each filter on the common wavelength grid.
+        weights = np.zeros((len(wave), len(filters)), dtype=float)
+        mag0 = np.zeros(len(filters), dtype=float)
+        col_names = []
+        
+        for ff in range(len(filters)):
             prt_fmt = 'Starting filter: {0:s}   Elapsed time: {1:.2f} seconds'
-            print( prt_fmt.format(ii, time.time() - startTime))
+            print( prt_fmt.format(filters[ff], time.time() - startTime))
             
-            filt = get_filter_info(ii, rebin=rebin, vega=vega)
-            filt_name = get_filter_col_name(ii)
-
-            # Make the column to hold magnitudes in this filter. Add to points table.
-            col_name = 'm_' + filt_name
-            mag_col = Column(np.zeros(npoints, dtype=float), name=col_name)
+            filt = get_filter_info(filters[ff], rebin=rebin, vega=vega)
+            weights[:, ff] = get_filter_weights(filt, wave)
+            mag0[ff] = filt.mag0
+            col_names.append('m_' + get_filter_col_name(filters[ff]))
+
+        # Do the filter integration for all stars and all filters at once.
+        print('Starting synthetic photometry')
+        mags = mags_in_filters(flux, weights, mag0)
+
+        # Make the columns to hold magnitudes in each filter. Add to points table.
+        for ff in range(len(filters)):
+            mag_col = Column(mags[:, ff], name=col_names[ff])
             self.points.add_column(mag_col)
-            
-            # Loop through each star in the isochrone and do the filter integration
-            print('Starting synthetic photometry')
-            for ss in range(npoints):
-                star = self.spec_list[ss]  # These are already extincted, observed spectra.
-                star_mag = mag_in_filter(star, filt)
-                
-                self.points[col_name][ss] = star_mag
-        
-                if (self.verbose and (ss % 100) == 0):
+
+            if self.verbose:
+                for ss in range(0, npoints, 100):
                     print( verbose_fmt.format(self.points['mass'][ss], self.points['Teff'][ss],
-                                             filt_name, star_mag))
+                                             col_names[ff][2:], mags[ss, ff]))
 
         endTime = time.time()
         print( '      Time taken: {0:.2f} seconds'.format(endTime - startTime))
 
+        # Spectra read from the saved files still match the isochrone.
         if self.save_file != None:
-            with warnings.catch_warnings():
-                warnings.simplefilter('ignore')
-                self.points.write(self.save_file, overwrite=True)
+            write_iso_file(self.points, self.save_file,
+                           keep_spectra=isinstance(self.spec_list, SpectrumArrayList))
 
         return
 
@@ -1042,24 +1692,27 @@ class IsochronePhot(Isochrone):
         """
         Check to see if save_file exists, as saved by the save_file 
         and save_file_legacy objects. If the filename exists, check the 
-        meta-data as well.
+        meta-data as well. The check uses the iso_dir manifest
+        (see IsochroneManifest), so the file itself isn't read.
+
+        Also sets self.missing_filters, the requested filters that
+        aren't in the file.
 
         returns a boolean: True is file exists, false otherwise
         """
         out_bool = False
+        self.missing_filters = list(self.filters)
+
+        manifest = get_iso_manifest(os.path.dirname(self.save_file))
+        record = manifest.get(self.save_file)
+        if record == None:
+            record = manifest.get(self.save_file_legacy)
         
-        if os.path.exists(self.save_file) | os.path.exists(self.save_file_legacy):
-            try:
-                tmp = Table.read(self.save_file)
-            except:
-                tmp = Table.read(self.save_file_legacy)
-            
-        
+        if record != None:
             # See if the meta-data matches: evo model, atm_func, redlaw
-            if ( (tmp.meta['EVOMODEL'] == type(evo_model).__name__) &
-                (tmp.meta['ATMFUNC'] == atm_func.__name__) &
-                 (tmp.meta['REDLAW'] == red_law.name) ):
+            if manifest.models_match(record, evo_model, atm_func, red_law):
                 out_bool = True
+                self.missing_filters = manifest.missing_filters(record, self.filters)
             
         return out_bool
 
@@ -1120,6 +1773,542 @@ class IsochronePhot(Isochrone):
         
         return
 
+def get_iso_save_file(iso_dir, logAge, AKs, distance, metallicity=0.0):
+    """
+    Return the file names used by IsochronePhot to store the isochrone
+    photometry for a set of isochrone parameters.
+
+    For the solar metallicity case, allow for legacy isochrones (which didn't have
+    metallicity tag since they were all solar metallicity) to be read
+    properly.
+
+    Returns
+    -------
+    save_file : str
+        Isochrone file name
+
+    save_file_legacy : str
+        Legacy isochrone file name
+    """
+    if metallicity == 0.0:
+        save_file_fmt = '{0}/iso_{1:.2f}_{2:4.2f}_{3:4s}_p00.fits'
+        save_file = save_file_fmt.format(iso_dir, logAge, AKs, str(distance).zfill(5))
+
+        save_file_legacy = '{0}/iso_{1:.2f}_{2:4.2f}_{3:4s}.fits'
+        save_file_legacy = save_file_legacy.format(iso_dir, logAge, AKs, str(distance).zfill(5))
+    else:
+        # Set metallicity flag
+        if metallicity < 0:
+            metal_pre = 'm'
+        else:
+            metal_pre = 'p'
+        metal_flag = int(abs(metallicity)*10)
+            
+        save_file_fmt = '{0}/iso_{1:.2f}_{2:4.2f}_{3:4s}_{4}{5:2s}.fits'
+        save_file = save_file_fmt.format(iso_dir, logAge, AKs, str(distance).zfill(5), metal_pre, str(metal_flag).zfill(2))
+        save_file_legacy = save_file
+
+    return save_file, save_file_legacy
+
+def write_iso_file(points, save_file, keep_spectra=False):
+    """
+    Write an isochrone table to save_file. The table is written to a
+    temporary file and then renamed, so that other processes never see
+    a partially written isochrone.
+
+    Any spectra saved alongside save_file (see write_iso_spectra) are
+    removed, since they may not match the new isochrone, unless 
+    keep_spectra is True (e.g. when only filters were added).
+    """
+    save_dir = os.path.dirname(os.path.abspath(save_file))
+
+    if not keep_spectra:
+        remove_iso_spectra(save_file)
+
+    with atomic_write(save_file, suffix='.fits') as tmp_file:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            points.write(tmp_file, overwrite=True, format='fits')
+
+    get_iso_manifest(save_dir).add(save_file, points)
+
+    return
+
+def get_iso_spectra_files(save_file):
+    """
+    Return the file names of the spectra saved alongside an isochrone
+    file: the (N_points x N_wave) float32 flux array, and the wavelength
+    array and flux scale of each spectrum.
+    """
+    base = os.path.splitext(save_file)[0]
+    return base + '_spec_flux.npy', base + '_spec_axes.npz'
+
+def write_iso_spectra(wave, flux, save_file):
+    """
+    Save the spectra of an isochrone alongside its save_file. The flux 
+    is stored as float32, so it can be memory mapped by read_iso_spectra.
+    Each spectrum is divided by its maximum, since the reddened fluxes 
+    are often too small for float32.
+    """
+    flux_file, axes_file = get_iso_spectra_files(save_file)
+
+    scale = np.max(flux, axis=1)
+    scale[scale <= 0] = 1.0
+
+    # Write to temporary files first, so that other processes never
+    # read partially written spectra. The axes file is replaced
+    # last, since read_iso_spectra needs both.
+    with atomic_write(axes_file, suffix='.npz') as tmp_axes_file, \
+         atomic_write(flux_file, suffix='.npy') as tmp_flux_file:
+        with open(tmp_flux_file, 'wb') as _out:
+            np.save(_out, np.asarray(flux / scale[:, np.newaxis], dtype=np.float32))
+        with open(tmp_axes_file, 'wb') as _out:
+            np.savez(_out, wave=wave, scale=scale)
+
+    return
+
+def read_iso_spectra(save_file):
+    """
+    Read the spectra saved alongside an isochrone file with 
+    write_iso_spectra. The flux array is memory mapped, so only the
+    spectra that are used get read.
+
+    Returns
+    -------
+    spec_list : SpectrumArrayList or None
+        The spectra, which can be used as Isochrone.spec_list. 
+        None if there are no saved spectra.
+    """
+    flux_file, axes_file = get_iso_spectra_files(save_file)
+    if not (os.path.exists(flux_file) & os.path.exists(axes_file)):
+        return None
+    
+    axes = np.load(axes_file)
+    flux = np.load(flux_file, mmap_mode='r')
+
+    return SpectrumArrayList(axes['wave'], flux, scale=axes['scale'])
+
+def remove_iso_spectra(save_file):
+    """
+    Delete the spectra saved alongside an isochrone file, if any.
+    """
+    for ff in get_iso_spectra_files(save_file):
+        if os.path.exists(ff):
+            os.remove(ff)
+
+    return
+
+class SpectrumArrayList(object):
+    """
+    Read-only list of spectra from a 2D flux array (e.g. from 
+    read_iso_spectra), that can be used in place of Isochrone.spec_list. 
+    The pysynphot spectra are only made when they are indexed.
+
+    Parameters
+    ----------
+    wave : numpy array
+        Wavelength array, in Angstroms.
+
+    flux : 2D numpy array
+        (N_spectra x N_wave) flux array, in flam.
+
+    scale : numpy array or None, optional
+        Factor to multiply each spectrum by. Default is None (no scaling).
+    """
+    def __init__(self, wave, flux, scale=None):
+        self.wave = wave
+        self.flux = flux
+        
+        if scale is None:
+            scale = np.ones(flux.shape[0], dtype=float)
+        self.scale = scale
+
+        return
+
+    def __len__(self):
+        return self.flux.shape[0]
+
+    def __getitem__(self, ii):
+        if isinstance(ii, slice):
+            return [self[jj] for jj in range(*ii.indices(len(self)))]
+
+        flux = np.array(self.flux[ii], dtype=float) * self.scale[ii]
+        return spectrum.ArraySourceSpectrum(wave=self.wave, flux=flux,
+                                            waveunits='angstrom', fluxunits='flam')
+
+    def __iter__(self):
+        for ii in range(len(self)):
+            yield self[ii]
+
+    def to_array(self):
+        """
+        Return the wavelength and (N_spectra x N_wave) flux arrays, 
+        as from spectra_to_array.
+        """
+        return self.wave, self.flux * self.scale[:, np.newaxis]
+
+class IsochroneManifest(object):
+    """
+    Index of the isochrone files in an iso_dir, so that checking whether 
+    an isochrone exists, which models it was made with, and which 
+    filters it has doesn't need any FITS I/O.
+
+    The index is stored as a JSON-lines file (manifest.jsonl) in iso_dir,
+    with one record per line:
+
+    file, logAge, AKs, distance, metallicity, evo_model, atm_func, 
+    red_law, filters (m_* column names), size, mtime, md5
+
+    Records are only ever appended (by write_iso_file), so several 
+    processes can safely add to the same manifest; the last record for 
+    a file wins. Files that are not in the manifest, or that have changed 
+    since they were added, are indexed from their FITS header on demand.
+
+    Parameters
+    ----------
+    iso_dir: path
+        Isochrone directory.
+    """
+    def __init__(self, iso_dir):
+        self.iso_dir = iso_dir
+        self.manifest_file = os.path.join(iso_dir, 'manifest.jsonl')
+        
+        self.entries = {}
+        self._offset = 0
+        self.update()
+
+        return
+
+    def update(self):
+        """
+        Read any records added to the manifest file (e.g. by other 
+        processes) since the last update.
+        """
+        if not os.path.exists(self.manifest_file):
+            return
+        
+        with open(self.manifest_file, 'rb') as _in:
+            _in.seek(self._offset)
+            new = _in.read()
+
+        # Only use complete lines; a partial one is still being written.
+        end = new.rfind(b'\n') + 1
+        for line in new[:end].splitlines():
+            if len(line.strip()) == 0:
+                continue
+            record = json.loads(line.decode())
+            self.entries[record['file']] = record
+        self._offset += end
+
+        return
+
+    def add(self, save_file, points=None):
+        """
+        Add an isochrone file to the manifest. The parameters are taken 
+        from the points table meta-data, if given, or else from the 
+        file's FITS header.
+
+        Returns
+        -------
+        record: dict
+        """
+        if points is None:
+            meta = fits.getheader(save_file, 1)
+            col_names = [meta['TTYPE{0}'.format(ii+1)] for ii in range(meta['TFIELDS'])]
+        else:
+            meta = points.meta
+            col_names = points.colnames
+
+        def get_meta(key, dtype, default=None):
+            if key not in meta:
+                return default
+            return dtype(meta[key])
+        
+        stat = os.stat(save_file)
+        record = {'file': os.path.basename(save_file),
+                  'logAge': get_meta('LOGAGE', float),
+                  'AKs': get_meta('AKS', float),
+                  'distance': get_meta('DISTANCE', float),
+                  'metallicity': get_meta('METAL_IN', float, 0.0),
+                  'evo_model': get_meta('EVOMODEL', str),
+                  'atm_func': get_meta('ATMFUNC', str),
+                  'red_law': get_meta('REDLAW', str),
+                  'filters': [col for col in col_names if col.startswith('m_')],
+                  'size': stat.st_size,
+                  'mtime': stat.st_mtime_ns,
+                  'md5': self.get_checksum(save_file)}
+
+        # A single O_APPEND write, so lines from different processes
+        # don't get mixed together. If iso_dir is read-only, the record
+        # is only kept in memory.
+        line = (json.dumps(record) + '\n').encode()
+        try:
+            _out = os.open(self.manifest_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(_out, line)
+            finally:
+                os.close(_out)
+        except OSError as err:
+            print( 'Could not add {0} to {1}: {2}'.format(record['file'], 
+                                                         self.manifest_file, err))
+
+        self.entries[record['file']] = record
+
+        return record
+
+    def get(self, save_file):
+        """
+        Return the manifest record for an isochrone file, or None if 
+        the file doesn't exist.
+        """
+        try:
+            stat = os.stat(save_file)
+        except OSError:
+            return None
+
+        key = os.path.basename(save_file)
+        if not self._is_current(self.entries.get(key), stat):
+            self.update()
+            
+        record = self.entries.get(key)
+        if not self._is_current(record, stat):
+            record = self.add(save_file)
+
+        return record
+
+    def missing_filters(self, record, filters):
+        """
+        Return the filter strings (e.g. 'wfc3,ir,f127m') from filters 
+        that don't have a column in the isochrone file of record.
+        """
+        return [filt for filt in filters
+                if 'm_' + get_filter_col_name(filt) not in record['filters']]
+
+    def models_match(self, record, evo_model, atm_func, red_law):
+        """
+        Check whether the isochrone file of record was made with 
+        the given evolution model, atmosphere function and reddening law.
+        """
+        return ((record['evo_model'] == type(evo_model).__name__) and
+                (record['atm_func'] == atm_func.__name__) and
+                (record['red_law'] == red_law.name))
+
+    def verify(self, save_file):
+        """
+        Check the isochrone file against the checksum in the manifest.
+        Unlike get(), a file that has changed since it was added is not
+        indexed again, so it fails the check.
+        """
+        if not os.path.exists(save_file):
+            return False
+
+        self.update()
+        record = self.entries.get(os.path.basename(save_file))
+        if record is None:
+            return False
+        
+        return self.get_checksum(save_file) == record['md5']
+
+    def get_checksum(self, save_file):
+        md5 = hashlib.md5()
+        with open(save_file, 'rb') as _in:
+            for chunk in iter(lambda: _in.read(2**20), b''):
+                md5.update(chunk)
+
+        return md5.hexdigest()
+        
+    def _is_current(self, record, stat):
+        return ((record is not None) and (record['size'] == stat.st_size) and
+                (record['mtime'] == stat.st_mtime_ns))
+
+# Manifests that have been read, by iso_dir
+iso_manifests = {}
+
+def get_iso_manifest(iso_dir):
+    """
+    Return the (cached) IsochroneManifest for iso_dir.
+    """
+    key = os.path.abspath(iso_dir)
+    if key not in iso_manifests:
+        iso_manifests[key] = IsochroneManifest(key)
+
+    return iso_manifests[key]
+
+class IsochroneIntrinsic(Isochrone):
+    """
+    Isochrone with unreddened spectra at 10 pc. Since distance is only
+    a flux scale factor and extinction is only a multiplicative curve, the
+    photometry for any number of extinctions and distances can be derived 
+    from these spectra without regenerating the atmospheres.
+
+    Parameters
+    ----------
+    logAge : float
+        The age of the isochrone, in log(years)
+
+    metallicity : float, optional
+        The metallicity of the isochrone, in [M/H].
+        Default is 0.
+
+    evo_model: model evolution class, optional
+        Set the stellar evolution model class. 
+        Default is evolution.MISTv1().
+
+    atm_func: model atmosphere function, optional
+        Set the stellar atmosphere models for the stars. 
+        Default is get_merged_atmosphere.
+
+    wd_atm_func: white dwarf model atmosphere function, optional
+        Set the stellar atmosphere models for the white dwafs. 
+        Default is get_wd_atmosphere   
+
+    mass_sampling : int, optional
+        Sample the raw isochrone every `mass_sampling` steps. The default
+        is mass_sampling = 0, which is the native isochrone mass sampling 
+        of the evolution model.
+
+    wave_range : list, optional
+        length=2 list with the wavelength min/max of the final spectra.
+        Units are Angstroms. Default is [3000, 52000].
+
+    min_mass : float or None, optional
+        If float, defines the minimum mass in the isochrone.
+        Unit is solar masses. Default is None
+
+    max_mass : float or None, optional
+        If float, defines the maxmimum mass in the isochrone.
+        Units is solar masses. Default is None.
+
+    rebin : boolean, optional
+        If true, rebins the atmospheres so that they are the same
+        resolution as the Castelli+04 atmospheres. Default is True.
+
+    atm_cache : AtmosphereCache object or None, optional
+        If defined, fetch the atmospheres through this on-disk
+        spectrum cache (see atmospheres.AtmosphereCache). 
+        Default is None.
+    """
+    def __init__(self, logAge, metallicity=0.0,
+                 evo_model=default_evo_model, atm_func=default_atm_func,
+                 wd_atm_func = default_wd_atm_func, mass_sampling=1,
+                 wave_range=[3000, 52000], min_mass=None, max_mass=None,
+                 rebin=True, atm_cache=None):
+        # AKs = 0 gives a reddening curve of exactly 1, so the red_law
+        # has no effect on the spectra.
+        Isochrone.__init__(self, logAge, 0.0, 10.0,
+                           metallicity=metallicity,
+                           evo_model=evo_model, atm_func=atm_func,
+                           wd_atm_func=wd_atm_func,
+                           mass_sampling=mass_sampling, wave_range=wave_range,
+                           min_mass=min_mass, max_mass=max_mass, rebin=rebin,
+                           atm_cache=atm_cache)
+        del self.points.meta['REDLAW']
+
+        # 2D (N_points x N_wave) array of the unreddened spectra at 10 pc.
+        self.wave, self.flux = spectra_to_array(self.spec_list)
+
+        return
+
+    def get_photometry_grid(self, AKs_arr, dist_arr, red_law=default_red_law,
+                            filters=['ubv,U', 'ubv,B', 'ubv,V',
+                                     'ubv,R', 'ubv,I'],
+                            rebin=True, vega=vega):
+        """
+        Make synthetic photometry over a grid of extinctions and distances.
+
+        For each extinction, the reddening curve is folded into the filter 
+        weights, so that the photometry for all the stars, extinctions and
+        filters is a single matrix product. The distance modulus is then 
+        added to the magnitudes.
+
+        Parameters
+        ----------
+        AKs_arr : array
+            Array of total extinctions in the Ks filter, in magnitudes
+
+        dist_arr : array
+            Array of distances, in pc
+
+        red_law : reddening law object, optional
+            Define the reddening law for the synthetic photometry.
+            Default is reddening.RedLawNishiyama09().
+
+        filters : array of strings, optional
+            Define what filters the synthetic photometry
+            will be calculated for, via the filter string 
+            identifier. 
+
+        Returns
+        -------
+        mags : array
+            Magnitudes with shape (N_AKs, N_dist, N_points, N_filters)
+        """
+        AKs_arr = np.atleast_1d(AKs_arr)
+        dist_arr = np.atleast_1d(dist_arr)
+
+        # Filter weights on the common wavelength grid.
+        weights = np.zeros((len(self.wave), len(filters)), dtype=float)
+        mag0 = np.zeros(len(filters), dtype=float)
+        for ff in range(len(filters)):
+            filt = get_filter_info(filters[ff], rebin=rebin, vega=vega)
+            weights[:, ff] = get_filter_weights(filt, self.wave)
+            mag0[ff] = filt.mag0
+
+        # Reddening curve for each extinction, shape (N_AKs x N_wave).
+        red = red_law.transmission(AKs_arr, self.wave)
+
+        # Reddened filter weights, shape (N_wave x N_AKs*N_filters).
+        red_weights = red.T[:, :, np.newaxis] * weights[:, np.newaxis, :]
+        red_weights = red_weights.reshape(len(self.wave), -1)
+
+        mags = mags_in_filters(self.flux, red_weights, np.tile(mag0, len(AKs_arr)))
+        mags = mags.reshape(len(self.flux), len(AKs_arr), len(filters))
+        mags = mags.transpose(1, 0, 2)
+
+        # Distance modulus relative to 10 pc
+        dist_mod = 5.0 * np.log10(dist_arr / 10.0)
+        mags = mags[:, np.newaxis, :, :] + dist_mod[np.newaxis, :, np.newaxis, np.newaxis]
+        
+        return mags
+
+    def make_isochrone_tables(self, AKs_arr, dist_arr, red_law=default_red_law,
+                              filters=['ubv,U', 'ubv,B', 'ubv,V',
+                                       'ubv,R', 'ubv,I'],
+                              rebin=True, vega=vega):
+        """
+        Make the isochrone photometry tables for a grid of extinctions and 
+        distances. The tables have the same columns and meta-data as 
+        IsochronePhot.points.
+
+        Parameters are the same as for get_photometry_grid.
+        
+        Returns
+        -------
+        tables : dictionary
+            Isochrone tables, keyed by (AKs, distance)
+        """
+        AKs_arr = np.atleast_1d(AKs_arr)
+        dist_arr = np.atleast_1d(dist_arr)
+
+        mags = self.get_photometry_grid(AKs_arr, dist_arr, red_law=red_law,
+                                        filters=filters, rebin=rebin, vega=vega)
+        col_names = ['m_' + get_filter_col_name(filt) for filt in filters]
+
+        tables = {}
+        for aa in range(len(AKs_arr)):
+            for dd in range(len(dist_arr)):
+                tab = self.points.copy()
+                tab.meta['REDLAW'] = red_law.name
+                tab.meta['AKS'] = AKs_arr[aa]
+                tab.meta['DISTANCE'] = dist_arr[dd]
+
+                for ff in range(len(filters)):
+                    tab.add_column(Column(mags[aa, dd, :, ff], name=col_names[ff]))
+
+                tables[(AKs_arr[aa], dist_arr[dd])] = tab
+
+        return tables
+
 #===================================================#
 # Iso table: same as IsochronePhot object, but doesn't do reddening application
 # or photometry automatically. These are separate functions on the object.
@@ -1284,10 +2473,8 @@ class iso_table(object):
             
         """
         self.AKs = np.ones(len(self.spec_list))
-        # Apply reddening to each object in the spec list
+        # Draw the extinction of each object in the spec list
         for i in range(len(self.spec_list)):
-            star = self.spec_list[i]
-
             # Calculate reddening at extinction value using defined
             # extinction law
             if dAKs != 0:
@@ -1310,12 +2497,23 @@ class iso_table(object):
             else:
                 AKs_act = AKs
 
-            red = extinction_law.reddening(AKs_act).resample(star.wave) 
-            star *= red
+            self.AKs[i] = AKs_act
+
+        # Get the reddening curves of all the stars at once. The spectra
+        # are usually all on the same wavelength grid.
+        wave = self.spec_list[0].wave
+        red_all = extinction_law.transmission(self.AKs, wave)
+        
+        for i in range(len(self.spec_list)):
+            star = self.spec_list[i]
+            if np.array_equal(star.wave, wave):
+                red = red_all[i]
+            else:
+                red = extinction_law.transmission(self.AKs[i], star.wave)
 
             # Update the spectrum in spec list
+            star *= spectrum.ArraySpectralElement(star.wave, red, waveunits='angstrom')
             self.spec_list[i] = star
-            self.AKs[i] = AKs_act
 
         # Update the table to reflect the AKs used
         self.points.meta['AKS'] = AKs
@@ -1373,6 +2571,20 @@ def get_filter_info(name, vega=vega, rebin=True):
     Define filter functions, setting ZP according to
     Vega spectrum. Input name is the popstar
     obs_string
+
+    Filters with the default Vega spectrum are only made once, and
+    are then fetched from filter_registry (see FilterRegistry).
+    """
+    if vega is filter_registry.vega:
+        return filter_registry.get_filter_info(name, rebin=rebin)
+    else:
+        return make_filter_info(name, vega=vega, rebin=rebin)
+
+def make_filter_info(name, vega=vega, rebin=True):
+    """ 
+    Make the filter function from the filter files, setting ZP 
+    according to Vega spectrum. Input name is the popstar
+    obs_string. Use get_filter_info instead, which caches the filters.
     """
     tmp = name.split(',')
     filterName = tmp[-1]
@@ -1458,6 +2670,200 @@ def get_filter_info(name, vega=vega, rebin=True):
 
     return filt
 
+class FilterRegistry(object):
+    """
+    Registry of the filter functions and their Vega zero-points, so that
+    each filter is only read from the filter files and integrated over 
+    Vega once.
+
+    The filters are kept in memory, keyed by (obs_string, rebin). Filters
+    from the filt_func files are also saved to disk, in one .npz file per 
+    facility (wave, throughput, flux0, mag0 for each filter). The .npz file
+    for a facility is remade when any of its filter files changes, or 
+    when it was made with a different Vega spectrum. Other filters 
+    (e.g. HST filters from pysynphot) are only kept in memory.
+
+    Parameters
+    ----------
+    cache_dir: path or None, optional
+        Directory to store the .npz files in. If None, 
+        use $POPSTAR_MODELS/filt_cache/ (or keep the filters in memory
+        only, if POPSTAR_MODELS is undefined). If the directory can't be
+        written to, the filters are only kept in memory.
+
+    vega: spectrum, optional
+        The Vega spectrum used for the zero-points.
+    """
+    def __init__(self, cache_dir=None, vega=vega):
+        if (cache_dir == None) and ('POPSTAR_MODELS' in os.environ):
+            cache_dir = os.environ['POPSTAR_MODELS'] + '/filt_cache/'
+            
+        self.cache_dir = cache_dir
+        self.vega = vega
+
+        # The zero-points depend on the Vega spectrum, so the .npz files
+        # are only used with the same one.
+        md5 = hashlib.md5()
+        md5.update(np.asarray(vega.wave, dtype=float).tobytes())
+        md5.update(np.asarray(vega.flux, dtype=float).tobytes())
+        self.vega_hash = md5.hexdigest()
+
+        self.hits = 0
+        self.misses = 0
+
+        # Filters by (name, rebin), and the .npz contents by facility.
+        self._filters = {}
+        self._facilities = {}
+
+        return
+
+    def get_filter_info(self, name, rebin=True):
+        """
+        Get the filter function, with flux0 and mag0 set, for the
+        popstar obs_string. Same as get_filter_info.
+        """
+        key = (name, rebin)
+        
+        if key in self._filters:
+            self.hits += 1
+        else:
+            self._filters[key] = self._get_entry(name, rebin)
+
+        wave, throughput, flux0, mag0, filt_name = self._filters[key]
+
+        filt = spectrum.ArraySpectralElement(wave, throughput, waveunits='angstrom',
+                                             name=filt_name)
+        filt.flux0 = flux0
+        filt.mag0 = mag0
+
+        return filt
+
+    def clear(self):
+        """
+        Empty the registry, including the files on disk.
+        """
+        if self.cache_dir != None:
+            for facility in self._facilities:
+                cache_file = self._get_cache_file(facility)
+                if os.path.exists(cache_file):
+                    os.remove(cache_file)
+
+        self._filters = {}
+        self._facilities = {}
+        self.hits = 0
+        self.misses = 0
+
+        return
+
+    def _get_entry(self, name, rebin):
+        """
+        Get the (wave, throughput, flux0, mag0, name) for a filter
+        from the .npz file, or make it.
+        """
+        facility = name.split(',')[0]
+        if facility not in filters.facility_dirs:
+            facility = None
+            
+        entry_key = '{0}__{1:d}'.format(name.replace(',', '__'), rebin)
+
+        if facility != None:
+            entries = self._get_facility(facility)
+            
+            if entry_key in entries:
+                self.hits += 1
+                return entries[entry_key]
+
+        # Make the filter from scratch
+        self.misses += 1
+        filt = make_filter_info(name, vega=self.vega, rebin=rebin)
+        entry = (np.array(filt.wave, dtype=float), np.array(filt.throughput, dtype=float),
+                 filt.flux0, filt.mag0, filt.name)
+
+        if facility != None:
+            entries[entry_key] = entry
+            self._save_facility(facility)
+
+        return entry
+    
+    def _get_cache_file(self, facility):
+        return '{0}/{1}.npz'.format(self.cache_dir, facility)
+
+    def _get_source_mtime(self, facility):
+        """
+        Latest modification time of the filter files for a facility.
+        """
+        mtime = 0
+        facility_dir = filters.filters_dir + '/' + filters.facility_dirs[facility]
+        
+        for root, dirs, files in os.walk(facility_dir):
+            for ff in files:
+                mtime = max(mtime, os.path.getmtime(os.path.join(root, ff)))
+
+        return mtime
+
+    def _get_facility(self, facility):
+        """
+        Load the filters for a facility from the .npz file, unless the
+        filter files have changed since it was made.
+        """
+        if facility in self._facilities:
+            return self._facilities[facility]
+
+        entries = {}
+
+        if (self.cache_dir != None) and os.path.exists(self._get_cache_file(facility)):
+            try:
+                data = np.load(self._get_cache_file(facility))
+                
+                if ((data['source_mtime'] >= self._get_source_mtime(facility)) and
+                    (str(data['vega_hash']) == self.vega_hash)):
+                    for key in data['keys']:
+                        info = data[key + '__info']
+                        entries[key] = (data[key + '__wave'], data[key + '__throughput'],
+                                        float(info[0]), float(info[1]), str(data[key + '__name']))
+            except Exception:
+                # Unreadable file; it will be remade.
+                entries = {}
+
+        self._facilities[facility] = entries
+
+        return entries
+
+    def _save_facility(self, facility):
+        """
+        Write all the filters for a facility to the .npz file. The file
+        is written to a temporary file and then renamed, so that other
+        processes never see a partially written file.
+        """
+        if self.cache_dir == None:
+            return
+        
+        entries = self._facilities[facility]
+        
+        arrays = {'keys': np.array(list(entries.keys())),
+                  'source_mtime': self._get_source_mtime(facility),
+                  'vega_hash': np.array(self.vega_hash)}
+        for key, entry in entries.items():
+            arrays[key + '__wave'] = entry[0]
+            arrays[key + '__throughput'] = entry[1]
+            arrays[key + '__info'] = np.array([entry[2], entry[3]])
+            arrays[key + '__name'] = np.array(entry[4])
+
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            
+            with atomic_write(self._get_cache_file(facility)) as tmp_file:
+                with open(tmp_file, 'wb') as _f:
+                    np.savez(_f, **arrays)
+        except OSError:
+            # Can't write the cache; keep the filters in memory only.
+            pass
+
+        return
+
+filter_registry = FilterRegistry()
+
 def get_filter_col_name(obs_str):
     """
     Get standard column name for synthetic photometry based on 
@@ -1548,11 +2954,18 @@ def make_isochrone_grid(age_arr, AKs_arr, dist_arr, evo_model=default_evo_model,
                         iso_dir = './', mass_sampling=1,
                         filters=['wfc3,ir,f127m',
                                  'wfc3,ir,f139m',
-                                 'wfc3,ir,f153m']):
+                                 'wfc3,ir,f153m'],
+                        n_workers=1):
     """
     Wrapper routine to generate a grid of isochrones of different ages,
     extinctions, and distances. 
 
+    The atmospheres are only made once per age (see IsochroneIntrinsic), 
+    and the extinctions and distances are then applied in bulk. 
+    Isochrones that already exist in iso_dir with the same models are 
+    skipped, and ones that are only missing some filters have them added. If an age
+    fails, the error is reported and the rest of the grid is still made.
+
     Parameters:
     ----------
     age_arr: array
@@ -1581,6 +2994,17 @@ def make_isochrone_grid(age_arr, AKs_arr, dist_arr, evo_model=default_evo_model,
 
     filters: dictionary
         Which filters to do the synthetic photometry on    
+
+    n_workers: int
+        Number of processes to make isochrones with; each process makes
+        the isochrones of one age (or, if there are more workers than ages,
+        some of them) at a time. If 1 (default), the isochrones are made 
+        serially in this process.
+
+    Returns
+    -------
+    failed: list
+        List of (logAge, AKs, distance) for the grid points that failed.
     """
     print( '**************************************')
     print( 'Start generating isochrones')
@@ -1588,21 +3012,81 @@ def make_isochrone_grid(age_arr, AKs_arr, dist_arr, evo_model=default_evo_model,
     print( 'Atmospheric Models adopted: {0}'.format(atm_func))
     print( 'Reddening Law adopted: {0}'.format(redlaw))
     print( 'Isochrone Mass sampling: {0}'.format(mass_sampling))
+    print( 'Number of workers: {0}'.format(n_workers))
     print( '**************************************')
 
-    num_models = len(age_arr) * len(AKs_arr) * len(dist_arr)
-    iteration = 0
-    #Loop structure: loop 1 = age, loop 2 = Aks, loop 3 = distance
+    # Make the iso_dir up front so the workers don't race to do it.
+    if not os.path.exists(iso_dir):
+        os.makedirs(iso_dir)
+
+    # Loop structure: loop 1 = age, loop 2 = Aks, loop 3 = distance
+    grid = []
     for i in range(len(age_arr)):
         for j in range(len(AKs_arr)):
             for k in range(len(dist_arr)):
-                    iso = IsochronePhot(age_arr[i], AKs_arr[j], dist_arr[k],
-                                        evo_model=evo_model, atm_func=atm_func,
-                                        red_law=redlaw, iso_dir=iso_dir,
-                                        mass_sampling=mass_sampling,
-                                        filters=filters)
-                    iteration += 1
-                    print( 'Done ' + str(iteration) + ' of ' + str(num_models))
+                grid.append((age_arr[i], AKs_arr[j], dist_arr[k]))
+    num_models = len(grid)
+
+    # Skip the isochrones that already exist with the same models, 
+    # unless they are missing some of the filters.
+    manifest = get_iso_manifest(iso_dir)
+    todo = []
+    for params in grid:
+        save_file, save_file_legacy = get_iso_save_file(iso_dir, *params)
+        record = manifest.get(save_file)
+        if record == None:
+            record = manifest.get(save_file_legacy)
+            
+        if ((record == None) or (not manifest.models_match(record, evo_model, atm_func, redlaw)) or
+            (len(manifest.missing_filters(record, filters)) > 0)):
+            todo.append(params)
+    print( 'Skipping {0} of {1} isochrones that already exist'.format(num_models - len(todo), num_models))
+
+    # Group the isochrones by age, so that the atmospheres are only
+    # made once per age. The extinction and distance are applied afterwards.
+    # If there are more workers than ages, each age's isochrones are split
+    # among the idle workers (each of which makes the atmospheres again).
+    kwargs = {'evo_model': evo_model, 'atm_func': atm_func, 'red_law': redlaw,
+              'iso_dir': iso_dir, 'mass_sampling': mass_sampling, 'filters': filters}
+    age_todo_list = []
+    for age in age_arr:
+        age_todo = [params for params in todo if params[0] == age]
+        if len(age_todo) > 0:
+            age_todo_list.append(age_todo)
+
+    n_split = max(1, n_workers // max(len(age_todo_list), 1))
+    tasks = []
+    for age_todo in age_todo_list:
+        for idx in np.array_split(np.arange(len(age_todo)), min(n_split, len(age_todo))):
+            tasks.append(([age_todo[ii] for ii in idx], kwargs))
+
+    failed = []
+    iteration = 0
+    t1 = time.time()
+    
+    if n_workers > 1:
+        pool = multiprocessing.Pool(processes=n_workers)
+        results = pool.imap_unordered(_make_isochrone_grid_age, tasks)
+    else:
+        pool = None
+        results = map(_make_isochrone_grid_age, tasks)
+
+    try:
+        for point_errs in results:
+            for params, err in point_errs:
+                iteration += 1
+                if err != None:
+                    failed.append(params)
+                    print( 'FAILED logAge = {0}, AKs = {1}, distance = {2}: {3}'.format(params[0], params[1],
+                                                                                       params[2], err))
+            print( 'Done {0} of {1} ({2:.0f} s elapsed)'.format(iteration, len(todo), time.time() - t1))
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+
+    if len(failed) > 0:
+        print( '{0} of {1} isochrones failed'.format(len(failed), len(todo)))
 
     # Also, save a README file in iso directory documenting the params used
     _out = open(iso_dir+'README.txt', 'w')
@@ -1612,7 +3096,285 @@ def make_isochrone_grid(age_arr, AKs_arr, dist_arr, evo_model=default_evo_model,
     _out.write('Reddening Law: {0}\n'.format(redlaw))
     _out.write('Isochrone Mass: {0}'.format(mass_sampling))
     _out.close()
-    return
+    
+    return failed
+
+def _make_isochrone_grid_age(task):
+    """
+    Helper function for make_isochrone_grid to make the isochrones
+    (logAge, AKs, distance) in age_todo, which all have the same age,
+    from one IsochroneIntrinsic. Errors are returned rather than raised, 
+    so that one bad isochrone doesn't stop the rest of the grid.
+
+    Returns
+    -------
+    point_errs: list
+        (params, err) for each isochrone, where err is None or the error message.
+    """
+    age_todo, kwargs = task
+    logAge = age_todo[0][0]
+    
+    try:
+        iso = IsochroneIntrinsic(logAge, evo_model=kwargs['evo_model'],
+                                 atm_func=kwargs['atm_func'],
+                                 mass_sampling=kwargs['mass_sampling'])
+
+        AKs_arr = np.unique([params[1] for params in age_todo])
+        dist_arr = np.unique([params[2] for params in age_todo])
+        tables = iso.make_isochrone_tables(AKs_arr, dist_arr, red_law=kwargs['red_law'],
+                                           filters=kwargs['filters'])
+    except Exception as e:
+        err = '{0}: {1}'.format(type(e).__name__, e)
+        return [(params, err) for params in age_todo]
+
+    point_errs = []
+    for params in age_todo:
+        try:
+            save_file, save_file_legacy = get_iso_save_file(kwargs['iso_dir'], *params)
+            table = tables[(params[1], params[2])]
+
+            # Add the new filters to an existing isochrone, keeping
+            # any other filters it already has. Isochrones made with other
+            # models are overwritten.
+            old_file = [ff for ff in [save_file, save_file_legacy] if os.path.exists(ff)]
+            if len(old_file) > 0:
+                old_table = Table.read(old_file[0])
+                same_models = all([old_table.meta.get(key) == table.meta.get(key)
+                                   for key in ['EVOMODEL', 'ATMFUNC', 'REDLAW', 'METAL_IN']])
+                if (same_models and (len(old_table) == len(table)) and
+                    np.allclose(old_table['mass'], table['mass'])):
+                    for col in table.colnames:
+                        if col not in old_table.colnames:
+                            old_table[col] = table[col]
+                    table = old_table
+                
+            write_iso_file(table, save_file)
+
+            err = None
+        except Exception as e:
+            err = '{0}: {1}'.format(type(e).__name__, e)
+
+        point_errs.append((params, err))
+
+    return point_errs
+
+class IsochronePhotGrid(object):
+    """
+    Interpolate the photometry of a grid of IsochronePhot files
+    (e.g. from make_isochrone_grid) to any (logAge, AKs, distance), 
+    without making new isochrones.
+
+    All of the isochrones in iso_dir with the requested metallicity 
+    are read into memory once. The magnitudes are then:
+
+    * shifted by the distance modulus from the closest grid distance (exact), 
+    * linearly interpolated in AKs,
+    * interpolated in mass along the two bracketing grid isochrones, 
+      and then linearly in logAge.
+
+    The age interpolation is the least accurate step, especially for 
+    fast evolutionary phases. Use get_interpolation_error() to compare it 
+    against the exact isochrones in the grid.
+
+    Parameters
+    ----------
+    iso_dir: path
+        Directory with the IsochronePhot files.
+
+    metallicity: float, optional
+        Only use isochrones with this metallicity, in [M/H]. Default is 0.
+
+    filters: list or None, optional
+        Filters to interpolate (e.g. ['wfc3,ir,f127m']). If None, use all
+        of the filters that are in every isochrone.
+    """
+    def __init__(self, iso_dir, metallicity=0.0, filters=None):
+        t1 = time.time()
+        
+        # Use the manifest to select the isochrones
+        manifest = get_iso_manifest(iso_dir)
+        iso_files = []
+        params = []
+        models = set()
+        records = []
+        for iso_file in glob.glob('{0}/iso_*.fits'.format(iso_dir)):
+            record = manifest.get(iso_file)
+
+            # Skip files that were removed since the glob.
+            if (record == None) or (not np.isclose(record['metallicity'], metallicity)):
+                continue
+            
+            iso_files.append(iso_file)
+            records.append(record)
+            params.append((record['logAge'], record['AKs'], record['distance']))
+            models.add((record['evo_model'], record['atm_func'], record['red_law']))
+
+        if len(iso_files) == 0:
+            raise ValueError('IsochronePhotGrid: no isochrones in {0}'.format(iso_dir))
+        if len(models) > 1:
+            raise ValueError('IsochronePhotGrid: isochrones in {0} use different '
+                             'models: {1}'.format(iso_dir, models))
+            
+        params = np.array(params, dtype=float)
+        self.log_age = np.unique(params[:, 0])
+        self.AKs = np.unique(params[:, 1])
+        self.distance = np.unique(params[:, 2])
+        
+        if filters == None:
+            self.filters = list(records[0]['filters'])
+            for record in records:
+                self.filters = [col for col in self.filters if col in record['filters']]
+        else:
+            self.filters = ['m_' + get_filter_col_name(filt) for filt in filters]
+
+            for record in records:
+                missing = manifest.missing_filters(record, filters)
+                if len(missing) > 0:
+                    raise ValueError('IsochronePhotGrid: {0} does not have the filters '
+                                     '{1}'.format(record['file'], missing))
+
+        isos = [Table.read(iso_file) for iso_file in iso_files]
+
+        # For each age, hold the masses and a (N_AKs x N_dist x N_points x N_filt)
+        # array of magnitudes. Missing grid points are NaN.
+        self.mass = [None] * len(self.log_age)
+        self.mags = [None] * len(self.log_age)
+        
+        for ii in range(len(isos)):
+            aa = np.searchsorted(self.log_age, params[ii, 0])
+            kk = np.searchsorted(self.AKs, params[ii, 1])
+            dd = np.searchsorted(self.distance, params[ii, 2])
+
+            mass = np.array(isos[ii]['mass'])
+            if self.mass[aa] is None:
+                self.mass[aa] = mass
+                self.mags[aa] = np.full((len(self.AKs), len(self.distance), len(mass), len(self.filters)),
+                                        np.nan, dtype=np.float32)
+            elif (len(mass) != len(self.mass[aa])) or not np.allclose(mass, self.mass[aa]):
+                raise ValueError('IsochronePhotGrid: isochrones at logAge = {0:.2f} have '
+                                 'different mass sampling'.format(self.log_age[aa]))
+
+            for ff in range(len(self.filters)):
+                self.mags[aa][kk, dd, :, ff] = isos[ii][self.filters[ff]]
+
+        t2 = time.time()
+        print( 'Loaded {0:d} isochrones in {1:.2f} s'.format(len(isos), t2 - t1))
+
+        return
+
+    def get_magnitudes(self, logAge, AKs, distance, mass=None):
+        """
+        Interpolate the grid photometry. 
+
+        Parameters
+        ----------
+        logAge: float
+            Age, in log(years)
+
+        AKs: float
+            Extinction in the Ks filter, in magnitudes
+
+        distance: float
+            Distance, in pc
+
+        mass: array or None, optional
+            Initial masses to return the magnitudes at, in solar masses. 
+            If None, use the masses of the closest grid isochrone.
+
+        Returns
+        -------
+        iso: astropy Table
+            Table with the mass and magnitude (m_*) columns. Masses outside 
+            of either bracketing isochrone have NaN magnitudes.
+        """
+        age_idx, age_wgt = self._bracket(self.log_age, logAge, 'logAge')
+
+        if mass is None:
+            mass = self.mass[age_idx[int(round(age_wgt))]]
+
+        mags = self._interpolate_age(age_idx, age_wgt, AKs, distance, mass)
+
+        iso = Table([mass], names=['mass'])
+        for ff in range(len(self.filters)):
+            iso[self.filters[ff]] = mags[:, ff]
+            
+        iso.meta['LOGAGE'] = logAge
+        iso.meta['AKS'] = AKs
+        iso.meta['DISTANCE'] = distance
+
+        return iso
+
+    def get_interpolation_error(self, logAge, AKs, distance):
+        """
+        Estimate the age interpolation error near logAge. The closest 
+        interior grid isochrone is predicted from its two neighbors, 
+        and compared to the exact isochrone.
+
+        Returns
+        -------
+        err: astropy Table
+            Median and maximum absolute magnitude difference 
+            for each filter, and the grid age used.
+        """
+        if len(self.log_age) < 3:
+            raise ValueError('IsochronePhotGrid: need at least 3 ages to estimate the interpolation error')
+        
+        aa = np.clip(np.argmin(np.abs(self.log_age - logAge)), 1, len(self.log_age) - 2)
+        age_wgt = ((self.log_age[aa] - self.log_age[aa-1]) /
+                   (self.log_age[aa+1] - self.log_age[aa-1]))
+
+        mag_exact = self._get_age_mags(aa, AKs, distance)
+        mag_interp = self._interpolate_age([aa-1, aa+1], age_wgt, AKs, distance, self.mass[aa])
+        diff = np.abs(mag_interp - mag_exact)
+        
+        err = Table([self.filters, np.nanmedian(diff, axis=0), np.nanmax(diff, axis=0)],
+                    names=['filter', 'median', 'max'])
+        err.meta['LOGAGE'] = self.log_age[aa]
+
+        return err
+
+    def _interpolate_age(self, age_idx, age_wgt, AKs, distance, mass):
+        mags = np.zeros((len(mass), len(self.filters)), dtype=float)
+
+        for aa, wgt in zip(age_idx, [1.0 - age_wgt, age_wgt]):
+            if wgt == 0:
+                continue
+
+            mag_age = self._get_age_mags(aa, AKs, distance)
+            for ff in range(len(self.filters)):
+                mags[:, ff] += wgt * np.interp(mass, self.mass[aa], mag_age[:, ff],
+                                               left=np.nan, right=np.nan)
+
+        return mags
+
+    def _get_age_mags(self, aa, AKs, distance):
+        """
+        Magnitudes of grid age aa at AKs and distance.
+        """
+        AKs_idx, AKs_wgt = self._bracket(self.AKs, AKs, 'AKs')
+
+        mags = np.zeros(self.mags[aa].shape[2:], dtype=float)
+        for kk, wgt in zip(AKs_idx, [1.0 - AKs_wgt, AKs_wgt]):
+            if wgt == 0:
+                continue
+            
+            # Shift from the closest grid distance
+            has_dist = np.where(np.isfinite(self.mags[aa][kk]).any(axis=(1, 2)))[0]
+            if len(has_dist) == 0:
+                msg = 'IsochronePhotGrid: no isochrone at logAge = {0:.2f}, AKs = {1:.2f}'
+                raise ValueError(msg.format(self.log_age[aa], self.AKs[kk]))
+            dd = has_dist[np.argmin(np.abs(np.log10(self.distance[has_dist] / distance)))]
+
+            mags += wgt * (self.mags[aa][kk, dd] + 5.0 * np.log10(distance / self.distance[dd]))
+
+        return mags
+
+    def _bracket(self, grid, value, name):
+        if (value < grid[0]) or (value > grid[-1]):
+            msg = 'IsochronePhotGrid: {0} = {1} is outside of the grid ({2} - {3})'
+            raise ValueError(msg.format(name, value, grid[0], grid[-1]))
+
+        return evolution.bracket_grid(grid, value)
 
 # Little helper utility to get the magnitude of an object through a filter.
 def mag_in_filter(star, filt):
@@ -1629,6 +3391,155 @@ def mag_in_filter(star, filt):
     star_mag = -2.5 * math.log10(star_flux / filt.flux0) + filt.mag0
     return star_mag
 
+def spectra_to_array(spec_list, wave=None):
+    """
+    Resample a list of spectra onto a single wavelength grid and
+    return them as a 2D flux array, for use with the batched
+    synthetic photometry functions.
+
+    Parameters
+    ----------
+    spec_list : list of pysynphot spectra
+        The spectra to tabulate (e.g. Isochrone.spec_list).
+
+    wave : array or None, optional
+        Wavelength grid to resample onto, in Angstroms. If None,
+        the wavelength array of the spectra is used, or the union 
+        of their wavelength arrays if they differ (e.g. for white
+        dwarf atmospheres), so that no spectrum is undersampled.
+
+    Returns
+    -------
+    wave : numpy array
+        The common wavelength grid, in Angstroms.
+
+    flux : 2D numpy array
+        Flux array of shape (N_spectra, N_wave) in flam
+        (erg s^-1 cm^-2 A^-1).
+    """
+    if wave is None:
+        # The distinct wavelength grids of the spectra
+        wave_list = []
+        for spec in spec_list:
+            spec_wave = np.asarray(spec.wave, dtype=float)
+            if not any([np.array_equal(spec_wave, ww) for ww in wave_list]):
+                wave_list.append(spec_wave)
+
+        if len(wave_list) == 1:
+            wave = wave_list[0]
+        else:
+            wave = np.unique(np.concatenate(wave_list))
+    wave = np.asarray(wave, dtype=float)
+
+    flux = np.empty((len(spec_list), len(wave)), dtype=float)
+    for ii in range(len(spec_list)):
+        # Spectra evaluate to photlam internally; convert to flam.
+        flux[ii] = spec_list[ii](wave)
+
+    flux = pysynphot.units.Photlam().ToFlam(wave, flux)
+
+    return wave, flux
+
+def get_filter_weights(filt, wave):
+    """
+    Calculate the weight vector for a filter on the wavelength grid
+    of a flux array made with spectra_to_array, such that the filter
+    flux is a dot product with the (piecewise-linear) spectrum.
+
+    This reproduces the binning done by pysynphot's Observation
+    (with binset=filt.wave) and the bin-width sum in mag_in_filter,
+    and includes the 1 / flux0 normalization of the filter.
+
+    Parameters
+    ----------
+    filt : pysynphot ArraySpectralElement
+        Filter object, as returned by get_filter_info.
+
+    wave : numpy array
+        Wavelength grid of the flux array, in Angstroms.
+
+    Returns
+    -------
+    weights : numpy array
+        Weights with the same length as wave.
+    """
+    wave = np.asarray(wave, dtype=float)
+    binwave = np.asarray(filt.wave, dtype=float)
+
+    # pysynphot integrates over a merged wavelength set that includes the
+    # bin centers and edges.
+    edges = binning.calculate_bin_edges(binwave)
+    spwave = np.union1d(np.union1d(wave, binwave), edges)
+
+    # The bin widths used in mag_in_filter.
+    dw = np.diff(binwave)
+    dw = np.append(dw, dw[-1])
+
+    # Assign each integration segment to a bin. Each bin contributes
+    # (mean flux in bin) * dw, converted from photlam to flam at the bin center.
+    seg_bin = np.searchsorted(edges, spwave[:-1], side='right') - 1
+    seg_good = (seg_bin >= 0) & (seg_bin < len(binwave))
+    seg_bin = np.clip(seg_bin, 0, len(binwave)-1)
+
+    bin_scale = dw / np.diff(edges) / binwave
+    seg_scale = np.where(seg_good, bin_scale[seg_bin], 0.0) * np.diff(spwave)
+
+    # Trapezoid integration: each node gets half of its two segments.
+    node_wgt = np.zeros(len(spwave), dtype=float)
+    node_wgt[:-1] += 0.5 * seg_scale
+    node_wgt[1:] += 0.5 * seg_scale
+
+    # Multiply by the throughput and the flam -> photlam conversion at each node.
+    node_wgt *= filt(spwave) * spwave
+
+    # Distribute the node weights onto the input grid, since the spectrum
+    # is linearly interpolated between grid points.
+    idx = np.searchsorted(wave, spwave, side='right') - 1
+    inside = (spwave >= wave[0]) & (spwave <= wave[-1])
+    idx = np.clip(idx, 0, len(wave)-2)
+    frac = (spwave - wave[idx]) / (wave[idx+1] - wave[idx])
+
+    weights = np.zeros(len(wave), dtype=float)
+    np.add.at(weights, idx[inside], node_wgt[inside] * (1.0 - frac[inside]))
+    np.add.at(weights, idx[inside]+1, node_wgt[inside] * frac[inside])
+
+    weights /= filt.flux0
+
+    return weights
+
+def mags_in_filters(flux, weights, mag0):
+    """
+    Calculate synthetic magnitudes for many spectra in many filters
+    with a single matrix product. Agrees with mag_in_filter to better
+    than 0.001 mag for smooth (e.g. rebinned atmosphere) spectra.
+
+    Parameters
+    ----------
+    flux : 2D numpy array
+        Flux array of shape (N_spectra, N_wave), from spectra_to_array.
+
+    weights : 2D numpy array
+        Filter weights of shape (N_wave, N_filters), where each column
+        is made with get_filter_weights.
+
+    mag0 : float or numpy array
+        Zero-point magnitude of each filter (filt.mag0).
+
+    Returns
+    -------
+    mags : 2D numpy array
+        Magnitudes of shape (N_spectra, N_filters). Spectra with no flux
+        in a filter get a magnitude of np.nan.
+    """
+    flux_filt = np.dot(flux, weights)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mags = -2.5 * np.log10(flux_filt) + mag0
+
+    mags[~np.isfinite(mags)] = np.nan
+
+    return mags
+
 def match_model_mass(isoMasses,theMass):
     dm = np.abs(isoMasses - theMass)
     mdx = dm.argmin()
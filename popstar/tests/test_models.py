@@ -135,3 +135,458 @@ def test_filters():
     print('Filters done')
 
     return
+
+def test_atmosphere_cache(tmp_path):
+    """
+    Test the on-disk atmosphere spectrum cache
+    """
+    from popstar import atmospheres
+    import pysynphot
+    import numpy as np
+    import os
+
+    # Use a blackbody "atmosphere" so that no model grids are needed
+    get_bb_atmosphere = atmospheres.get_bb_atmosphere
+    cache_dir = str(tmp_path)
+
+    cache = atmospheres.AtmosphereCache(cache_dir=cache_dir)
+    atm_func = cache.cached(get_bb_atmosphere)
+    assert atm_func.__name__ == 'get_bb_atmosphere'
+
+    sp1 = atm_func(temperature=5000, gravity=4.0, metallicity=0, rebin=True)
+    assert (cache.hits == 0) & (cache.misses == 1)
+    np.testing.assert_allclose(sp1.flux, get_bb_atmosphere(temperature=5000).flux, rtol=1e-12)
+
+    # The cached spectrum is the same, and by default nearby
+    # parameters are different entries.
+    sp2 = atm_func(temperature=5000, gravity=4.0, metallicity=0, rebin=True)
+    assert (cache.hits == 1) & (cache.misses == 1)
+    np.testing.assert_array_equal(sp1.flux, sp2.flux)
+    atm_func(temperature=5001, gravity=4.0, metallicity=0, rebin=True)
+    assert cache.misses == 2
+
+    # Different rebin is a different entry
+    sp3 = atm_func(temperature=5000, gravity=4.0, metallicity=0, rebin=False)
+    assert cache.misses == 3
+    np.testing.assert_allclose(sp3.flux, get_bb_atmosphere(temperature=5000, rebin=False).flux,
+                               rtol=1e-12)
+
+    # With rounding, nearby parameters are the same entry
+    cache_round = atmospheres.AtmosphereCache(cache_dir=cache_dir, teff_step=5.0, logg_step=0.01)
+    sp4 = cache_round.get_atmosphere(get_bb_atmosphere, temperature=5001, gravity=4.001, rebin=True)
+    assert (cache_round.hits == 1) & (cache_round.misses == 0)
+    np.testing.assert_array_equal(sp4.flux, sp1.flux)
+
+    # Spectra in other units are stored in flam
+    def get_photlam_atmosphere(metallicity=0, temperature=5000, gravity=4):
+        sp = pysynphot.spectrum.BlackBody(temperature)
+        sp.convert('photlam')
+        return sp
+
+    sp5 = cache.get_atmosphere(get_photlam_atmosphere, temperature=6000, gravity=4.0)
+    assert sp5.fluxunits.name == 'flam'
+    np.testing.assert_allclose(sp5.flux, get_bb_atmosphere(temperature=6000).flux)
+
+    # The cache files follow the umask
+    umask = os.umask(0o022)
+    try:
+        cache.get_atmosphere(get_bb_atmosphere, temperature=7000, gravity=4.0)
+    finally:
+        os.umask(umask)
+    key = cache.get_key('get_bb_atmosphere', 7000, 4.0, 0)
+    assert (os.stat('{0}/{1}.npy'.format(cache_dir, key)).st_mode & 0o777) == 0o644
+
+    # Size cap: only the most recent spectrum is kept
+    cache3 = atmospheres.AtmosphereCache(cache_dir=cache_dir, max_size=1)
+    cache3.get_atmosphere(get_bb_atmosphere, temperature=8000, gravity=4.0)
+    assert len(cache3._entries) == 1
+    assert len(os.listdir(cache_dir)) == 1
+
+    return
+
+def test_merged_atmospheres():
+    """
+    Test the array version of get_merged_atmosphere
+    """
+    from popstar import atmospheres
+    import numpy as np
+
+    temp = np.array([2000, 3200, 3500, 3500, 3800, 4000, 5250, 6000, 25000, np.nan])
+    grav = np.array([5.0, 5.0, 5.0, 2.0, 5.0, 4.0, 4.0, 4.0, 4.0, 4.0])
+
+    # Regimes follow the same logic as get_merged_atmosphere
+    regime = atmospheres.get_merged_atmosphere_regime(0, temp, grav)
+    good = ['BTSettl_2015', 'BTSettl_2015', 'BTSettl_phoenix', 'phoenixv16',
+            'phoenixv16', 'phoenixv16', 'atlas_phoenix', 'castelli', 'castelli', '']
+    np.testing.assert_array_equal(regime, good)
+
+    regime = atmospheres.get_merged_atmosphere_regime(-1.0, temp, grav)
+    assert (regime[:6] == 'phoenixv16').all()
+
+    # Use a blackbody "atmosphere" for every grid so that no model 
+    # grids are needed
+    get_bb_atmosphere = atmospheres.get_bb_atmosphere
+
+    grids_orig = atmospheres.merged_atmosphere_grids.copy()
+    try:
+        for name in atmospheres.merged_atmosphere_grids:
+            atmospheres.merged_atmosphere_grids[name] = (get_bb_atmosphere, True, 'bb')
+
+        wave, flux = atmospheres.get_merged_atmospheres(0, temp, grav)
+    finally:
+        atmospheres.merged_atmosphere_grids.update(grids_orig)
+
+    assert flux.shape == (len(temp), len(wave))
+    assert np.isnan(flux[-1]).all()
+    for ii in range(len(temp) - 1):
+        sp = get_bb_atmosphere(temperature=temp[ii])
+        np.testing.assert_allclose(flux[ii], sp.flux, rtol=1e-6)
+
+    return
+
+def test_atmosphere_grid(tmp_path):
+    """
+    Test the preloaded atmosphere flux cubes against pysynphot.Icat
+    """
+    from popstar import atmospheres
+    from astropy.table import Table
+    import pysynphot
+    import numpy as np
+    import os
+
+    # Make a small grid out of the [M/H] = -0.5 part of the Kurucz grid
+    k93_dir = '{0}/grid/k93models/'.format(os.environ['PYSYN_CDBS'])
+    catalog = Table.read(k93_dir + 'catalog.fits')
+    files = ['km05/km05_9500.fits', 'km05/km05_9750.fits']
+    idx = [ii for ii in range(len(catalog)) if catalog['FILENAME'][ii].split('[')[0] in files]
+    
+    grid_dir = str(tmp_path)
+    os.symlink(k93_dir + 'km05', grid_dir + '/km05')
+    catalog[idx].write(grid_dir + '/catalog.fits')
+
+    # Grids without a cube are remembered
+    atmospheres.atmosphere_grids.pop('k93models', None)
+    assert atmospheres.get_atmosphere_grid('k93models') == None
+    assert atmospheres.atmosphere_grids['k93models'] == None
+
+    grid = atmospheres.AtmosphereGrid('k93models', grid_dir=grid_dir)
+    assert not grid.exists()
+    umask = os.umask(0o022)
+    try:
+        grid.make_cube()
+    finally:
+        os.umask(umask)
+    assert grid.exists()
+    assert 'k93models' not in atmospheres.atmosphere_grids
+    assert (os.stat(grid.flux_file).st_mode & 0o777) == 0o644
+
+    # Single atmospheres match Icat, including on the grid points
+    for temp, logg in [(9600, 4.2), (9500, 4.2), (9750, 3.0), (9700, 4.5)]:
+        sp = grid.get_spectrum(metallicity=-0.5, temperature=temp, gravity=logg)
+        sp_icat = pysynphot.Icat('k93models', temp, -0.5, logg)
+        np.testing.assert_allclose(sp.flux, sp_icat.flux, rtol=1e-5)
+
+    # Out of bounds, like Icat
+    try:
+        grid.get_spectrum(metallicity=-0.5, temperature=12000, gravity=4.0)
+        assert False
+    except pysynphot.exceptions.ParameterOutOfBounds:
+        pass
+
+    # Many atmospheres at once
+    temp = np.array([9600, 9700, 12000])
+    logg = np.array([4.2, 3.3, 4.0])
+    flux, good = grid.get_fluxes(-0.5, temp, logg)
+    np.testing.assert_array_equal(good, [True, True, False])
+    assert np.isnan(flux[2]).all()
+    sp = grid.get_spectrum(metallicity=-0.5, temperature=9700, gravity=3.3)
+    np.testing.assert_allclose(flux[1], sp.flux)
+
+    return
+
+def test_atmosphere_catalog_index(tmp_path):
+    """
+    Test the parsed atmosphere catalog used for the grid bounds
+    """
+    from popstar import atmospheres
+    from astropy.table import Table
+    import numpy as np
+    import os
+
+    index = ['3000,0.0,3.0', '3000,0.0,5.0',
+             '3500,0.0,0.0', '3500,0.0,5.0',
+             '4000,0.0,0.0', '4000,0.0,4.5',
+             '3500,-1.0,1.0', '3500,-1.0,5.0']
+    catalog = Table([index, ['none.fits[g00]'] * len(index)], names=['INDEX', 'FILENAME'])
+
+    grid_dir = str(tmp_path)
+    catalog.write(grid_dir + '/catalog.fits')
+        
+    umask = os.umask(0o022)
+    try:
+        idx = atmospheres.AtmosphereCatalogIndex('test', grid_dir=grid_dir)
+    finally:
+        os.umask(umask)
+    assert os.path.exists(idx.index_file)
+    assert (os.stat(idx.index_file).st_mode & 0o777) == 0o644
+        
+    metal = np.array([0.1, 0.0, 0.0, -0.8])
+    temp = np.array([2500, 3900, 3700, 3600])
+    logg = np.array([2.0, 4.8, 4.0, 0.5])
+    temp_new, logg_new = idx.get_bounds(metallicity=metal, temperature=temp, gravity=logg)
+    np.testing.assert_array_equal(temp_new, [3000, 3900, 3700, 3500])
+    np.testing.assert_array_equal(logg_new, [3.0, 4.5, 4.0, 1.0])
+
+    # Read back from disk
+    idx2 = atmospheres.AtmosphereCatalogIndex('test', grid_dir=grid_dir)
+    np.testing.assert_array_equal(idx2.teff, idx.teff)
+    np.testing.assert_array_equal(idx2.logg_max, idx.logg_max)
+
+    return
+
+def test_isochrone_cache():
+    """
+    Test the in-memory cache of evolution model isochrones
+    """
+    from popstar import evolution
+    from astropy.table import Table
+    import numpy as np
+
+    class _CountingEvolution(evolution.StellarEvolution):
+        def __init__(self):
+            evolution.StellarEvolution.__init__(self, '', [6.0, 7.0, 8.0], [], [0.015])
+            self.n_read = 0
+
+        def _read_isochrone(self, full_iso_file):
+            self.n_read += 1
+            return Table([np.arange(3.0)], names=['mass'])
+
+    evo = _CountingEvolution()
+    cache = evolution.IsochroneCache(max_tables=2)
+
+    iso1 = cache.get_isochrone(evo, 0, 0, 'iso_6.00.fits')
+    iso1['mass'][0] = -1
+    iso2 = cache.get_isochrone(evo, 0, 0, 'iso_6.00.fits')
+    assert evo.n_read == 1
+    assert (cache.hits == 1) & (cache.misses == 1)
+
+    # Returned tables are copies
+    assert iso2['mass'][0] == 0
+
+    # Least recently used table is dropped
+    cache.get_isochrone(evo, 1, 0, 'iso_7.00.fits')
+    cache.get_isochrone(evo, 2, 0, 'iso_8.00.fits')
+    assert evo.n_read == 3
+    cache.get_isochrone(evo, 2, 0, 'iso_8.00.fits')
+    assert evo.n_read == 3
+    cache.get_isochrone(evo, 0, 0, 'iso_6.00.fits')
+    assert evo.n_read == 4
+
+    cache.clear()
+    assert (cache.hits == 0) & (cache.misses == 0)
+
+    return
+
+def test_packed_isochrones(tmp_path):
+    """
+    Test packing all MISTv1 ages for a metallicity into one file
+    """
+    from popstar import evolution
+    from astropy.table import Table
+    import numpy as np
+    import os
+
+    model_dir = str(tmp_path)
+    try:
+        evo = evolution.MISTv1()
+        evo.model_dir = model_dir + '/'
+        iso_dir = model_dir + '/iso/z015/'
+        os.makedirs(iso_dir)
+
+        # Fake MIST v1.2 isochrones with 79 columns
+        for log_age in [6.99, 7.00, 7.01]:
+            n_star = int(log_age * 100) - 690
+            iso = Table(np.random.rand(n_star, 79), names=['col{0}'.format(ii+1) for ii in range(79)])
+            iso['col2'] = log_age
+            iso['col79'] = [0, 6, 9] * (n_star // 3) + [0] * (n_star % 3)
+            iso.meta['SOURCE'] = 'fake'
+            iso.write('{0}/iso_{1:.2f}.fits'.format(iso_dir, log_age))
+
+        evolution.isochrone_cache.clear()
+        iso_fits = evo.isochrone(age=10**6.995)
+        assert evolution.get_packed_isochrones(iso_dir) == None
+
+        evo.pack_isochrones()
+        packed = evolution.get_packed_isochrones(iso_dir)
+        np.testing.assert_array_equal(packed.log_age, [6.99, 7.00, 7.01])
+        np.testing.assert_array_equal(packed.offsets, [0, 9, 19, 30])
+        assert len(packed.get_column('mass')) == 30
+        assert packed.get_column('phase').dtype.kind == 'i'
+        assert packed.get_column('isWR').dtype.kind == 'b'
+        assert packed.get_isochrone('iso_7.00.fits').meta['SOURCE'] == 'fake'
+
+        # Changed isochrone files are re-packed
+        iso_file = iso_dir + 'iso_7.00.fits'
+        os.utime(iso_file, ns=(0, os.stat(iso_file).st_mtime_ns + 10**9))
+        evolution.packed_isochrones.clear()
+        assert evolution.get_packed_isochrones(iso_dir) == None
+        evolution.packed_isochrones.clear()
+        packed = evolution.get_packed_isochrones(iso_dir, read_func=evo._read_isochrone_file)
+        assert packed.source_mtimes[1] == os.stat(iso_file).st_mtime_ns
+
+        # So are files packed with other column names
+        evolution.pack_isochrones(iso_dir, lambda iso_file: Table.read(iso_file))
+        assert 'EEP' not in evolution.get_packed_isochrones(iso_dir).col_names
+        evolution.packed_isochrones.clear()
+        packed = evolution.get_packed_isochrones(iso_dir, read_func=evo._read_isochrone_file)
+        assert 'EEP' in packed.col_names
+
+        # Isochrones now come from the packed file
+        for ff in os.listdir(iso_dir):
+            if ff.endswith('.fits'):
+                os.remove(iso_dir + ff)
+                
+        evolution.isochrone_cache.clear()
+        iso_packed = evo.isochrone(age=10**6.995)
+        assert iso_packed.colnames == iso_fits.colnames
+        for col in iso_fits.colnames:
+            assert iso_packed[col].dtype == iso_fits[col].dtype
+            np.testing.assert_array_equal(iso_packed[col], iso_fits[col])
+        assert iso_packed.meta['metallicity_act'] == iso_fits.meta['metallicity_act']
+    finally:
+        evolution.isochrone_cache.clear()
+
+    return
+
+def test_isochrone_interpolation(tmp_path):
+    """
+    Test interpolating MISTv1 isochrones in age and metallicity
+    """
+    from popstar import evolution
+    from astropy.table import Table
+    import numpy as np
+    import os
+
+    model_dir = str(tmp_path)
+    try:
+        evo = evolution.MISTv1()
+        evo.model_dir = model_dir + '/'
+
+        # Fake MIST v1.2 isochrones, where the EEPs shift with age and
+        # mass depends linearly on EEP, log(age) and metallicity.
+        for zz, z_dir in [(0.015, 'z015'), (0.024, 'z024')]:
+            os.makedirs(model_dir + '/iso/' + z_dir)
+            for log_age in [7.00, 7.01]:
+                eep = np.arange(10) + int(round(log_age * 100)) - 700
+                iso = Table(np.ones((len(eep), 79)), names=['col{0}'.format(ii+1) for ii in range(79)])
+                iso['col1'] = eep
+                iso['col2'] = log_age
+                iso['col3'] = eep + 10 * log_age + 100 * zz
+                iso['col79'] = 0.0
+                iso.write('{0}/iso/{1}/iso_{2:.2f}.fits'.format(model_dir, z_dir, log_age))
+
+        evolution.isochrone_cache.clear()
+
+        # Grid points come back unchanged
+        iso = evo.isochrone(age=1e7, metallicity=np.log10(0.015 / evo.z_solar), interpolate=True)
+        np.testing.assert_array_equal(iso['EEP'], np.arange(10))
+        np.testing.assert_allclose(iso['mass'], iso['EEP'] + 70.0 + 1.5)
+
+        # Halfway in age: only the common EEPs are kept
+        iso = evo.isochrone(age=10**7.005, metallicity=np.log10(0.015 / evo.z_solar), interpolate=True)
+        np.testing.assert_array_equal(iso['EEP'], np.arange(1, 10))
+        np.testing.assert_allclose(iso['mass'], iso['EEP'] + 70.05 + 1.5)
+        np.testing.assert_allclose(iso['logAge'], 7.005)
+        
+        # Halfway in age and metallicity
+        feh = np.log10(np.array([0.015, 0.024]) / evo.z_solar)
+        iso = evo.isochrone(age=10**7.005, metallicity=feh.mean(), interpolate=True)
+        np.testing.assert_allclose(iso['mass'], iso['EEP'] + 70.05 + 1.95)
+        np.testing.assert_allclose(iso.meta['metallicity_act'], feh.mean())
+    finally:
+        evolution.isochrone_cache.clear()
+
+    return
+
+def test_red_law_transmission():
+    """
+    Test that the batched reddening curves match pysynphot's
+    reddening() for every law.
+    """
+    from popstar import reddening
+    import numpy as np
+
+    laws = [reddening.RedLawNishiyama09(), reddening.RedLawCardelli(3.1),
+            reddening.RedLawRomanZuniga07(), reddening.RedLawRiekeLebofsky(),
+            reddening.RedLawDamineli16(), reddening.RedLawDeMarchi16(),
+            reddening.RedLawFitzpatrick09(2.5, 3.1), reddening.RedLawSchlafly16(1.8, 0.5),
+            reddening.RedLawPowerLaw(2.0, 2.12), reddening.RedLawFritz11(),
+            reddening.RedLawHosek18(), reddening.RedLawHosek18b(),
+            reddening.RedLawNoguerasLara18()]
+
+    wave = np.linspace(3000, 52000, 5000)
+    AKs = np.array([0.0, 0.5, 2.7])
+    
+    for law in laws:
+        trans = law.transmission(AKs, wave)
+        assert trans.shape == (len(AKs), len(wave))
+        
+        for aa in range(len(AKs)):
+            trans_good = law.reddening(AKs[aa]).resample(wave).throughput
+            np.testing.assert_allclose(trans[aa], trans_good, rtol=1e-10)
+            np.testing.assert_allclose(law.transmission(AKs[aa], wave), trans_good, rtol=1e-10)
+
+    # N09 is normalized at 2.14 microns
+    law = laws[0]
+    np.testing.assert_allclose(law.get_law(np.array([21400.0])), 1.0, rtol=1e-6)
+
+    # Each wavelength grid is only interpolated once
+    nodes = law._get_wave_nodes(wave)
+    assert law._get_wave_nodes(wave.copy()) is nodes
+    
+    return
+
+def test_red_law_nearest():
+    """
+    Test the array lookup of the law at the closest tabulated wavelength.
+    """
+    from popstar import reddening
+    import numpy as np
+
+    law = reddening.RedLawHosek18b()
+    wave = np.sort(law.wave) * 10**-4
+
+    # Random wavelengths, law points, and midpoints between law points
+    wavelength = np.concatenate([np.random.uniform(wave[0], wave[-1], 100),
+                                 wave[::50], 0.5 * (wave[1:] + wave[:-1])[::50]])
+    
+    A_good = []
+    for ii in wavelength:
+        idx = np.where( abs(wave - ii) == min(abs(wave - ii)) )
+        A_good.append(law.obscuration[np.argsort(law.wave)][idx][0])
+
+    np.testing.assert_array_equal(law.Hosek18b(wavelength, 2.0), np.array(A_good) * 2.0)
+    np.testing.assert_array_equal(law.Hosek18b(2.14, 1.0), law.get_law_nearest([2.14]))
+
+    return
+
+def test_get_red_law():
+    """
+    Test that get_red_law reuses the law objects.
+    """
+    from popstar import reddening
+    import pickle
+    import numpy as np
+
+    law = reddening.get_red_law('C89,3.1')
+    assert law.name == 'C89,3.1'
+    assert reddening.get_red_law('C89,3.10') is law
+    assert reddening.get_red_law('C89,4.0') is not law
+    assert reddening.get_red_law('N09') is reddening.get_red_law('N09')
+
+    # Laws can still be sent to other processes
+    wave = np.linspace(5000, 20000, 100)
+    law_copy = pickle.loads(pickle.dumps(law))
+    np.testing.assert_array_equal(law_copy.transmission(1.0, wave), law.transmission(1.0, wave))
+
+    return
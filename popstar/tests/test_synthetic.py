@@ -2,6 +2,7 @@ import time
 import pylab as plt
 import numpy as np
 from popstar import synthetic, reddening, evolution, atmospheres
+from popstar.atmospheres import get_bb_atmosphere
 import pysynphot
 import os
 import pdb
@@ -186,6 +187,511 @@ def test_IsochronePhot(plot=False):
 
     return
 
+def test_batch_photometry():
+    """
+    Test that the matrix-based synthetic photometry (used by 
+    IsochronePhot.make_photometry) matches mag_in_filter.
+    """
+    from popstar import synthetic as syn
+    from popstar import reddening
+    from pysynphot import spectrum
+
+    red_law = reddening.RedLawNishiyama09()
+    
+    # Make some test spectra: blackbodies with and without reddening, and Vega
+    spec_list = []
+    for temp in [3000, 6000, 15000, 30000]:
+        bb = pysynphot.spectrum.BlackBody(temp)
+        bb.convert('flam')
+        bb = spectrum.trimSpectrum(bb, 3000, 52000)
+        bb *= 1e-20
+        spec_list.append(bb)
+        spec_list.append(bb * red_law.reddening(2.7).resample(bb.wave))
+    spec_list.append(spectrum.trimSpectrum(syn.vega, 3000, 52000))
+
+    # Spectra on different grids: a coarse one first, and a line-rich 
+    # one on a fine grid, which must not be sampled on the coarse grid.
+    bb = spec_list[2]
+    wave_coarse = np.arange(3000, 52001, 200.0)
+    wave_fine = np.arange(3000, 52001, 2.0)
+    lines = 1 - 0.9 * (np.sin(wave_fine / 7.0)**20)
+    for wave, flux in [(wave_coarse, bb(wave_coarse)), (wave_fine, bb(wave_fine) * lines)]:
+        sp = spectrum.ArraySourceSpectrum(wave=wave, flux=flux, fluxunits='photlam')
+        sp.convert('flam')
+        spec_list.append(sp)
+    spec_list.insert(0, spec_list.pop(-2))
+
+    filt_list = ['nirc2,J', 'nirc2,Kp', '2mass,H', 'ubv,V', 'jwst,F200W']
+
+    wave, flux = syn.spectra_to_array(spec_list)
+    assert flux.shape == (len(spec_list), len(wave))
+
+    weights = np.zeros((len(wave), len(filt_list)), dtype=float)
+    mag0 = np.zeros(len(filt_list), dtype=float)
+    mag_good = np.zeros((len(spec_list), len(filt_list)), dtype=float)
+    
+    for ff in range(len(filt_list)):
+        filt = syn.get_filter_info(filt_list[ff])
+        weights[:, ff] = syn.get_filter_weights(filt, wave)
+        mag0[ff] = filt.mag0
+
+        for ss in range(len(spec_list)):
+            mag_good[ss, ff] = syn.mag_in_filter(spec_list[ss], filt)
+
+    mag_test = syn.mags_in_filters(flux, weights, mag0)
+
+    np.testing.assert_allclose(mag_test, mag_good, rtol=0, atol=1e-3)
+
+    return
+
+class _FakeEvolution(object):
+    """
+    Evolution model with a few main sequence stars, so that
+    isochrones can be made without the model grids.
+    """
+    def isochrone(self, age=1e8, metallicity=0.0):
+        from astropy.table import Table
+
+        mass = np.array([0.5, 1.0, 2.0, 5.0, 10.0])
+        iso = Table([mass, mass, np.log10(mass**3.5), np.log10(5800 * mass**0.6),
+                     np.repeat(4.4, len(mass)), np.zeros(len(mass), dtype=int),
+                     np.zeros(len(mass), dtype=bool)],
+                    names=['mass', 'mass_current', 'logL', 'logT', 'logg', 'phase', 'isWR'])
+        iso.meta['metallicity_in'] = metallicity
+        iso.meta['metallicity_act'] = metallicity
+        
+        return iso
+
+def test_filter_registry(tmp_path):
+    """
+    Test that the filter registry gives the same filters as
+    make_filter_info, and that the disk cache is reused and remade.
+    """
+    cache_dir = str(tmp_path)
+    registry = synthetic.FilterRegistry(cache_dir=cache_dir)
+
+    for name in ['nirc2,J', 'ubv,V']:
+        filt_good = synthetic.make_filter_info(name)
+        filt = registry.get_filter_info(name)
+
+        np.testing.assert_array_equal(filt.wave, filt_good.wave)
+        np.testing.assert_array_equal(filt.throughput, filt_good.throughput)
+        assert filt.flux0 == filt_good.flux0
+        assert filt.mag0 == filt_good.mag0
+
+    assert (registry.hits == 0) & (registry.misses == 2)
+    registry.get_filter_info('nirc2,J')
+    assert registry.hits == 1
+
+    assert os.path.exists(cache_dir + '/nirc2.npz')
+        
+    # A new registry reads the filters from disk
+    registry = synthetic.FilterRegistry(cache_dir=cache_dir)
+    filt = registry.get_filter_info('nirc2,J')
+    assert (registry.hits == 1) & (registry.misses == 0)
+
+    # rebin is a different filter
+    registry.get_filter_info('nirc2,J', rebin=False)
+    assert registry.misses == 1
+
+    # Out of date files are remade
+    data = dict(np.load(cache_dir + '/nirc2.npz'))
+    data['source_mtime'] = 0
+    np.savez(cache_dir + '/nirc2.npz', **data)
+        
+    registry = synthetic.FilterRegistry(cache_dir=cache_dir)
+    registry.get_filter_info('nirc2,J')
+    assert registry.misses == 1
+
+    # Files made with another Vega spectrum are remade
+    vega2 = synthetic.vega * 2
+    registry = synthetic.FilterRegistry(cache_dir=cache_dir, vega=vega2)
+    filt = registry.get_filter_info('nirc2,J')
+    assert registry.misses == 1
+    assert filt.flux0 == synthetic.make_filter_info('nirc2,J', vega=vega2).flux0
+
+    return
+
+def test_IsochroneIntrinsic(tmp_path):
+    """
+    Test that the photometry derived from the intrinsic isochrone
+    matches IsochronePhot at each extinction and distance.
+    """
+    red_law = reddening.RedLawNishiyama09()
+    filt_list = ['nirc2,J', 'nirc2,Kp', 'ubv,V']
+    AKs_arr = [0.0, 1.5]
+    dist_arr = [1000, 8000]
+
+    iso = synthetic.IsochroneIntrinsic(7.0, evo_model=_FakeEvolution(),
+                                       atm_func=get_bb_atmosphere)
+    assert iso.flux.shape == (len(iso.points), len(iso.wave))
+
+    mags = iso.get_photometry_grid(AKs_arr, dist_arr, red_law=red_law, filters=filt_list)
+    assert mags.shape == (2, 2, len(iso.points), len(filt_list))
+    tables = iso.make_isochrone_tables(AKs_arr, dist_arr, red_law=red_law, filters=filt_list)
+
+    iso_dir = str(tmp_path) + '/'
+    for AKs in AKs_arr:
+        for dist in dist_arr:
+            iso_good = synthetic.IsochronePhot(7.0, AKs, dist, evo_model=_FakeEvolution(),
+                                               atm_func=get_bb_atmosphere, red_law=red_law,
+                                               iso_dir=iso_dir, filters=filt_list)
+            tab = tables[(AKs, dist)]
+            assert tab.meta['AKS'] == AKs
+            assert tab.meta['DISTANCE'] == dist
+            assert tab.meta['REDLAW'] == iso_good.points.meta['REDLAW']
+                
+            for col in ['m_nirc2_J', 'm_nirc2_Kp', 'm_ubv_V']:
+                np.testing.assert_allclose(tab[col], iso_good.points[col], rtol=0, atol=1e-6)
+
+    # make_isochrone_grid should write the same isochrones
+    grid_dir = iso_dir + 'grid/'
+    failed = synthetic.make_isochrone_grid([7.0], AKs_arr, dist_arr, evo_model=_FakeEvolution(),
+                                           atm_func=get_bb_atmosphere, redlaw=red_law,
+                                           iso_dir=grid_dir, filters=filt_list)
+    assert failed == []
+        
+    iso_grid = synthetic.IsochronePhot(7.0, 1.5, 8000, evo_model=_FakeEvolution(),
+                                       atm_func=get_bb_atmosphere, red_law=red_law,
+                                       iso_dir=grid_dir, filters=filt_list)
+    assert iso_grid.recalc == False
+    np.testing.assert_allclose(iso_grid.points['m_nirc2_Kp'], tables[(1.5, 8000)]['m_nirc2_Kp'])
+
+    return
+
+def test_IsochronePhot_add_filters(tmp_path):
+    """
+    Test that filters missing from a saved isochrone are added to it,
+    without changing the existing ones.
+    """
+    from astropy.table import Table
+
+    red_law = reddening.RedLawNishiyama09()
+    kwargs = {'evo_model': _FakeEvolution(), 'atm_func': get_bb_atmosphere,
+              'red_law': red_law}
+
+    iso_dir = str(tmp_path) + '/'
+    iso_good = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir + 'good/',
+                                       filters=['nirc2,J', 'nirc2,Kp'], **kwargs)
+
+    iso = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir,
+                                  filters=['nirc2,J'], **kwargs)
+    assert iso.recalc == True
+        
+    iso = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir,
+                                  filters=['nirc2,J', 'nirc2,Kp'], **kwargs)
+    assert iso.recalc == True
+    assert iso.missing_filters == ['nirc2,Kp']
+
+    saved = Table.read(iso.save_file)
+    for col in ['m_nirc2_J', 'm_nirc2_Kp']:
+        np.testing.assert_allclose(saved[col], iso_good.points[col], rtol=0, atol=1e-6)
+
+    iso = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir,
+                                  filters=['nirc2,Kp'], **kwargs)
+    assert iso.recalc == False
+
+    # make_isochrone_grid adds the missing filters too, and keeps
+    # the filters that weren't asked for.
+    failed = synthetic.make_isochrone_grid([7.0], [1.0], [4000], evo_model=_FakeEvolution(),
+                                           atm_func=get_bb_atmosphere, redlaw=red_law,
+                                           iso_dir=iso_dir, filters=['ubv,V'])
+    assert failed == []
+    saved = Table.read(iso.save_file)
+    assert 'm_ubv_V' in saved.colnames
+    np.testing.assert_allclose(saved['m_nirc2_Kp'], iso_good.points['m_nirc2_Kp'],
+                               rtol=0, atol=1e-6)
+
+    return
+
+def test_IsochronePhot_spectra(tmp_path):
+    """
+    Test that the spectra saved with an isochrone are used to remake
+    spec_list and to add filters, without making any atmospheres.
+    """
+    from astropy.table import Table
+    from popstar.imf import imf
+
+    n_atm = [0]
+    def get_counted_atmosphere(**kwargs):
+        n_atm[0] += 1
+        return get_bb_atmosphere(**kwargs)
+    get_counted_atmosphere.__name__ = 'get_bb_atmosphere'
+
+    kwargs = {'evo_model': _FakeEvolution(), 'atm_func': get_counted_atmosphere}
+
+    iso_dir = str(tmp_path) + '/'
+    iso_good = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir + 'good/',
+                                       filters=['nirc2,J', 'nirc2,Kp'], **kwargs)
+
+    umask = os.umask(0o022)
+    try:
+        iso1 = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir, filters=['nirc2,J'],
+                                       save_spectra=True, **kwargs)
+    finally:
+        os.umask(umask)
+    flux_file, axes_file = synthetic.get_iso_spectra_files(iso1.save_file)
+    for ff in [flux_file, axes_file]:
+        assert (os.stat(ff).st_mode & 0o777) == 0o644
+
+    n_atm[0] = 0
+    iso2 = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir,
+                                   filters=['nirc2,J', 'nirc2,Kp'], **kwargs)
+    assert n_atm[0] == 0
+    assert os.path.exists(flux_file) & os.path.exists(axes_file)
+    assert iso2.spec_list.flux.dtype == np.float32
+    assert len(iso2.spec_list) == len(iso1.spec_list)
+    np.testing.assert_allclose(iso2.spec_list[2](iso1.wave), iso1.spec_list[2](iso1.wave),
+                               rtol=1e-6)
+    for col in ['m_nirc2_J', 'm_nirc2_Kp']:
+        np.testing.assert_allclose(iso2.points[col], iso_good.points[col], rtol=0, atol=1e-5)
+
+    # The spectra can be used in place of the original ones.
+    imf_in = imf.IMF_broken_powerlaw(np.array([0.4, 1.0, 12.0]), np.array([-1.3, -2.3]))
+    cluster1 = synthetic.UnresolvedCluster(iso1, imf_in, 1e4, mode='expectation')
+    cluster2 = synthetic.UnresolvedCluster(iso2, imf_in, 1e4, mode='expectation')
+    np.testing.assert_allclose(cluster2.spec_tot_full, cluster1.spec_tot_full, rtol=1e-6)
+
+    # Remaking the isochrone without saving the spectra removes them.
+    synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir, filters=['nirc2,J'],
+                            recomp=True, **kwargs)
+    assert not os.path.exists(flux_file)
+    assert synthetic.read_iso_spectra(iso1.save_file) == None
+
+    # So does writing another isochrone to the same file
+    # (e.g. with make_isochrone_grid).
+    synthetic.write_iso_spectra(iso1.wave, iso1.flux, iso1.save_file)
+    synthetic.write_iso_file(iso_good.points, iso1.save_file)
+    assert synthetic.read_iso_spectra(iso1.save_file) == None
+
+    # The spectra of a saved isochrone that has all of the filters are 
+    # made and saved, without rewriting the isochrone.
+    mtime = os.stat(iso1.save_file).st_mtime_ns
+    iso3 = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir, filters=['nirc2,J'],
+                                   save_spectra=True, **kwargs)
+    assert os.stat(iso1.save_file).st_mtime_ns == mtime
+    assert len(synthetic.read_iso_spectra(iso1.save_file)) == len(iso3.points)
+
+    # Filters added to a legacy isochrone from its spectra: the
+    # spectra are saved with the new isochrone file.
+    legacy_dir = iso_dir + 'legacy/'
+    iso4 = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=legacy_dir, filters=['nirc2,J'],
+                                   save_spectra=True, **kwargs)
+    os.rename(iso4.save_file, iso4.save_file_legacy)
+    for ff, ff_legacy in zip(synthetic.get_iso_spectra_files(iso4.save_file),
+                             synthetic.get_iso_spectra_files(iso4.save_file_legacy)):
+        os.rename(ff, ff_legacy)
+
+    n_atm[0] = 0
+    iso5 = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=legacy_dir,
+                                   filters=['nirc2,J', 'nirc2,Kp'], save_spectra=True, **kwargs)
+    assert n_atm[0] == 0
+    assert 'm_nirc2_Kp' in Table.read(iso5.save_file).colnames
+    assert len(synthetic.read_iso_spectra(iso5.save_file)) == len(iso5.points)
+
+    return
+
+class _BrokenEvolution(object):
+    """
+    Evolution model that always fails, for testing make_isochrone_grid.
+    """
+    def isochrone(self, age=1e8, metallicity=0.0):
+        raise ValueError('No model for age {0:.1e}'.format(age))
+
+def test_make_isochrone_grid(tmp_path, monkeypatch):
+    """
+    Test that failed grid points are reported, not raised,
+    in both serial and parallel mode.
+    """
+    iso_dir = str(tmp_path) + '/'
+    for n_workers in [1, 2]:
+        failed = synthetic.make_isochrone_grid([6.5, 7.0], [0.0], [1000],
+                                               evo_model=_BrokenEvolution(),
+                                               iso_dir=iso_dir, n_workers=n_workers)
+        assert sorted(failed) == [(6.5, 0.0, 1000), (7.0, 0.0, 1000)]
+        assert os.path.exists(iso_dir + 'README.txt')
+
+    # Failures are reported per isochrone, also when the
+    # isochrones of an age are split among the workers.
+    good_dir = iso_dir + 'good/'
+    bad_file = synthetic.get_iso_save_file(good_dir, 7.0, 1.0, 4000)[0]
+    write_iso_file = synthetic.write_iso_file
+    def write_iso_file_broken(points, save_file):
+        if save_file == bad_file:
+            raise OSError('Disk full')
+        write_iso_file(points, save_file)
+    monkeypatch.setattr(synthetic, 'write_iso_file', write_iso_file_broken)
+
+    for n_workers in [4, 1]:
+        failed = synthetic.make_isochrone_grid([7.0], [0.0, 1.0], [1000, 4000],
+                                               evo_model=_FakeEvolution(),
+                                               atm_func=get_bb_atmosphere, iso_dir=good_dir,
+                                               filters=['nirc2,J'], n_workers=n_workers)
+        assert failed == [(7.0, 1.0, 4000)]
+        assert os.path.exists(synthetic.get_iso_save_file(good_dir, 7.0, 1.0, 1000)[0])
+
+    return
+
+class _OtherEvolution(_FakeEvolution):
+    """
+    A different evolution model, for testing that isochrones made
+    with another model are remade.
+    """
+    pass
+
+def test_make_isochrone_grid_models(tmp_path):
+    """
+    Test that make_isochrone_grid remakes isochrones from other models,
+    and that the files follow the umask.
+    """
+    iso_dir = str(tmp_path) + '/'
+    kwargs = {'atm_func': get_bb_atmosphere, 'iso_dir': iso_dir, 'filters': ['nirc2,J']}
+
+    umask = os.umask(0o022)
+    try:
+        assert synthetic.make_isochrone_grid([7.0], [1.0], [4000], evo_model=_FakeEvolution(),
+                                             **kwargs) == []
+    finally:
+        os.umask(umask)
+
+    save_file = synthetic.get_iso_save_file(iso_dir, 7.0, 1.0, 4000)[0]
+    assert (os.stat(save_file).st_mode & 0o777) == 0o644
+    mtime = os.stat(save_file).st_mtime_ns
+
+    # Same models: skipped
+    synthetic.make_isochrone_grid([7.0], [1.0], [4000], evo_model=_FakeEvolution(), **kwargs)
+    assert os.stat(save_file).st_mtime_ns == mtime
+
+    # Other evolution model: remade, not merged into the old file
+    synthetic.make_isochrone_grid([7.0], [1.0], [4000], evo_model=_OtherEvolution(), **kwargs)
+    assert os.stat(save_file).st_mtime_ns != mtime
+    record = synthetic.get_iso_manifest(iso_dir).get(save_file)
+    assert record['evo_model'] == '_OtherEvolution'
+
+    return
+
+def test_IsochroneManifest(tmp_path):
+    """
+    Test that the iso_dir manifest tracks new, legacy and changed 
+    isochrone files, and that check_save_file uses it.
+    """
+    from astropy.table import Table
+
+    iso_dir = str(tmp_path) + '/'
+    iso = Table([[1.0, 2.0], [20.0, 19.0]], names=['mass', 'm_hst_f127m'])
+    iso.meta = {'LOGAGE': 6.5, 'AKS': 1.0, 'DISTANCE': 8000,
+                'EVOMODEL': '_BrokenEvolution', 'ATMFUNC': 'get_merged_atmosphere',
+                'REDLAW': 'N09'}
+    save_file, _ = synthetic.get_iso_save_file(iso_dir, 6.5, 1.0, 8000)
+    synthetic.write_iso_file(iso, save_file)
+
+    # Written without going through write_iso_file
+    legacy_file = iso_dir + 'iso_7.00_1.00_08000.fits'
+    iso.meta['LOGAGE'] = 7.0
+    iso.write(legacy_file)
+
+    # Read from the manifest file by a new manifest
+    manifest = synthetic.IsochroneManifest(iso_dir)
+    assert list(manifest.entries.keys()) == [os.path.basename(save_file)]
+    record = manifest.get(save_file)
+    assert record['logAge'] == 6.5
+    assert record['metallicity'] == 0.0
+    assert record['filters'] == ['m_hst_f127m']
+    assert manifest.verify(save_file)
+
+    missing = manifest.missing_filters(record, ['wfc3,ir,f127m', 'wfc3,ir,f153m'])
+    assert missing == ['wfc3,ir,f153m']
+
+    assert manifest.get(iso_dir + 'iso_8.00_1.00_08000.fits') == None
+    assert manifest.get(legacy_file)['logAge'] == 7.0
+
+    # Changed files are re-indexed
+    iso['m_hst_f153m'] = [18.0, 17.0]
+    iso.meta['LOGAGE'] = 6.5
+    iso.write(save_file, overwrite=True)
+    assert not manifest.verify(save_file)
+    record = manifest.get(save_file)
+    assert record['filters'] == ['m_hst_f127m', 'm_hst_f153m']
+    assert manifest.verify(save_file)
+
+    # A manifest that can't be written keeps the records in memory
+    manifest = synthetic.IsochroneManifest(iso_dir)
+    manifest.manifest_file = str(tmp_path / 'read_only' / 'manifest.jsonl')
+    os.remove(legacy_file)
+    iso.meta['LOGAGE'] = 7.0
+    iso.write(legacy_file)
+    assert manifest.get(legacy_file)['filters'] == ['m_hst_f127m', 'm_hst_f153m']
+        
+    # check_save_file
+    iso_phot = synthetic.IsochronePhot.__new__(synthetic.IsochronePhot)
+    iso_phot.save_file, iso_phot.save_file_legacy = synthetic.get_iso_save_file(iso_dir, 6.5, 1.0, 8000)
+    iso_phot.filters = ['wfc3,ir,f127m', 'nirc2,Kp']
+    assert iso_phot.check_save_file(_BrokenEvolution(), atmospheres.get_merged_atmosphere,
+                                    reddening.RedLawNishiyama09())
+    assert iso_phot.missing_filters == ['nirc2,Kp']
+    assert not iso_phot.check_save_file(_BrokenEvolution(), atmospheres.get_castelli_atmosphere,
+                                        reddening.RedLawNishiyama09())
+    assert iso_phot.missing_filters == iso_phot.filters
+
+    return
+
+def test_IsochronePhotGrid(tmp_path):
+    """
+    Test the grid interpolation on fake isochrones whose magnitudes
+    are linear in logAge and AKs.
+    """
+    from astropy.table import Table
+
+    def fake_mag(mass, logAge, AKs, distance):
+        return 20 - 2*mass + 0.5*logAge + 1.5*AKs + 5*np.log10(distance / 10.0)
+    
+    iso_dir = str(tmp_path) + '/'
+    mass = np.linspace(0.1, 10, 50)
+    for logAge in [6.0, 6.5, 7.0]:
+        for AKs in [0.0, 1.0]:
+            for distance in [1000, 8000]:
+                iso = Table([mass, fake_mag(mass, logAge, AKs, distance)],
+                            names=['mass', 'm_hst_f127m'])
+                iso.meta = {'LOGAGE': logAge, 'AKS': AKs, 'DISTANCE': distance,
+                            'METAL_IN': 0.0, 'EVOMODEL': 'fake', 'ATMFUNC': 'fake',
+                            'REDLAW': 'fake'}
+                save_file, _ = synthetic.get_iso_save_file(iso_dir, logAge, AKs, distance)
+                synthetic.write_iso_file(iso, save_file)
+
+    grid = synthetic.IsochronePhotGrid(iso_dir)
+    assert grid.filters == ['m_hst_f127m']
+        
+    # Between grid points
+    iso = grid.get_magnitudes(6.7, 0.4, 4000, mass=[1.0, 2.0, 20.0])
+    np.testing.assert_allclose(iso['m_hst_f127m'][:2],
+                               fake_mag(np.array([1.0, 2.0]), 6.7, 0.4, 4000), atol=1e-4)
+    assert np.isnan(iso['m_hst_f127m'][2])
+
+    # On a grid point
+    iso = grid.get_magnitudes(6.5, 1.0, 8000)
+    np.testing.assert_allclose(iso['mass'], mass)
+    np.testing.assert_allclose(iso['m_hst_f127m'],
+                               fake_mag(mass, 6.5, 1.0, 8000), atol=1e-4)
+
+    err = grid.get_interpolation_error(6.6, 0.5, 2000)
+    assert err.meta['LOGAGE'] == 6.5
+    assert err['max'][0] < 1e-4
+
+    try:
+        grid.get_magnitudes(8.0, 0.5, 2000)
+        assert False
+    except ValueError:
+        pass
+
+    # Filters that aren't in every isochrone
+    try:
+        synthetic.IsochronePhotGrid(iso_dir, filters=['wfc3,ir,f127m', 'nirc2,J'])
+        assert False
+    except ValueError as e:
+        assert 'nirc2,J' in str(e)
+
+    return
+
 def test_ResolvedCluster():
     from popstar import synthetic as syn
     from popstar import atmospheres as atm
@@ -294,6 +800,123 @@ def test_ResolvedCluster():
 
     return
 
+def test_ResolvedCluster_companions(tmp_path):
+    """
+    Test the companions table and the system photometry
+    of a ResolvedCluster with multiplicity.
+    """
+    from popstar.imf import imf
+    from popstar.imf import multiplicity
+
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+    iso_dir = str(tmp_path) + '/'
+    iso = synthetic.IsochronePhot(7.0, 1.0, 4000, evo_model=_FakeEvolution(),
+                                  atm_func=get_bb_atmosphere, iso_dir=iso_dir,
+                                  filters=filt_list)
+
+    my_imf = imf.IMF_broken_powerlaw(np.array([0.4, 1.0, 12.0]), np.array([-1.3, -2.3]),
+                                     multiplicity=multiplicity.MultiplicityUnresolved())
+    cluster = synthetic.ResolvedCluster(iso, my_imf, 1e4, seed=1)
+    clust = cluster.star_systems
+    comps = cluster.companions
+
+    assert np.sum(clust['N_companions']) == len(comps)
+    np.testing.assert_array_equal(np.bincount(comps['system_idx'], minlength=len(clust)),
+                                  clust['N_companions'])
+    np.testing.assert_allclose(comps['m_nirc2_J'],
+                               cluster.iso_interps['m_nirc2_J'](comps['mass']))
+    np.testing.assert_allclose(clust['systemMass'], clust['mass'] +
+                               np.bincount(comps['system_idx'], weights=comps['mass'],
+                                           minlength=len(clust)))
+
+    # System flux is the sum of the primary and companion fluxes.
+    for filt in ['m_nirc2_J', 'm_nirc2_Kp']:
+        f_prim = np.nan_to_num(10**(-0.4 * cluster.iso_interps[filt](clust['mass'])))
+        f_comp = np.nan_to_num(10**(-0.4 * comps[filt]))
+        f_sys = f_prim + np.bincount(comps['system_idx'], weights=f_comp, minlength=len(clust))
+        np.testing.assert_allclose(clust[filt], -2.5 * np.log10(f_sys))
+
+    # The same companions as a list of arrays for each system.
+    comp_list = [comps['mass'][comps['system_idx'] == ii] for ii in range(len(clust))]
+    clust2 = clust.copy()
+    clust2.remove_column('N_companions')
+    comps2 = cluster._make_companions_table(clust2, comp_list)
+    np.testing.assert_array_equal(comps2['mass'], comps['mass'])
+    np.testing.assert_array_equal(comps2['m_nirc2_Kp'], comps['m_nirc2_Kp'])
+
+    return
+
+def test_ResolvedClusterChunks(tmp_path):
+    """
+    Test making a ResolvedCluster in chunks, and writing it to disk.
+    """
+    from astropy.table import vstack
+    from popstar.imf import imf
+    from popstar.imf import multiplicity
+
+    iso = synthetic.Isochrone(7.0, 1.0, 4000, evo_model=_FakeEvolution(),
+                              atm_func=get_bb_atmosphere)
+    iso.points.add_column(np.linspace(20, 10, len(iso.points)), name='m_nirc2_Kp')
+    mass_limits = np.array([0.4, 1.0, 12.0])
+    powers = np.array([-1.3, -2.3])
+
+    # The IMF chunks add up to the cluster mass.
+    my_imf = imf.IMF_broken_powerlaw(mass_limits, powers,
+                                     multiplicity=multiplicity.MultiplicityUnresolved())
+    chunks = list(my_imf.generate_cluster_chunks(1e4, chunk_size=500, seed=1))
+    assert len(chunks) > 2
+    assert max([len(chunk[0]) for chunk in chunks]) == 500
+    sys_mass = np.concatenate([chunk[3] for chunk in chunks])
+    assert abs(sys_mass.sum() - 1e4) <= sys_mass[-1]
+    for mass, isMulti, compMass, sysMass, compOffsets in chunks:
+        assert compOffsets[-1] == len(compMass)
+        sys_idx = np.repeat(np.arange(len(mass)), np.diff(compOffsets))
+        np.testing.assert_allclose(sysMass, mass + np.bincount(sys_idx, weights=compMass,
+                                                               minlength=len(mass)))
+
+    # The cluster chunks have global system indices for the companions.
+    cluster = synthetic.ResolvedClusterChunks(iso, my_imf, 1e4, chunk_size=500, seed=1)
+    pairs = list(cluster)
+    assert len(pairs) == len(chunks)
+    clust = vstack([pair[0] for pair in pairs])
+    comps = vstack([pair[1] for pair in pairs])
+    # Same systems as the IMF chunks, less those outside the isochrone mass range.
+    mass = np.concatenate([chunk[0] for chunk in chunks])
+    good = (mass >= iso.points['mass'].min()) & (mass <= iso.points['mass'].max())
+    np.testing.assert_array_equal(clust['mass'], mass[good])
+    np.testing.assert_array_equal(np.bincount(comps['system_idx'], minlength=len(clust)),
+                                  clust['N_companions'])
+    np.testing.assert_allclose(clust['m_nirc2_Kp'][clust['N_companions'] == 0],
+                               cluster.iso_interps['m_nirc2_Kp'](clust['mass'][clust['N_companions'] == 0]))
+
+    out_dir = str(tmp_path)
+    out_file = out_dir + '/cluster.fits'
+    N_chunks = cluster.write(out_file)
+    assert N_chunks == len(pairs)
+    assert os.listdir(out_dir) == ['cluster.fits']
+
+    pairs_in = list(synthetic.read_cluster_chunks(out_file))
+    assert len(pairs_in) == len(pairs)
+    for (clust_ii, comps_ii), (clust_in, comps_in) in zip(pairs, pairs_in):
+        np.testing.assert_array_equal(clust_in['mass'], clust_ii['mass'])
+        np.testing.assert_array_equal(clust_in['m_nirc2_Kp'], clust_ii['m_nirc2_Kp'])
+        np.testing.assert_array_equal(comps_in['system_idx'], comps_ii['system_idx'])
+
+    # Without multiplicity, there are no companions tables.
+    my_imf = imf.IMF_broken_powerlaw(mass_limits, powers)
+    cluster = synthetic.ResolvedClusterChunks(iso, my_imf, 1e4, chunk_size=1000, seed=1)
+    umask = os.umask(0o022)
+    try:
+        cluster.write(out_file)
+    finally:
+        os.umask(umask)
+    assert (os.stat(out_file).st_mode & 0o777) == 0o644
+    pairs_in = list(synthetic.read_cluster_chunks(out_file))
+    assert len(pairs_in) > 1
+    assert pairs_in[0][1] is None
+
+    return
+
 def test_ResolvedClusterDiffRedden():
     from popstar import synthetic as syn
     from popstar import atmospheres as atm
@@ -391,6 +1014,132 @@ def test_ResolvedClusterDiffRedden():
 
     return
     
+def test_ResolvedClusterDiffRedden_table(tmp_path):
+    """
+    Test the differential extinction from the table of magnitudes
+    at each extinction.
+    """
+    from popstar.imf import imf
+    from popstar.imf import multiplicity
+
+    filt_list = ['nirc2,J', 'nirc2,Kp']
+    kwargs = {'evo_model': _FakeEvolution(), 'atm_func': get_bb_atmosphere,
+              'filters': filt_list}
+    deltaAKs = 0.3
+    
+    iso_dir = str(tmp_path) + '/'
+    iso = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir, **kwargs)
+
+    my_imf = imf.IMF_broken_powerlaw(np.array([0.4, 1.0, 12.0]), np.array([-1.3, -2.3]))
+    cluster0 = synthetic.ResolvedCluster(iso, my_imf, 1e4, seed=1, verbose=False)
+    cluster = synthetic.ResolvedClusterDiffRedden(iso, my_imf, 1e4, deltaAKs, seed=1,
+                                                  red_mode='table', n_AKs=20)
+    clust = cluster.star_systems
+    assert cluster.red_table.shape == (len(iso.points), 20, len(filt_list))
+
+    # The table is the photometry at each extinction
+    for aa in [0, 7, 19]:
+        iso_aa = synthetic.IsochronePhot(7.0, 1.0 + cluster.red_table_AKs[aa], 4000,
+                                         iso_dir=iso_dir, **kwargs)
+        for ff in range(len(filt_list)):
+            filt = cluster.filt_names[ff]
+            np.testing.assert_allclose(cluster.red_table[:, aa, ff],
+                                       iso_aa.points[filt] - iso.points[filt], atol=1e-4)
+
+    # Stars at the isochrone masses get the table values
+    delta = cluster._get_red_table_delta(iso.points['mass'][1:3],
+                                         cluster.red_table_AKs[[7, 7]])
+    np.testing.assert_allclose(delta, cluster.red_table[1:3, 7], atol=1e-10)
+
+    # More extinction makes the stars fainter
+    dmag = clust['m_nirc2_J'] - cluster0.star_systems['m_nirc2_J']
+    dAKs = clust['AKs_f'] - 1.0
+    assert np.all(np.sign(dmag[dAKs != 0]) == np.sign(dAKs[dAKs != 0]))
+    assert np.abs(dAKs).max() > 2 * deltaAKs
+        
+    # The companions are reddened separately from their primary.
+    my_imf = imf.IMF_broken_powerlaw(np.array([0.4, 1.0, 12.0]), np.array([-1.3, -2.3]),
+                                     multiplicity=multiplicity.MultiplicityUnresolved())
+    cluster = synthetic.ResolvedClusterDiffRedden(iso, my_imf, 1e4, deltaAKs, seed=1,
+                                                  red_mode='table')
+    clust = cluster.star_systems
+    comps = cluster.companions
+    dAKs = clust['AKs_f'] - 1.0
+    for ff in range(len(filt_list)):
+        filt = cluster.filt_names[ff]
+        m_prim = cluster.iso_interps[filt](clust['mass'])
+        m_prim += cluster._get_red_table_delta(clust['mass'], dAKs)[:, ff]
+        m_comp = cluster.iso_interps[filt](comps['mass'])
+        m_comp += cluster._get_red_table_delta(comps['mass'], dAKs[comps['system_idx']])[:, ff]
+        np.testing.assert_allclose(comps[filt], m_comp)
+            
+        f_sys = np.nan_to_num(10**(-0.4 * m_prim))
+        f_sys += np.bincount(comps['system_idx'], weights=np.nan_to_num(10**(-0.4 * m_comp)),
+                             minlength=len(clust))
+        np.testing.assert_allclose(clust[filt], -2.5 * np.log10(f_sys))
+
+    # Loaded isochrones need their spectra
+    iso = synthetic.IsochronePhot(7.0, 1.0, 4000, iso_dir=iso_dir, **kwargs)
+    assert iso.recalc == False
+    try:
+        synthetic.ResolvedClusterDiffRedden(iso, my_imf, 1e4, deltaAKs, red_mode='table')
+        assert False
+    except ValueError:
+        pass
+
+    return
+
+def test_gaussian_random_field():
+    """
+    Test the correlated extinction maps for ResolvedClusterDiffRedden.
+    """
+    from popstar.imf import imf
+
+    np.random.seed(2)
+    smooth = synthetic.make_gaussian_random_field(128, 3.0)
+    rough = synthetic.make_gaussian_random_field(128, lambda k: np.ones(len(k)))
+    assert smooth.shape == (128, 128)
+    for field in [smooth, rough]:
+        np.testing.assert_allclose([field.mean(), field.std()], [0, 1], atol=1e-10)
+
+    # Neighboring pixels are correlated in the smooth field only
+    corr_smooth = np.corrcoef(smooth[:, :-1].ravel(), smooth[:, 1:].ravel())[0, 1]
+    corr_rough = np.corrcoef(rough[:, :-1].ravel(), rough[:, 1:].ravel())[0, 1]
+    assert corr_smooth > 0.9
+    assert abs(corr_rough) < 0.1
+
+    # Sampling at the pixel centers gives the pixel values, and
+    # the field is periodic.
+    yy, xx = np.mgrid[0:128, 0:128]
+    np.testing.assert_allclose(synthetic.sample_field(smooth, (xx.ravel() + 0.5) / 128,
+                                                      (yy.ravel() + 0.5) / 128, chunk_size=1000),
+                               smooth.ravel())
+    np.testing.assert_allclose(synthetic.sample_field(smooth, [0.3, 1.3], [0.7, -0.3]),
+                               synthetic.sample_field(smooth, [0.3, 0.3], [0.7, 0.7]))
+
+    # Between the pixel centers, the interpolation lowers the variance
+    # of a rough field, as predicted by sample_field_variance.
+    for field in [smooth, rough]:
+        sampled = synthetic.sample_field(field, *np.random.uniform(size=(2, 10**6)))
+        np.testing.assert_allclose(sampled.var(), synthetic.sample_field_variance(field),
+                                   rtol=0.01)
+    assert synthetic.sample_field_variance(rough) < 0.5
+
+    # The cluster extinctions follow the map
+    iso = synthetic.Isochrone(7.0, 1.0, 4000, evo_model=_FakeEvolution(),
+                              atm_func=get_bb_atmosphere)
+    iso.points.add_column(np.linspace(20, 10, len(iso.points)), name='m_nirc2_Kp')
+    my_imf = imf.IMF_broken_powerlaw(np.array([0.4, 1.0, 12.0]), np.array([-1.3, -2.3]))
+    cluster = synthetic.ResolvedClusterDiffRedden(iso, my_imf, 1e4, 0.2, seed=1,
+                                                  power_spectrum=3.0, field_grid=64)
+    clust = cluster.star_systems
+    assert cluster.red_field.shape == (64, 64)
+    np.testing.assert_allclose(clust['AKs_f'] - 1.0,
+                               0.2 * synthetic.sample_field(cluster.red_field, clust['x'], clust['y']))
+    np.testing.assert_allclose(synthetic.sample_field_variance(cluster.red_field), 1.0)
+
+    return
+
 def test_UnresolvedCluster():
     from popstar import synthetic as syn
     from popstar import atmospheres as atm
@@ -424,6 +1173,48 @@ def test_UnresolvedCluster():
 
     return
 
+def test_UnresolvedCluster_spectrum():
+    """
+    Test that the integrated spectrum is the sum of the spectra
+    of the individual stars.
+    """
+    from popstar.imf import imf
+
+    iso = synthetic.Isochrone(7.0, 1.0, 4000, evo_model=_FakeEvolution(),
+                              atm_func=get_bb_atmosphere)
+    imf_in = imf.IMF_broken_powerlaw(np.array([0.4, 1.0, 12.0]), np.array([-1.3, -2.3]))
+
+    cluster = synthetic.UnresolvedCluster(iso, imf_in, 1e3, keep_star_spectra=True)
+    assert len(cluster.spec_list) == len(cluster.mass_all)
+    assert cluster.iso_weights.sum() == len(cluster.mass_all)
+
+    spec_sum = np.sum([spec._fluxtable for spec in cluster.spec_list], axis=0)
+    np.testing.assert_allclose(cluster.spec_tot_full, spec_sum)
+
+    spec_sum = np.sum([spec._fluxtable for spec in cluster.spec_list_trim], axis=0)
+    np.testing.assert_allclose(cluster.spec_trim, spec_sum)
+    np.testing.assert_array_equal(cluster.wave_trim, cluster.spec_list_trim[0].wave)
+
+    # The expected spectrum should match a large sampled cluster
+    cluster = synthetic.UnresolvedCluster(iso, imf_in, 1e6)
+    cluster_exp = synthetic.UnresolvedCluster(iso, imf_in, 1e6, mode='expectation')
+    assert cluster_exp.spec_list == None
+    assert len(cluster_exp.mass_all) == 0
+    np.testing.assert_allclose(cluster_exp.spec_tot_full, cluster.spec_tot_full, rtol=0.02)
+    np.testing.assert_allclose(cluster_exp.mass_tot, cluster.mass_tot, rtol=0.02)
+
+    # Hybrid with no stars above the sampling mass is the expectation.
+    cluster_hyb = synthetic.UnresolvedCluster(iso, imf_in, 1e6, mode='hybrid',
+                                              hybrid_mass_min=20)
+    np.testing.assert_allclose(cluster_hyb.spec_tot_full, cluster_exp.spec_tot_full)
+    
+    cluster_hyb = synthetic.UnresolvedCluster(iso, imf_in, 1e6, mode='hybrid',
+                                              hybrid_mass_min=2)
+    assert cluster_hyb.mass_all.min() > 1.8
+    np.testing.assert_allclose(cluster_hyb.spec_tot_full, cluster_exp.spec_tot_full, rtol=0.02)
+
+    return
+
 def test_ifmr_multiplicity():
     from popstar import synthetic as syn
     from popstar import atmospheres as atm
@@ -617,7 +1408,8 @@ def model_young_cluster_object(resolved=False):
     if resolved:
         cluster = syn.ResolvedCluster(iso, imf_in, cluster_mass)
     else:
-        cluster = syn.UnresolvedCluster(iso, imf_in, cluster_mass, wave_range=[19000,24000])
+        cluster = syn.UnresolvedCluster(iso, imf_in, cluster_mass, wave_range=[19000,24000],
+                                        keep_star_spectra=True)
 
     # Plot the spectrum of the most massive star
     idx = cluster.mass_all.argmax()
@@ -628,7 +1420,7 @@ def model_young_cluster_object(resolved=False):
     plt.plot(cluster.spec_list_trim[idx]._wavetable, cluster.spec_list_trim[idx]._fluxtable, 'k.')
 
     # Plot an integrated spectrum of the whole cluster.
-    wave, flux = cluster.spec_list_trim[idx]._wavetable, cluster.spec_trim
+    wave, flux = cluster.wave_trim, cluster.spec_trim
     plt.figure(2)
     plt.clf()
     plt.plot(wave, flux, 'k.')
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import contextlib
+
+# Umask when popstar was imported, for systems without /proc.
+_import_umask = os.umask(0)
+os.umask(_import_umask)
+
+def get_umask():
+    """
+    Return the current umask of the process. It is read from 
+    /proc/self/status, since setting the umask to read it would 
+    briefly change it for the other threads too. Where that isn't 
+    available, the umask at import is returned.
+    """
+    try:
+        with open('/proc/self/status') as _in:
+            for line in _in:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return _import_umask
+
+@contextlib.contextmanager
+def atomic_write(out_file, suffix='.tmp', directory=False):
+    """
+    Context manager to write out_file (or the directory out_file, if
+    directory is True) so that other processes never see it partially
+    written. It yields the name of a temporary file (or directory) in
+    the same directory as out_file, which is renamed to out_file if the
+    block finishes, or removed if it raises.
+
+    The temporary file gets the usual permissions of a new file under
+    the umask, rather than the 0600 (0700 for directories) that tempfile
+    uses, so that out_file can be shared with other users.
+
+    Parameters
+    ----------
+    out_file : str
+        Output file (or directory) name.
+
+    suffix : str
+        Suffix of the temporary file name, e.g. for functions that
+        pick the format or add an extension based on it (np.save).
+
+    directory : boolean
+        If True, make a temporary directory instead of a file. An
+        existing out_file directory is replaced.
+    """
+    out_dir = os.path.dirname(os.path.abspath(out_file))
+
+    if directory:
+        tmp_file = tempfile.mkdtemp(suffix=suffix, dir=out_dir)
+        mode = 0o777
+    else:
+        _out, tmp_file = tempfile.mkstemp(suffix=suffix, dir=out_dir)
+        os.close(_out)
+        mode = 0o666
+
+    try:
+        os.chmod(tmp_file, mode & ~get_umask())
+
+        yield tmp_file
+
+        if directory and os.path.isdir(out_file):
+            shutil.rmtree(out_file)
+        os.replace(tmp_file, out_file)
+    finally:
+        if directory:
+            shutil.rmtree(tmp_file, ignore_errors=True)
+        elif os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    return